@@ -0,0 +1,69 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import cPickle
+import os
+
+__all__ = ['AddressBookSnapshot', 'normalize_address']
+
+
+def normalize_address(address):
+    # strip everything that's not numbers from the URIs if they are not SIP URIs
+    if address.startswith(("http:", "https:")):
+        return address
+    elif "@" not in address:
+        if address.startswith("sip:"):
+            address = address[4:]
+        contact_uri = "+" if address[0] == "+" else ""
+        contact_uri += "".join(c for c in address if c in "0123456789#*")
+        return contact_uri
+    else:
+        return address
+
+
+class AddressBookSnapshot(object):
+    """
+        The name, organization and normalized (uri, type) addresses of the System Address Book persons loaded last
+        time, by unique id together with their modification time. It is saved to disk after each load, so when Blink
+        starts the persons not modified since are built from it instead of being read and parsed again.
+        """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.loaded = False
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                records = cPickle.load(f)
+        except Exception:
+            records = {}
+        self.records = records if isinstance(records, dict) else {}
+        self.loaded = True
+
+    def save(self):
+        # write a new file and move it in place so that a crash while saving does not lose the previous snapshot
+        try:
+            with open(self.path + '.tmp', 'wb') as f:
+                cPickle.dump(self.records, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(self.path + '.tmp', self.path)
+        except (cPickle.PickleError, IOError, OSError):
+            pass
+
+    def get(self, record, modification_time):
+        # returns the stored person if it was not modified since, None otherwise
+        try:
+            stored_modification_time, person = self.records[record]
+        except (KeyError, TypeError, ValueError):
+            return None
+        if modification_time is None or stored_modification_time != modification_time:
+            return None
+        return person
+
+    def update(self, record, modification_time, person):
+        self.records[record] = (modification_time, person)
+
+    def remove(self, records):
+        for record in records:
+            self.records.pop(record, None)
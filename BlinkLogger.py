@@ -5,13 +5,17 @@
 from __future__ import with_statement
 
 import datetime
+import gzip
 import os
+import shutil
 import sys
 
+from threading import Timer
+
 from AppKit import NSApp
 
 from application import log
-from application.notification import IObserver, NotificationCenter
+from application.notification import IObserver, Notification, NotificationCenter
 from application.python.queue import EventQueue
 from application.python.types import Singleton
 from application.system import makedirs
@@ -61,15 +65,84 @@ class BlinkLogger(object):
         return self.messages
 
 
+class TraceFile(object):
+    """Trace file that buffers writes and rotates into gzip compressed segments once it grows over max_size"""
+
+    def __init__(self, filename, buffer_size, max_size, backup_count):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.buffer = []
+        self.buffered = 0
+        self.file = open(filename, 'a')
+        self.size = os.path.getsize(filename)
+
+    def write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        if self.max_size and self.size >= self.max_size:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        try:
+            for index in xrange(self.backup_count - 1, 0, -1):
+                segment = '%s.%d.gz' % (self.filename, index)
+                if os.path.exists(segment):
+                    os.rename(segment, '%s.%d.gz' % (self.filename, index + 1))
+            with open(self.filename, 'rb') as source:
+                target = gzip.open('%s.1.gz' % self.filename, 'wb')
+                try:
+                    shutil.copyfileobj(source, target)
+                finally:
+                    target.close()
+            os.remove(self.filename)
+        except Exception, e:
+            print "failed to rotate log file '%s': %s" % (self.filename, e)
+        self.file = open(self.filename, 'a')
+        self.size = os.path.getsize(self.filename)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+
 class FileLogger(object):
     __metaclass__ = Singleton
     implements(IObserver)
 
+    # trace files are written once trace_buffer_size bytes are pending or trace_flush_interval seconds after the first pending write
+    trace_buffer_size = 64*1024
+    trace_flush_interval = 1.0
+    # and are rotated into at most trace_backup_count compressed segments once they grow over trace_max_size bytes
+    trace_max_size = 20*1024*1024
+    trace_backup_count = 5
+
     # public methods
     #
 
     def __init__(self, msrp_level=log.level.INFO):
         self.msrp_level = msrp_level
+        self._prefix = '%s %d' % (os.path.basename(sys.argv[0]).rstrip('.py'), os.getpid())
+        self._settings = None
+        self._flush_timer = None
 
         self._siptrace_filename = None
         self._siptrace_file = None
@@ -100,6 +173,8 @@ class FileLogger(object):
         except Exception:
             pass
 
+        self._settings = SIPSimpleSettings()
+
         # register to receive log notifications
         notification_center = NotificationCenter()
         notification_center.add_observer(self)
@@ -113,25 +188,13 @@ class FileLogger(object):
         self._event_queue.stop()
         self._event_queue.join()
 
-        # close sip trace file
-        if self._siptrace_file is not None:
-            self._siptrace_file.close()
-            self._siptrace_file = None
-
-        # close msrp trace file
-        if self._msrptrace_file is not None:
-            self._msrptrace_file.close()
-            self._msrptrace_file = None
-
-        # close pjsip trace file
-        if self._pjsiptrace_file is not None:
-            self._pjsiptrace_file.close()
-            self._pjsiptrace_file = None
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
 
-        # close notifications trace file
-        if self._notifications_file is not None:
-            self._notifications_file.close()
-            self._notifications_file = None
+        # flush and close the trace files
+        for type in ('siptrace', 'msrptrace', 'pjsiptrace', 'notifications'):
+            self._close_log_file(type)
 
         # unregister from receiving notifications
         notification_center = NotificationCenter()
@@ -142,7 +205,7 @@ class FileLogger(object):
 
     @allocate_autorelease_pool
     def _process_notification(self, notification):
-        settings = SIPSimpleSettings()
+        settings = self._settings
         handler = getattr(self, '_NH_%s' % notification.name, None)
         if handler is not None:
             handler(notification)
@@ -151,7 +214,7 @@ class FileLogger(object):
         if handler is not None:
             handler(notification)
 
-        if notification.name not in ('SIPEngineLog', 'SIPEngineSIPTrace') and settings.logs.trace_notifications and settings.logs.trace_notifications_to_file:
+        if notification.name not in ('SIPEngineLog', 'SIPEngineSIPTrace', 'FileLoggerFlushTraces') and settings.logs.trace_notifications and settings.logs.trace_notifications_to_file:
             try:
                 self._init_log_file('notifications')
             except Exception:
@@ -159,27 +222,28 @@ class FileLogger(object):
             else:
                 message = 'Notification name=%s sender=%s data=%s' % (notification.name, notification.sender, pformat(notification.data))
                 self._notifications_file.write('%s: %s\n' % (datetime.datetime.now(), message))
-                self._notifications_file.flush()
+                self._schedule_flush()
 
     # notification handlers
     #
 
+    def _NH_FileLoggerFlushTraces(self, notification):
+        self._flush_timer = None
+        for type in ('siptrace', 'msrptrace', 'pjsiptrace', 'notifications'):
+            trace_file = getattr(self, '_%s_file' % type)
+            if trace_file is not None:
+                try:
+                    trace_file.flush()
+                except Exception, e:
+                    print "failed to write log file '%s': %s" % (trace_file.filename, e)
+
     def _NH_CFGSettingsObjectDidChange(self, notification):
-        settings = SIPSimpleSettings()
+        settings = self._settings
         if notification.sender is settings:
             if 'logs.directory' in notification.data.modified:
-                # sip trace
-                if self._siptrace_file is not None:
-                    self._siptrace_file.close()
-                    self._siptrace_file = None
-                # pjsip trace
-                if self._pjsiptrace_file is not None:
-                    self._pjsiptrace_file.close()
-                    self._pjsiptrace_file = None
-                # notifications trace
-                if self._notifications_file is not None:
-                    self._notifications_file.close()
-                    self._notifications_file = None
+                # sip, msrp, pjsip and notifications traces
+                for type in ('siptrace', 'msrptrace', 'pjsiptrace', 'notifications'):
+                    self._close_log_file(type)
                 # try to create the log directory
                 try:
                     self._init_log_directory()
@@ -190,7 +254,7 @@ class FileLogger(object):
     #
 
     def _LH_SIPEngineSIPTrace(self, notification):
-        settings = SIPSimpleSettings()
+        settings = self._settings
         if not settings.logs.trace_sip or not settings.logs.trace_sip_to_file:
             return
         if self._siptrace_start_time is None:
@@ -210,11 +274,11 @@ class FileLogger(object):
         except Exception:
             pass
         else:
-            self._siptrace_file.write('%s [%s %d]: %s\n' % (notification.datetime, os.path.basename(sys.argv[0]).rstrip('.py'), os.getpid(), message))
-            self._siptrace_file.flush()
+            self._siptrace_file.write('%s [%s]: %s\n' % (notification.datetime, self._prefix, message))
+            self._schedule_flush()
 
     def _LH_SIPEngineLog(self, notification):
-        settings = SIPSimpleSettings()
+        settings = self._settings
         if not settings.logs.trace_pjsip or not settings.logs.trace_pjsip_to_file:
             return
         message = "(%(level)d) %(message)s" % notification.data.__dict__
@@ -223,11 +287,11 @@ class FileLogger(object):
         except Exception:
             pass
         else:
-            self._pjsiptrace_file.write('[%s %d] %s\n' % (os.path.basename(sys.argv[0]).rstrip('.py'), os.getpid(), message))
-            self._pjsiptrace_file.flush()
+            self._pjsiptrace_file.write('[%s] %s\n' % (self._prefix, message))
+            self._schedule_flush()
 
     def _LH_DNSLookupTrace(self, notification):
-        settings = SIPSimpleSettings()
+        settings = self._settings
         if not settings.logs.trace_sip or not settings.logs.trace_sip_to_file:
             return
         message = 'DNS lookup %(query_type)s %(query_name)s' % notification.data.__dict__
@@ -251,11 +315,11 @@ class FileLogger(object):
         except Exception:
             pass
         else:
-            self._siptrace_file.write('%s [%s %d]: %s\n' % (notification.datetime, os.path.basename(sys.argv[0]).rstrip('.py'), os.getpid(), message))
-            self._siptrace_file.flush()
+            self._siptrace_file.write('%s [%s]: %s\n' % (notification.datetime, self._prefix, message))
+            self._schedule_flush()
 
     def _LH_MSRPTransportTrace(self, notification):
-        settings = SIPSimpleSettings()
+        settings = self._settings
         if not settings.logs.trace_msrp or not settings.logs.trace_msrp_to_file:
             return
         arrow = {'incoming': '<--', 'outgoing': '-->'}[notification.data.direction]
@@ -269,11 +333,11 @@ class FileLogger(object):
         except Exception:
             pass
         else:
-            self._msrptrace_file.write('%s [%s %d]: %s\n' % (notification.datetime, os.path.basename(sys.argv[0]).rstrip('.py'), os.getpid(), message))
-            self._msrptrace_file.flush()
+            self._msrptrace_file.write('%s [%s]: %s\n' % (notification.datetime, self._prefix, message))
+            self._schedule_flush()
 
     def _LH_MSRPLibraryLog(self, notification):
-        settings = SIPSimpleSettings()
+        settings = self._settings
         if not settings.logs.trace_msrp or not settings.logs.trace_msrp_to_file:
             return
         if notification.data.level < self.msrp_level:
@@ -284,8 +348,8 @@ class FileLogger(object):
         except Exception:
             pass
         else:
-            self._msrptrace_file.write('%s [%s %d]: %s\n' % (notification.datetime, os.path.basename(sys.argv[0]).rstrip('.py'), os.getpid(), message))
-            self._msrptrace_file.flush()
+            self._msrptrace_file.write('%s [%s]: %s\n' % (notification.datetime, self._prefix, message))
+            self._schedule_flush()
 
     # private methods
     #
@@ -330,7 +394,7 @@ class FileLogger(object):
             self._init_log_directory()
             filename = getattr(self, '_%s_filename' % type)
             try:
-                setattr(self, '_%s_file' % type, open(filename, 'a'))
+                setattr(self, '_%s_file' % type, TraceFile(filename, self.trace_buffer_size, self.trace_max_size, self.trace_backup_count))
             except Exception, e:
                 if not getattr(self, '_%s_error' % type):
                     print "failed to create log file '%s': %s" % (filename, e)
@@ -339,4 +403,18 @@ class FileLogger(object):
             else:
                 setattr(self, '_%s_error' % type, False)
 
-
+    def _close_log_file(self, type):
+        trace_file = getattr(self, '_%s_file' % type)
+        if trace_file is not None:
+            setattr(self, '_%s_file' % type, None)
+            try:
+                trace_file.close()
+            except Exception, e:
+                print "failed to write log file '%s': %s" % (trace_file.filename, e)
+
+    def _schedule_flush(self):
+        if self._flush_timer is None:
+            # the flush is queued behind the pending notifications, so trace files are only touched by the log thread
+            self._flush_timer = Timer(self.trace_flush_interval, self._event_queue.put, (Notification('FileLoggerFlushTraces', self),))
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
@@ -63,7 +63,7 @@ from gnutls.errors import GNUTLSError
 
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null
-from itertools import chain
+from itertools import chain, islice
 from zope.interface import implements
 
 from sipsimple.account import BonjourAccount
@@ -170,7 +170,6 @@ class ChatController(MediaStream):
     screenshot_task = None
     dealloc_timer = None
     zoom_period_label = ''
-    message_count_from_history = 0
 
     nickname_request_map = {} # message id -> nickname
     new_fingerprints = {}
@@ -195,7 +194,8 @@ class ChatController(MediaStream):
         self.share_screen_in_conference = False
 
         self.previous_is_encrypted = False
-        self.history_msgid_list=set()
+        self.history_msgid_list=[]
+        self.history_cursor = None
 
         self.remote_uri = format_identity_to_string(self.sessionController.remotePartyObject)
         self.local_uri = '%s@%s' % (self.sessionController.account.id.username, self.sessionController.account.id.domain) if self.sessionController.account is not BonjourAccount() else 'bonjour'
@@ -770,13 +770,11 @@ class ChatController(MediaStream):
         except IndexError:
             msgid = None
 
-        self.chatViewController.clear()
-        self.chatViewController.resetRenderedMessages()
-        self.replay_history(msgid)
+        self.replay_history(msgid, older=True)
 
     @run_in_green_thread
     @allocate_autorelease_pool
-    def replay_history(self, scrollToMessageId=None):
+    def replay_history(self, scrollToMessageId=None, older=False):
         if not self:
             return
 
@@ -787,39 +785,15 @@ class ChatController(MediaStream):
             remote_uris = list(str(uri.uri) for uri in blink_contact.uris if '@' in uri.uri)
 
         if self.sessionController.account is not BonjourAccount():
-            zoom_factor = self.chatViewController.scrolling_zoom_factor
-            if zoom_factor:
-                period_array = {
-                                1: datetime.datetime.now()-datetime.timedelta(days=2),
-                                2: datetime.datetime.now()-datetime.timedelta(days=7),
-                                3: datetime.datetime.now()-datetime.timedelta(days=31),
-                                4: datetime.datetime.now()-datetime.timedelta(days=90),
-                                5: datetime.datetime.now()-datetime.timedelta(days=180),
-                                6: datetime.datetime.now()-datetime.timedelta(days=365),
-                                7: datetime.datetime.now()-datetime.timedelta(days=3650)
-                            }
-
-                after_date = period_array[zoom_factor].strftime("%Y-%m-%d")
-
-                if zoom_factor == 1:
-                    self.zoom_period_label = 'Displaying messages from last day'
-                elif zoom_factor == 2:
-                    self.zoom_period_label = 'Displaying messages from last week'
-                elif zoom_factor == 3:
-                    self.zoom_period_label = 'Displaying messages from last month'
-                elif zoom_factor == 4:
-                    self.zoom_period_label = 'Displaying messages from last three months'
-                elif zoom_factor == 5:
-                    self.zoom_period_label = 'Displaying messages from last six months'
-                elif zoom_factor == 6:
-                    self.zoom_period_label = 'Displaying messages from last year'
-                elif zoom_factor == 7:
-                    self.zoom_period_label = 'Displaying all messages'
-                    self.chatViewController.setHandleScrolling_(False)
-
-                results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), after_date=after_date, count=10000, search_text=self.chatViewController.search_text)
+            if older and self.history_cursor is None:
+                results = []
             else:
-                results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), count=self.showHistoryEntries, search_text=self.chatViewController.search_text)
+                # fetch only the page of messages older than the oldest one already displayed
+                before = self.history_cursor if older else None
+                results = list(islice(self.history.iter_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), search_text=self.chatViewController.search_text, before=before, page_size=self.showHistoryEntries), self.showHistoryEntries))
+
+            if results:
+                self.history_cursor = (results[-1].time, results[-1].id)
 
             # build a list of previously failed messages
             last_failed_messages=[]
@@ -828,62 +802,67 @@ class ChatController(MediaStream):
                     break
                 last_failed_messages.append(row)
             last_failed_messages.reverse()
-            self.history_msgid_list = [row.msgid for row in reversed(list(results))]
+            msgid_list = [row.msgid for row in reversed(results)]
+            self.history_msgid_list = msgid_list + self.history_msgid_list if older else msgid_list
 
             # render last delievered messages except those due to be resent
-            # messages_to_render = [row for row in reversed(list(results)) if row not in last_failed_messages]
-            messages_to_render = [row for row in reversed(list(results))]
+            # messages_to_render = [row for row in reversed(results) if row not in last_failed_messages]
+            messages_to_render = [row for row in reversed(results)]
             #self.resend_last_failed_message(last_failed_messages)
-            self.render_history_messages(messages_to_render, scrollToMessageId)
+            self.render_history_messages(messages_to_render, scrollToMessageId, older)
 
-        self.send_pending_message()
+        if not older:
+            self.send_pending_message()
 
     @allocate_autorelease_pool
     @run_in_gui_thread
-    def render_history_messages(self, messages, scrollToMessageId=None):
-        if self.chatViewController.scrolling_zoom_factor:
-            if not self.message_count_from_history:
-                self.message_count_from_history = len(messages)
-                self.chatViewController.lastMessagesLabel.setStringValue_(self.zoom_period_label)
-            else:
-                if self.message_count_from_history >= len(messages):
-                    self.chatViewController.setHandleScrolling_(False)
-                    self.zoom_period_label = '%s. There are no previous messages.' % self.zoom_period_label
-                    self.chatViewController.lastMessagesLabel.setStringValue_(self.zoom_period_label)
-                    self.chatViewController.setHandleScrolling_(False)
-                else:
-                    self.chatViewController.lastMessagesLabel.setStringValue_(self.zoom_period_label)
-        else:
-            self.message_count_from_history = len(messages)
-            if len(messages):
-                self.chatViewController.lastMessagesLabel.setStringValue_('Scroll up for going back in time')
-            else:
-                self.chatViewController.setHandleScrolling_(False)
-                self.chatViewController.lastMessagesLabel.setStringValue_('There are no previous messages')
-
-        if len(messages):
+    def render_history_messages(self, messages, scrollToMessageId=None, older=False):
+        if len(messages) and messages[0].date is not None:
             message = messages[0]
             delta = datetime.date.today() - message.date
 
-            if not self.chatViewController.scrolling_zoom_factor:
-                if delta.days <= 2:
-                    self.chatViewController.scrolling_zoom_factor = 1
-                elif delta.days <= 7:
-                    self.chatViewController.scrolling_zoom_factor = 2
-                elif delta.days <= 31:
-                    self.chatViewController.scrolling_zoom_factor = 3
-                elif delta.days <= 90:
-                    self.chatViewController.scrolling_zoom_factor = 4
-                elif delta.days <= 180:
-                    self.chatViewController.scrolling_zoom_factor = 5
-                elif delta.days <= 365:
-                    self.chatViewController.scrolling_zoom_factor = 6
-                else:
-                    self.chatViewController.scrolling_zoom_factor = 7
+            if delta.days <= 2:
+                self.chatViewController.scrolling_zoom_factor = 1
+                self.zoom_period_label = 'Displaying messages from last day'
+            elif delta.days <= 7:
+                self.chatViewController.scrolling_zoom_factor = 2
+                self.zoom_period_label = 'Displaying messages from last week'
+            elif delta.days <= 31:
+                self.chatViewController.scrolling_zoom_factor = 3
+                self.zoom_period_label = 'Displaying messages from last month'
+            elif delta.days <= 90:
+                self.chatViewController.scrolling_zoom_factor = 4
+                self.zoom_period_label = 'Displaying messages from last three months'
+            elif delta.days <= 180:
+                self.chatViewController.scrolling_zoom_factor = 5
+                self.zoom_period_label = 'Displaying messages from last six months'
+            elif delta.days <= 365:
+                self.chatViewController.scrolling_zoom_factor = 6
+                self.zoom_period_label = 'Displaying messages from last year'
+            else:
+                self.chatViewController.scrolling_zoom_factor = 7
+                self.zoom_period_label = 'Displaying all messages'
+
+        if len(messages) < self.showHistoryEntries:
+            # the last page of the history has been reached
+            self.chatViewController.setHandleScrolling_(False)
+            if not older and not len(messages):
+                self.chatViewController.lastMessagesLabel.setStringValue_('There are no previous messages')
+            else:
+                self.zoom_period_label = '%s. There are no previous messages.' % self.zoom_period_label
+                self.chatViewController.lastMessagesLabel.setStringValue_(self.zoom_period_label)
+        elif older:
+            self.chatViewController.lastMessagesLabel.setStringValue_(self.zoom_period_label)
+        else:
+            self.chatViewController.lastMessagesLabel.setStringValue_('Scroll up for going back in time')
+
+        if older:
+            self.chatViewController.startRenderingOlderMessages()
 
         call_id = None
         seen_sms = {}
         last_media_type = None
+        entries = []
 
         for message in messages:
             if message.status == 'failed':
@@ -900,8 +879,7 @@ class ChatController(MediaStream):
             if message.direction == 'outgoing':
                 icon = NSApp.delegate().contactsWindowController.iconPathForSelf()
             else:
-                sender_uri = sipuri_components_from_string(message.cpim_from)[0]
-                icon = NSApp.delegate().contactsWindowController.iconPathForURI(sender_uri)
+                icon = NSApp.delegate().contactsWindowController.iconPathForCPIMIdentity(message.cpim_from)
 
             timestamp=ISOTimestamp(message.cpim_timestamp)
             is_html = message.content_type != 'text'
@@ -909,16 +887,21 @@ class ChatController(MediaStream):
 
             if self.chatViewController:
                 if call_id is not None and call_id != message.sip_callid and  message.media_type == 'chat':
-                    self.chatViewController.showSystemMessage(message.sip_callid, 'Connection established', timestamp, False)
+                    entries.append(self.chatViewController.systemMessageEntry(message.sip_callid, 'Connection established', timestamp, False))
 
                 if message.media_type == 'sms' and last_media_type == 'chat':
-                    self.chatViewController.showSystemMessage(message.sip_callid, 'Instant messages', timestamp, False)
+                    entries.append(self.chatViewController.systemMessageEntry(message.sip_callid, 'Instant messages', timestamp, False))
 
-                self.chatViewController.showMessage(message.sip_callid, message.msgid, message.direction, message.cpim_from, icon, message.body, timestamp, is_private=private, recipient=message.cpim_to, state=message.status, is_html=is_html, history_entry=True, media_type = message.media_type, encryption=message.encryption)
+                entries.append(self.chatViewController.messageEntry(message.sip_callid, message.msgid, message.direction, message.cpim_from, icon, message.body, timestamp, is_private=private, recipient=message.cpim_to, state=message.status, is_html=is_html, media_type = message.media_type, encryption=message.encryption))
 
             call_id = message.sip_callid
             last_media_type = 'chat' if message.media_type == 'chat' else 'sms'
 
+        if self.chatViewController:
+            self.chatViewController.showMessages(entries)
+
+        if older:
+            self.chatViewController.finishRenderingOlderMessages()
         if scrollToMessageId is not None:
             self.chatViewController.scrollToId(scrollToMessageId)
         self.chatViewController.loadingProgressIndicator.stopAnimation_(None)
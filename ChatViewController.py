@@ -7,6 +7,7 @@ __all__ = ['ChatInputTextView', 'ChatViewController', 'processHTMLText',
 import calendar
 import cgi
 import datetime
+import json
 import objc
 import os
 import re
@@ -68,12 +69,10 @@ def processHTMLText(text, usesmileys=True, is_html=False):
         if not is_html and _url_pattern_exact.match(token):
             type, d, rest = token.partition(":")
             url = type + d + urllib.quote(rest.encode('utf-8'), "/%?&=;:,@+$#")
-            token = r'<a href=\"%s\">%s</a>' % (url, escape_html(token))
+            token = '<a href="%s">%s</a>' % (url, escape_html(token))
         else:
             if not is_html:
                 token = escape_html(token)
-            else:
-                token = token.replace('"', r'\"')
             if usesmileys:
                 token = SmileyManager().subst_smileys_html(token)
         result.append(token)
@@ -224,6 +223,7 @@ class ChatViewController(NSObject):
 
     editorIsComposing = False
     scrolling_back = False
+    older_messages_index = None
 
     @property
     def sessionController(self):
@@ -405,10 +405,11 @@ class ChatViewController(NSObject):
         else:
             self.messageQueue = []
 
-    def showSystemMessage(self, call_id, text, timestamp=None, is_error=False):
+    def systemMessageEntry(self, call_id, text, timestamp=None, is_error=False):
+        # keeps track of the message and returns the arguments used to render it with renderMessages()
         msgid = str(uuid.uuid1())
         rendered_message = ChatMessageObject(call_id, msgid, text, False, timestamp)
-        self.rendered_messages.append(rendered_message)
+        self.addRenderedMessage(rendered_message)
 
         if timestamp is None:
             timestamp = ISOTimestamp.now()
@@ -418,15 +419,11 @@ class ChatViewController(NSObject):
             else:
                 timestamp = time.strftime("%T", time.localtime(calendar.timegm(timestamp.utctimetuple())))
 
-        is_error = 1 if is_error else "null"
-        script = """renderSystemMessage('%s', "%s", "%s", %s)""" % (msgid, processHTMLText(text), timestamp, is_error)
+        is_error = 1 if is_error else None
+        return ["system", msgid, processHTMLText(text), timestamp, is_error]
 
-        if self.finishedLoading:
-            self.executeJavaScript(script)
-        else:
-            self.messageQueue.append(script)
-
-    def showMessage(self, call_id, msgid, direction, sender, icon_path, text, timestamp, is_html=False, state='', recipient='', is_private=False, history_entry=False, media_type='chat', encryption=None):
+    def messageEntry(self, call_id, msgid, direction, sender, icon_path, text, timestamp, is_html=False, state='', recipient='', is_private=False, media_type='chat', encryption=None):
+        # keeps track of the message and returns the arguments used to render it with renderMessages()
         lock_icon_path = ''
         if encryption is not None:
             if encryption == '':
@@ -434,12 +431,9 @@ class ChatViewController(NSObject):
             else:
                 lock_icon_path = Resources.get('locked-green.png' if encryption == 'verified' else 'locked-red.png')
 
-        if not history_entry and not self.delegate.isOutputFrameVisible():
-            self.delegate.showChatViewWhileVideoActive()
-
         # keep track of rendered messages to toggle the smileys or search their content later
         rendered_message = ChatMessageObject(call_id, msgid, text, is_html, timestamp, media_type)
-        self.rendered_messages.append(rendered_message)
+        self.addRenderedMessage(rendered_message)
 
         if timestamp.date() != datetime.date.today():
             displayed_timestamp = time.strftime("%F %T", time.localtime(calendar.timegm(timestamp.utctimetuple())))
@@ -447,7 +441,7 @@ class ChatViewController(NSObject):
             displayed_timestamp = time.strftime("%T", time.localtime(calendar.timegm(timestamp.utctimetuple())))
 
         text = processHTMLText(text, self.expandSmileys, is_html)
-        private = 1 if is_private else "null"
+        private = 1 if is_private else None
 
         if is_private and recipient:
             label = 'Private message to %s' % cgi.escape(recipient) if direction == 'outgoing' else 'Private message from %s' % cgi.escape(sender)
@@ -457,15 +451,53 @@ class ChatViewController(NSObject):
             else:
                 label = cgi.escape(self.account.display_name or self.account.id) if sender is None else cgi.escape(sender)
 
-        script = """renderMessage('%s', '%s', '%s', '%s', "%s", '%s', '%s', %s, '%s')""" % (msgid, direction, label, icon_path, text, displayed_timestamp, state, private, lock_icon_path)
+        return ["message", msgid, direction, label, icon_path, text, displayed_timestamp, state, private, lock_icon_path]
+
+    def showSystemMessage(self, call_id, text, timestamp=None, is_error=False):
+        self.renderEntries([self.systemMessageEntry(call_id, text, timestamp, is_error)])
+
+    def showMessage(self, call_id, msgid, direction, sender, icon_path, text, timestamp, is_html=False, state='', recipient='', is_private=False, history_entry=False, media_type='chat', encryption=None):
+        if not history_entry and not self.delegate.isOutputFrameVisible():
+            self.delegate.showChatViewWhileVideoActive()
+
+        self.renderEntries([self.messageEntry(call_id, msgid, direction, sender, icon_path, text, timestamp, is_html, state, recipient, is_private, media_type, encryption)])
+
+        if hasattr(self.delegate, "chatViewDidGetNewMessage_"):
+            self.delegate.chatViewDidGetNewMessage_(self)
+
+    def showMessages(self, entries):
+        # renders history entries built with messageEntry() and systemMessageEntry() with a single call into the web view
+        if not entries:
+            return
+
+        self.renderEntries(entries)
+
+        if hasattr(self.delegate, "chatViewDidGetNewMessage_"):
+            self.delegate.chatViewDidGetNewMessage_(self)
+
+    def renderEntries(self, entries):
+        script = "renderMessages(%s)" % json.dumps(entries)
 
         if self.finishedLoading:
             self.executeJavaScript(script)
         else:
             self.messageQueue.append(script)
 
-        if hasattr(self.delegate, "chatViewDidGetNewMessage_"):
-            self.delegate.chatViewDidGetNewMessage_(self)
+    def addRenderedMessage(self, rendered_message):
+        if self.older_messages_index is not None:
+            self.rendered_messages.insert(self.older_messages_index, rendered_message)
+            self.older_messages_index += 1
+        else:
+            self.rendered_messages.append(rendered_message)
+
+    def startRenderingOlderMessages(self):
+        # messages rendered from now on are placed above the ones already displayed
+        self.older_messages_index = 0
+        self.executeJavaScript("startRenderingOlderMessages()")
+
+    def finishRenderingOlderMessages(self):
+        self.older_messages_index = None
+        self.executeJavaScript("finishRenderingOlderMessages()")
 
     def toggleSmileys(self, expandSmileys):
         for entry in self.rendered_messages:
@@ -473,7 +505,7 @@ class ChatViewController(NSObject):
 
     def updateMessage(self, msgid, text, is_html, expandSmileys):
         text = processHTMLText(text, expandSmileys, is_html)
-        script = """updateMessageBodyContent('%s', "%s")""" % (msgid, text)
+        script = "updateMessageBodyContent(%s, %s)" % (json.dumps(msgid), json.dumps(text))
         self.executeJavaScript(script)
 
     def toggleCollaborationEditor(self):
@@ -595,26 +627,8 @@ class ChatViewController(NSObject):
 
     def scrollTimerDelay_(self, timer):
         if self.scrolling_back:
-            self.scrolling_zoom_factor += 1
-            if self.scrolling_zoom_factor > 7:
-                self.scrolling_zoom_factor = 7
             self.loadingProgressIndicator.startAnimation_(None)
-            self.lastMessagesLabel.setStringValue_('Loading messages...')
-            if self.scrolling_zoom_factor == 1:
-                zoom_period_label = 'Loading messages from last day...'
-            elif self.scrolling_zoom_factor == 2:
-                zoom_period_label = 'Loading messages from last week...'
-            elif self.scrolling_zoom_factor == 3:
-                zoom_period_label = 'Loading messages from last month...'
-            elif self.scrolling_zoom_factor == 4:
-                zoom_period_label = 'Loading messages from last three months...'
-            elif self.scrolling_zoom_factor == 5:
-                zoom_period_label = 'Loading messages from last six months...'
-            elif self.scrolling_zoom_factor == 6:
-                zoom_period_label = 'Loading messages from last year...'
-            elif self.scrolling_zoom_factor == 7:
-                zoom_period_label = 'Loading all messages...'
-            self.lastMessagesLabel.setStringValue_(zoom_period_label)
+            self.lastMessagesLabel.setStringValue_('Loading older messages...')
             self.delegate.scroll_back_in_time()
 
     def collaborativeEditorisTyping(self):
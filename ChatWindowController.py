@@ -177,7 +177,7 @@ class ChatWindowController(NSWindowController):
             self.notification_center.add_observer(self, name="BlinkShouldTerminate")
             self.notification_center.add_observer(self, name="BlinkCollaborationEditorContentHasChanged")
             self.notification_center.add_observer(self, name="BlinkConferenceGotUpdate")
-            self.notification_center.add_observer(self, name="BlinkContactsHaveChanged")
+            self.notification_center.add_observer(self, name="BlinkContactListDidChange")
             self.notification_center.add_observer(self, name="BlinkGotProposal")
             self.notification_center.add_observer(self, name="BlinkSentAddProposal")
             self.notification_center.add_observer(self, name="BlinkSentRemoveProposal")
@@ -553,7 +553,7 @@ class ChatWindowController(NSWindowController):
     def _NH_BlinkConferenceGotUpdate(self, sender, data):
         self.refreshDrawer()
 
-    def _NH_BlinkContactsHaveChanged(self, sender, data):
+    def _NH_BlinkContactListDidChange(self, sender, data):
         self.setOwnIcon()
         self.refreshDrawer()
 
@@ -102,13 +102,15 @@ from zope.interface import implements
 
 from ContactController import AddContactController, EditContactController
 from GroupController import AddGroupController
+from AddressBookSnapshot import AddressBookSnapshot, normalize_address
 from AudioSession import AudioSession
 from BlinkLogger import BlinkLogger
 from HistoryManager import SessionHistory
 from MergeContactController import MergeContactController
+from PresenceAggregate import PresenceAggregate
 from VirtualGroups import VirtualGroupsManager, VirtualGroup
 from resources import ApplicationData, Resources
-from util import allocate_autorelease_pool, format_date, format_uri_type, is_anonymous, sipuri_components_from_string, sip_prefix_pattern, strip_addressbook_special_characters, run_in_gui_thread, BLINK_URL_TOKEN
+from util import allocate_autorelease_pool, format_date, format_uri_type, is_anonymous, sipuri_components_from_string, sip_prefix_pattern, strip_addressbook_special_characters, run_in_gui_thread, BLINK_URL_TOKEN, LRUCache
 
 
 ICON_SIZE = 128
@@ -215,6 +217,19 @@ def decode_icon(data):
         return None
 
 
+def split_uri(uri):
+    if isinstance(uri, (FrozenSIPURI, SIPURI)):
+        return (uri.user or '', uri.host or '')
+    elif '@' in uri:
+        uri = sip_prefix_pattern.sub("", uri)
+        user, _, host = uri.partition("@")
+        host = host.partition(":")[0]
+        return (user, host)
+    else:
+        user = uri.partition(":")[0]
+        return (user, '')
+
+
 class Avatar(object):
     def __init__(self, icon, path=None):
         self.icon = self.scale_icon(icon)
@@ -430,16 +445,7 @@ class BlinkContact(NSObject):
         return any(text in item for item in chain((uri.uri.lower() for uri in self.uris), (self.name.lower(),)))
 
     def split_uri(self, uri):
-        if isinstance(uri, (FrozenSIPURI, SIPURI)):
-            return (uri.user or '', uri.host or '')
-        elif '@' in uri:
-            uri = sip_prefix_pattern.sub("", uri)
-            user, _, host = uri.partition("@")
-            host = host.partition(":")[0]
-            return (user, host)
-        else:
-            user = uri.partition(":")[0]
-            return (user, '')
+        return split_uri(uri)
 
     def matchesURI(self, uri, exact_match=False):
 
@@ -665,6 +671,10 @@ class BlinkPresenceContact(BlinkContact):
     """Contact representation with Presence Enabled"""
     implements(IObserver)
 
+    # contact id -> (pidf ids, PresenceAggregate) shared by all copies of a contact, which are updated one after the other,
+    # so a bounded cache is enough and entries of deleted contacts are eventually dropped
+    presence_aggregation_cache = LRUCache(500)
+
     auto_answer = BlinkPresenceContactAttribute('auto_answer')
     name = BlinkPresenceContactAttribute('name')
     uris = BlinkPresenceContactAttribute('uris')
@@ -683,6 +693,9 @@ class BlinkPresenceContact(BlinkContact):
         self.old_presence_note = None
         self.old_resource_state = None
         self.pidfs_map = {}
+        self._pidfs = set()
+        self._pidfs_snapshot = []
+        self._pidfs_lists = []
         self.init_presence_state()
         self.timer = None
         self.application_will_end = False
@@ -693,17 +706,24 @@ class BlinkPresenceContact(BlinkContact):
 
     @property
     def pidfs(self):
+        # the set is only rebuilt when a pidf list was added, replaced or removed from pidfs_map. The snapshot keeps
+        # references to the lists, so their ids cannot be reused while it is valid
+        pidfs_lists = [pidfs_for_account for value in self.pidfs_map.itervalues() for pidfs_for_account in value.itervalues()]
+        snapshot = map(id, pidfs_lists)
+        if snapshot == self._pidfs_snapshot:
+            return self._pidfs
         pidfs = set()
-        for key in self.pidfs_map.keys():
-            for account in self.pidfs_map[key].keys():
-                pidfs_for_account = self.pidfs_map[key][account]
-                found = False
-                for pidf in pidfs_for_account:
-                    for old_pidf in pidfs:
-                        if old_pidf == pidf:
-                            found = True
-                    if not found:
-                        pidfs.add(pidf)
+        for pidfs_for_account in pidfs_lists:
+            found = False
+            for pidf in pidfs_for_account:
+                for old_pidf in pidfs:
+                    if old_pidf == pidf:
+                        found = True
+                if not found:
+                    pidfs.add(pidf)
+        self._pidfs = pidfs
+        self._pidfs_snapshot = snapshot
+        self._pidfs_lists = pidfs_lists
         return pidfs
 
     def account_has_pidfs_for_uris(self, account, uris):
@@ -855,7 +875,7 @@ class BlinkPresenceContact(BlinkContact):
             self.old_resource_state = resource.state
 
             old_pidf_list_for_uri = []
-            if uri not in self.pidfs_map.keys():
+            if uri not in self.pidfs_map:
                 self.pidfs_map[uri] = {}
 
             try:
@@ -871,20 +891,20 @@ class BlinkPresenceContact(BlinkContact):
 
         if full_state:
             # purge old uris
-            for uri in self.pidfs_map.copy().keys():
+            purged = False
+            for uri in self.pidfs_map.keys():
                 uri_text = sip_prefix_pattern.sub('', uri)
                 if uri_text not in resources_uris:
                     changes = True
                     try:
                         del self.pidfs_map[uri][account]
-                        for key, value in self.pidfs_map.copy().iteritems():
-                            if not value:
-                                try:
-                                    del self.pidfs_map[key]
-                                except KeyError:
-                                    pass
                     except KeyError:
                         pass
+                    else:
+                        purged = True
+            if purged:
+                for key in [key for key, value in self.pidfs_map.iteritems() if not value]:
+                    del self.pidfs_map[key]
 
         if len(old_pidfs) == len(self.pidfs) and len(old_pidfs) == 0:
             changes = False
@@ -898,6 +918,21 @@ class BlinkPresenceContact(BlinkContact):
         self.handle_pidfs(log)
         return True
 
+    def _aggregate_pidfs(self, pidfs):
+        # the copies of a contact in all contacts, online and custom groups get the same pidf objects, aggregate them once
+        snapshot = frozenset(map(id, pidfs))
+        try:
+            cached_snapshot, aggregate = self.presence_aggregation_cache[self.contact.id]
+        except KeyError:
+            pass
+        else:
+            if cached_snapshot == snapshot:
+                return aggregate
+        aggregate = PresenceAggregate(pidfs)
+        # the aggregate keeps references to the pidfs, so their ids cannot be reused while it is cached
+        self.presence_aggregation_cache[self.contact.id] = (snapshot, aggregate)
+        return aggregate
+
     def handle_pidfs(self, log=False):
         # log should be True when updating contacts in all contacts group to avoid duplicates
         if self.application_will_end:
@@ -907,182 +942,38 @@ class BlinkPresenceContact(BlinkContact):
             # as a result of pidfs changes we may go offline and some GUI contacts are destroyed
             return
 
-        basic_status = 'closed'
         self.init_presence_state()
         has_notes = 0
 
-        devices = {}
-        urls = []
-        if self.pidfs:
-            for pidf in self.pidfs:
-                aor = str(urllib.unquote(pidf.entity))
-                if not aor.startswith(('sip:', 'sips:')):
-                    aor = 'sip:'+aor
-                # make a list of latest services
-                most_recent_service_timestamp = None
-                most_recent_service = None
-                most_recent_services = []
-                for service in pidf.services:
-                    if hasattr(service, 'timestamp') and service.timestamp is not None:
-                        if most_recent_service_timestamp is None:
-                            # add service
-                            most_recent_service_timestamp = service.timestamp.value
-                            most_recent_service = service
-                        elif service.timestamp.value >= most_recent_service_timestamp:
-                            if service.user_input is not None and service.user_input.value == 'idle':
-                                # replace older idle with newer
-                                if most_recent_service.user_input is not None and most_recent_service.user_input.value == 'idle':
-                                    most_recent_service_timestamp = service.timestamp.value
-                                    most_recent_service = service
-                            else:
-                                # replace idle with non-idle
-                                if service.status.basic == 'open':
-                                    most_recent_service_timestamp = service.timestamp.value
-                                    most_recent_service = service
-                        elif service.timestamp.value < most_recent_service_timestamp:
-                            # replace newer idle with older non-idle
-                            if service.user_input is not None and service.user_input.value != 'idle' and most_recent_service.user_input is not None and most_recent_service.user_input.value == 'idle':
-                                most_recent_service_timestamp = service.timestamp.value
-                                most_recent_service = service
-                    else:
-                        # services without timestamp will be weighted later
-                        most_recent_services.append(service)
-
-                if most_recent_service is not None:
-                    most_recent_services.append(most_recent_service)
-
-                if basic_status is 'closed':
-                    basic_status = 'open' if any(service for service in pidf.services if service in most_recent_services and service.status.basic == 'open') else 'closed'
-
-                _busy = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'busy')
-                if self.presence_state['status']['busy'] is False:
-                    self.presence_state['status']['busy'] = _busy
-
-                _available = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'available' or (service.status.extended == None and basic_status == 'open'))
-                if self.presence_state['status']['available'] is False:
-                    self.presence_state['status']['available'] = _available
-
-                _away = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'away')
-                if self.presence_state['status']['away'] is False:
-                    self.presence_state['status']['away'] = _away
-
-                _offline = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'offline')
-                if self.presence_state['status']['offline'] is False:
-                    self.presence_state['status']['offline'] = _offline
-
-                if _busy:
-                    device_wining_status = 'busy'
-                elif _available:
-                    device_wining_status = 'available'
-                elif _away:
-                    device_wining_status = 'away'
-                else:
-                    device_wining_status = 'offline'
-
-                _presence_open_notes = sorted([unicode(note) for service in pidf.services if service in most_recent_services and service.status.basic == 'open' for note in service.notes if note])
-                _presence_closed_notes = sorted([unicode(note) for service in pidf.services if service in most_recent_services and service.status.basic == 'closed' for note in service.notes if note])
-
-                _presence_notes =  _presence_closed_notes if device_wining_status == 'offline' else _presence_open_notes
-
-                has_notes += len(_presence_notes)
-
-                for service in pidf.services:
-                    if service.homepage is not None and service.homepage.value:
-                        urls.append(service.homepage.value)
-                    uri_text = sip_prefix_pattern.sub('', aor)
-
-                    caps = set()
-                    if service.capabilities is not None:
-                        if service.capabilities.audio:
-                            caps.add("audio")
-                        if service.capabilities.message:
-                            caps.add("chat")
-                        if service.capabilities.file_transfer:
-                            caps.add("file-transfer")
-                        if service.capabilities.screen_sharing_server:
-                            caps.add("screen-sharing-server")
-                        if service.capabilities.screen_sharing_client:
-                            caps.add("screen-sharing-client")
-
-                    contact = urllib.unquote(service.contact.value) if service.contact is not None else aor
-                    if not contact.startswith(('sip:', 'sips:')):
-                        contact = 'sip:'+contact
-
-                    if service in most_recent_services and service.icon is not None:
-                        icon = unicode(service.icon)
-                    else:
-                        icon = None
-
-                    if service.device_info is not None:
-                        if service.device_info.time_offset is not None:
-                            ctime = datetime.datetime.utcnow() + datetime.timedelta(minutes=int(service.device_info.time_offset))
-                            time_offset = int(service.device_info.time_offset)/60.0
-                            if time_offset == int(time_offset):
-                                offset_info = '(UTC+%d%s)' % (time_offset, (service.device_info.time_offset.description is not None and (' (%s)' % service.device_info.time_offset.description) or ''))
-                            else:
-                                offset_info = '(UTC+%.1f%s)' % (time_offset, (service.device_info.time_offset.description is not None and (' (%s)' % service.device_info.time_offset.description) or ''))
-                            offset_info_text = "%s %s" % (ctime.strftime("%H:%M"), offset_info)
-                        else:
-                            offset_info = None
-                            offset_info_text = None
-                        if service.status.extended is not None:
-                            device_wining_status = str(service.status.extended)
-                        device_text = '%s running %s' % (service.device_info.description, service.device_info.user_agent) if service.device_info.user_agent else service.device_info.description
-                        description = service.device_info.description
-                        user_agent = service.device_info.user_agent
-
-                    else:
-                        device_text = '%s' % service.id
-                        description = None
-                        user_agent = None
-                        offset_info = None
-                        offset_info_text = None
+        pidfs = self.pidfs
+        if pidfs:
+            aggregate = self._aggregate_pidfs(pidfs)
+            has_notes = aggregate.has_notes
+            self.presence_state['status'].update(aggregate.status)
+            self.presence_state['devices'] = aggregate.copy_devices()
+            self.presence_state['urls'] = list(aggregate.urls)
 
+            if self.log_presence_transitions:
+                for service_id, device_text, uri_text, device_wining_status, presence_notes in aggregate.transitions:
+                    something_has_changed = False
                     try:
-                        device = devices[service.id]
-                    except KeyError:
-                        devices[service.id] = {
-                            'id'          : service.id,
-                            'description' : description,
-                            'user_agent'  : user_agent,
-                            'contact'     : contact,
-                            'location'    : service.map.value if service.map is not None else None,
-                            'local_time'  : offset_info_text,
-                            'time_offset' : offset_info,
-                            'notes'       : _presence_notes,
-                            'status'      : device_wining_status,
-                            'caps'        : caps,
-                            'icon'        : icon,
-                            'aor'         : [aor],
-                            'timestamp'   : service.timestamp if hasattr(service, 'timestamp') and service.timestamp is not None else None
-                            }
+                        old_device = (device for device in self.old_devices if device['id'] == service_id).next()
+                    except StopIteration:
+                        something_has_changed = True
                     else:
-                        device['aor'].append(aor)
-
-                    if self.log_presence_transitions and service in most_recent_services:
-                        something_has_changed = False
-                        try:
-                            old_device = (device for device in self.old_devices if device['id'] == service.id).next()
-                        except StopIteration:
+                        if old_device['status'] != device_wining_status or old_device['notes'] != presence_notes:
                             something_has_changed = True
+
+                    if something_has_changed and service_id and log:
+                        if self.old_presence_status is None and device_wining_status == 'offline':
                             pass
                         else:
-                            if old_device['status'] != device_wining_status or old_device['notes'] != _presence_notes:
-                                something_has_changed = True
-
-                        if something_has_changed and service.id and log:
-                            if self.old_presence_status is None and device_wining_status == 'offline':
-                                pass
-                            else:
-                                log_line = u"Availability of device %s of %s (%s) is %s" % (device_text, self.name, uri_text, device_wining_status)
-                                BlinkLogger().log_debug(log_line)
-
-            self.presence_state['devices'] = devices
-            self.presence_state['urls'] = urls
+                            log_line = u"Availability of device %s of %s (%s) is %s" % (device_text, self.name, uri_text, device_wining_status)
+                            BlinkLogger().log_debug(log_line)
 
-            if self.log_presence_transitions:
                 self.old_devices = self.presence_state['devices'].values()
 
+        devices = self.presence_state['devices']
         self.setPresenceNote()
         has_notes = has_notes > 1 or self.presence_state['pending_authorizations']
         if has_notes:
@@ -1468,14 +1359,36 @@ class SystemAddressBookBlinkContact(BlinkContact):
     editable = True
     deletable = False
 
-    def __init__(self, ab_contact):
+    def __init__(self, ab_contact, person=None):
+        # person is the (name, organization, addresses) of ab_contact kept in the AddressBookSnapshot, if it is known
         self.id = ab_contact.uniqueId()
+        self.name, self.organization, addresses = person if person is not None else self.__class__.read_person(ab_contact)
+        self.uris = [ContactURI(uri=uri, type=address_type) for uri, address_type in addresses]
+        if self.uris:
+            detail = u'%s (%s)' % (self.uris[0].uri, self.uris[0].type)
+        else:
+            detail = u''
+        self.detail = detail
+        image_data = ab_contact.imageData()
+        if image_data:
+            try:
+                icon = NSImage.alloc().initWithData_(image_data)
+                self.avatar = Avatar(icon)
+            except Exception:
+                self.avatar = DefaultUserAvatar()
+        else:
+            self.avatar = DefaultUserAvatar()
+        self._set_username_and_domain()
 
-        self.name = self.__class__.format_person_name(ab_contact)
-        self.organization = ab_contact.valueForProperty_(AddressBook.kABOrganizationProperty)
+    @classmethod
+    def read_person(cls, ab_contact):
+        # returns the name, organization and normalized (uri, type) addresses of the person
+        name = cls.format_person_name(ab_contact)
+        organization = ab_contact.valueForProperty_(AddressBook.kABOrganizationProperty)
+        organization = unicode(organization) if organization is not None else None
 
-        if not self.name and self.organization:
-            self.name = unicode(self.organization)
+        if not name and organization:
+            name = organization
 
         addresses = []
 
@@ -1496,7 +1409,8 @@ class SystemAddressBookBlinkContact(BlinkContact):
                 label = value.labelAtIndex_(n)
                 uri = unicode(value.valueAtIndex_(n))
                 if labelNames.get(label, None) != 'fax':
-                    addresses.append((labelNames.get(label, label), sip_prefix_pattern.sub("", uri)))
+                    address_type = labelNames.get(label, label)
+                    addresses.append((unicode(address_type) if address_type is not None else None, sip_prefix_pattern.sub("", uri)))
 
         # get SIP addresses from the Email section
         value = ab_contact.valueForProperty_(AddressBook.kABEmailProperty)
@@ -1518,39 +1432,7 @@ class SystemAddressBookBlinkContact(BlinkContact):
                 elif uri.startswith(("http:", "https:")):
                     addresses.append(('url', uri))
 
-        uris = []
-        for address_type, address in addresses:
-            if not address:
-                continue
-
-            # strip everything that's not numbers from the URIs if they are not SIP URIs
-            if address.startswith(("http:", "https:")):
-                contact_uri = address
-            elif "@" not in address:
-                if address.startswith("sip:"):
-                    address = address[4:]
-                contact_uri = "+" if address[0] == "+" else ""
-                contact_uri += "".join(c for c in address if c in "0123456789#*")
-            else:
-                contact_uri = address
-            uris.append(ContactURI(uri=contact_uri, type=address_type))
-
-        self.uris = uris
-        if self.uris:
-            detail = u'%s (%s)' % (self.uris[0].uri, self.uris[0].type)
-        else:
-            detail = u''
-        self.detail = detail
-        image_data = ab_contact.imageData()
-        if image_data:
-            try:
-                icon = NSImage.alloc().initWithData_(image_data)
-                self.avatar = Avatar(icon)
-            except Exception:
-                self.avatar = DefaultUserAvatar()
-        else:
-            self.avatar = DefaultUserAvatar()
-        self._set_username_and_domain()
+        return name, organization, [(normalize_address(address), address_type) for address_type, address in addresses if address]
 
     @classmethod
     def format_person_name(cls, person):
@@ -1569,6 +1451,274 @@ class SystemAddressBookBlinkContact(BlinkContact):
         return name
 
 
+class BlinkContactList(list):
+    """
+        Contacts of a group. Counts the changes that move or drop contacts, so the indexes of the group can tell
+        when they must be rebuilt. Appended contacts are not counted, the indexes add them to what they already hold.
+        """
+    changes = 0
+
+    def __setitem__(self, index, value):
+        self.changes += 1
+        list.__setitem__(self, index, value)
+
+    def __delitem__(self, index):
+        self.changes += 1
+        list.__delitem__(self, index)
+
+    def __setslice__(self, i, j, sequence):
+        self.changes += 1
+        list.__setslice__(self, i, j, sequence)
+
+    def __delslice__(self, i, j):
+        self.changes += 1
+        list.__delslice__(self, i, j)
+
+    def __imul__(self, value):
+        self.changes += 1
+        return list.__imul__(self, value)
+
+    def insert(self, index, value):
+        self.changes += 1
+        list.insert(self, index, value)
+
+    def pop(self, *args):
+        self.changes += 1
+        return list.pop(self, *args)
+
+    def remove(self, value):
+        self.changes += 1
+        list.remove(self, value)
+
+    def reverse(self):
+        self.changes += 1
+        list.reverse(self)
+
+    def sort(self, *args, **kwargs):
+        self.changes += 1
+        list.sort(self, *args, **kwargs)
+
+
+class BlinkContactURIIndex(object):
+    """Lookup index narrowing down the contacts of a group that can match a URI"""
+
+    def __init__(self):
+        self.contacts = None
+        self.changes = None
+        self.entries = []
+        self.exact = {}
+        self.usernames = []
+        self.numbers = []
+        self.organizations = []
+        self.unindexed = []
+
+    def invalidate(self):
+        self.contacts = None
+
+    def contacts_matching_uri(self, contacts, uri, exact_match=False):
+        self._refresh(contacts)
+        username, domain = split_uri(uri)
+        positions = set(self.unindexed)
+
+        if domain:
+            positions.update(self.exact.get((username, domain), ()))
+        else:
+            key = self._key(username)
+            if key is None:
+                positions.update(xrange(len(self.entries)))
+            else:
+                positions.update(self._prefixed(self.usernames, key))
+
+        # phone numbers match when the contact number ends with the candidate stripped of leading + and 0s
+        number = username.lstrip("+").lstrip("0")
+        if len(number) > 7 and all(d in "1234567890" for d in number):
+            positions.update(self._prefixed(self.numbers, str(number[::-1])))
+
+        if self.organizations:
+            try:
+                text = unicode(uri).lower()
+            except UnicodeError:
+                positions.update(position for position, organization in self.organizations)
+            else:
+                positions.update(position for position, organization in self.organizations if text in organization)
+
+        entries = self.entries
+        return (entries[position] for position in sorted(positions) if entries[position].matchesURI(uri, exact_match))
+
+    def _refresh(self, contacts):
+        changes = getattr(contacts, 'changes', None)
+        if contacts is not self.contacts or changes is None or changes != self.changes:
+            self.contacts = contacts
+            self.changes = changes
+            self.entries = []
+            self.exact = {}
+            self.usernames = []
+            self.numbers = []
+            self.organizations = []
+            self.unindexed = []
+        elif len(contacts) == len(self.entries):
+            return
+        # only the contacts appended since the last lookup are indexed
+        for position in xrange(len(self.entries), len(contacts)):
+            blink_contact = contacts[position]
+            self.entries.append(blink_contact)
+            if isinstance(blink_contact, BonjourBlinkContact):
+                # has its own matchesURI implementation
+                self.unindexed.append(position)
+                continue
+            try:
+                self._add(position, blink_contact)
+            except Exception:
+                self.unindexed.append(position)
+        self.usernames.sort()
+        self.numbers.sort()
+
+    def _add(self, position, blink_contact):
+        candidates = [(blink_contact.username, blink_contact.domain)]
+        candidates.extend(split_uri(item.uri) for item in blink_contact.uris if item.uri)
+        for username, domain in candidates:
+            self.exact.setdefault((username, domain), []).append(position)
+            key = self._key(username)
+            if key is None:
+                self.unindexed.append(position)
+            else:
+                self.usernames.append((key, position))
+            number = strip_addressbook_special_characters(username).lstrip("+")
+            if number and all(d in "1234567890" for d in number):
+                self.numbers.append((str(number[::-1]), position))
+        organization = getattr(blink_contact, 'organization', None)
+        if organization is not None:
+            self.organizations.append((position, organization.lower()))
+
+    @staticmethod
+    def _key(value):
+        if isinstance(value, unicode):
+            return value
+        try:
+            return value.decode('ascii')
+        except (AttributeError, UnicodeError):
+            return None
+
+    @staticmethod
+    def _prefixed(keys, prefix):
+        index = bisect.bisect_left(keys, (prefix,))
+        while index < len(keys) and keys[index][0].startswith(prefix):
+            yield keys[index][1]
+            index += 1
+
+
+class BlinkContactSearchIndex(object):
+    """Trigram index over the lowercase names and URIs of the contacts of a group, finds the contacts containing a text"""
+
+    def __init__(self):
+        self.contacts = None
+        self.changes = None
+        self.entries = []
+        self.positions = {}
+        self.texts = []
+        self.trigrams = {}
+        self.last_text = None
+        self.last_result = []
+
+    def invalidate(self):
+        self.contacts = None
+
+    def contacts_containing(self, contacts, text):
+        # positions of the contacts for which 'text in contact' is true, in list order
+        self._refresh(contacts)
+        text = text.lower()
+        if self.last_text is not None and self.last_text in text:
+            # typing more characters can only narrow down the previous result
+            positions = self.last_result
+        else:
+            positions = self._candidates(text)
+        texts = self.texts
+        result = [position for position in positions if any(text in item for item in texts[position])]
+        self.last_text = text
+        self.last_result = result
+        return result
+
+    def rank(self, position, text):
+        # 0 for exact matches, 1 for matches at the start of the name, a word of the name or an URI, 2 otherwise
+        text = text.lower()
+        texts = self.texts[position]
+        if text in texts:
+            return 0
+        if any(item.startswith(text) or u' ' + text in item for item in texts):
+            return 1
+        return 2
+
+    def _candidates(self, text):
+        trigrams = set(text[i:i+3] for i in xrange(len(text) - 2))
+        if not trigrams:
+            return xrange(len(self.entries))
+        sets = sorted((self.trigrams.get(trigram, ()) for trigram in trigrams), key=len)
+        positions = set(sets[0])
+        for item in sets[1:]:
+            if not positions:
+                break
+            positions.intersection_update(item)
+        return sorted(positions)
+
+    def _refresh(self, contacts):
+        changes = getattr(contacts, 'changes', None)
+        if contacts is not self.contacts or changes is None or changes != self.changes:
+            self.contacts = contacts
+            self.changes = changes
+            self.entries = []
+            self.positions = {}
+            self.texts = []
+            self.trigrams = {}
+        elif len(contacts) == len(self.entries):
+            return
+        # appended contacts may match the last text too
+        self.last_text = None
+        self.last_result = []
+        for position in xrange(len(self.entries), len(contacts)):
+            blink_contact = contacts[position]
+            self.entries.append(blink_contact)
+            self.positions[id(blink_contact)] = position
+            # the same strings BlinkContact.__contains__ looks into
+            texts = tuple(chain((uri.uri.lower() for uri in blink_contact.uris), (blink_contact.name.lower(),)))
+            self.texts.append(texts)
+            for item in texts:
+                for i in xrange(len(item) - 2):
+                    self.trigrams.setdefault(item[i:i+3], set()).add(position)
+
+
+class BlinkPresenceURIIndex(object):
+    """Maps the user@domain of the URIs of subscribed presence contacts to the (contact, group) pairs they appear in"""
+
+    def __init__(self):
+        self.indexed = None
+        self.entries = {}
+
+    def invalidate(self):
+        self.indexed = None
+
+    def contacts_matching_uri(self, uri):
+        return self.entries.get(split_uri(uri), [])
+
+    def refresh(self, groups):
+        # (group, contacts, changes, indexed length) for each group, also keeps the indexed contacts referenced
+        indexed = self.indexed
+        if indexed is None or len(indexed) != len(groups) or any(group is not item[0] or group.contacts is not item[1] or group.contacts.changes != item[2] for group, item in zip(groups, indexed)):
+            indexed = [(group, group.contacts, group.contacts.changes, 0) for group in groups]
+            self.entries = {}
+        elif all(len(item[1]) == item[3] for item in indexed):
+            return
+        # only the contacts appended since the last refresh are added
+        for group, contacts, changes, length in indexed:
+            for blink_contact in contacts[length:]:
+                if not isinstance(blink_contact, BlinkPresenceContact) or not blink_contact.contact.presence.subscribe:
+                    continue
+                keys = set([(blink_contact.username, blink_contact.domain)])
+                keys.update(split_uri(item.uri) for item in blink_contact.uris if item.uri)
+                for key in keys:
+                    self.entries.setdefault(key, []).append((blink_contact, group))
+        self.indexed = [(group, contacts, changes, len(contacts)) for group, contacts, changes, length in indexed]
+
+
 class BlinkGroupAttribute(object):
     def __init__(self, name):
         self.name = name
@@ -1586,6 +1736,15 @@ class BlinkGroupAttribute(object):
             setattr(obj.group, self.name, value)
 
 
+class BlinkGroupContacts(object):
+    def __get__(self, obj, objtype):
+        if obj is None:
+            return self
+        return obj.__dict__.get('contacts', None)
+    def __set__(self, obj, value):
+        obj.__dict__['contacts'] = value if isinstance(value, BlinkContactList) else BlinkContactList(value)
+
+
 class BlinkGroup(NSObject):
     """Basic Group representation in Blink UI"""
     deletable = True
@@ -1595,12 +1754,15 @@ class BlinkGroup(NSObject):
     delete_contact_allowed = True
 
     name = BlinkGroupAttribute('name')
+    contacts = BlinkGroupContacts()
 
     def __new__(cls, *args, **kwargs):
         return cls.alloc().init()
 
     def __init__(self, name, group):
         self.contacts = []
+        self.uri_index = BlinkContactURIIndex()
+        self.search_index = BlinkContactSearchIndex()
         self.group = group
         self.name = name
 
@@ -1610,6 +1772,16 @@ class BlinkGroup(NSObject):
     def sortContacts(self):
         self.contacts.sort(key=lambda item: unicode(getattr(item, 'name')).lower())
 
+    def contactsMatchingURI(self, uri, exact_match=False):
+        return self.uri_index.contacts_matching_uri(self.contacts, uri, exact_match)
+
+    def contactsMatchingText(self, text):
+        # (rank, contact) for the contacts containing the text or matching it as an URI, in list order
+        index = self.search_index
+        positions = set(index.contacts_containing(self.contacts, text))
+        positions.update(index.positions[id(blink_contact)] for blink_contact in self.contactsMatchingURI(text))
+        return [(index.rank(position, text), index.entries[position]) for position in sorted(positions)]
+
 
 class VirtualBlinkGroup(BlinkGroup):
     """ Base class for Virtual Groups managed by Blink """
@@ -1617,6 +1789,8 @@ class VirtualBlinkGroup(BlinkGroup):
 
     def __init__(self, name=u'', expanded=False):
         self.contacts = []
+        self.uri_index = BlinkContactURIIndex()
+        self.search_index = BlinkContactSearchIndex()
         self.group = None
         self.name = name
         self.init_expanded = expanded
@@ -1914,17 +2088,22 @@ class AddressBookBlinkGroup(VirtualBlinkGroup):
 
     def __init__(self, name=NSLocalizedString("Address Book", "Group name label")):
         super(AddressBookBlinkGroup, self).__init__(name, expanded=False)
+        # record unique id -> blink contact, or None if the person has no usable addresses. Only used in the addressbook thread
+        self.records = {}
+        self.snapshot = AddressBookSnapshot(ApplicationData.get('addressbook_snapshot.pickle'))
 
     @run_in_thread('addressbook')
     @allocate_autorelease_pool
     def loadAddressBook(self, changedRecords=None):
-        nc = NotificationCenter()
         updatedRecords = []
         deletedRecords = []
         insertedRecords = []
         book = AddressBook.ABAddressBook.sharedAddressBook()
         logger = BlinkLogger()
 
+        if not self.snapshot.loaded:
+            self.snapshot.load()
+
         if changedRecords:
             try:
                 updatedRecords = changedRecords['ABUpdatedRecords']
@@ -1942,71 +2121,138 @@ class AddressBookBlinkGroup(VirtualBlinkGroup):
                 pass
 
             # deleted
-            if deletedRecords:
-                for blink_contact in self.contacts:
-                    for record in deletedRecords:
-                        if blink_contact.id == record:
-                            logger.log_debug('Deleted System Address Book contact %s' % blink_contact.name)
-                            self.contacts.remove(blink_contact)
-                            blink_contact.destroy()
-            # inserted
-            for record in insertedRecords:
+            removed = self._remove_records(deletedRecords)
+            for blink_contact in removed.itervalues():
+                logger.log_debug('Deleted System Address Book contact %s' % blink_contact.name)
+
+            # inserted and updated
+            persons = []
+            for record in chain(insertedRecords, updatedRecords):
                 ab_contact = book.recordForUniqueId_(record)
-                if type(ab_contact) != AddressBook.ABPerson:
-                    continue
+                if type(ab_contact) == AddressBook.ABPerson:
+                    persons.append((record, ab_contact))
+            old_blink_contacts = self._remove_records(record for record, ab_contact in persons)
+
+            added = []
+            for record, ab_contact in persons:
+                old_blink_contact = old_blink_contacts.get(record)
+                blink_contact = self._add_person(ab_contact)
+                if blink_contact is not None:
+                    added.append(blink_contact)
+                    logger.log_debug('%s System Address Book contact %s' % ('Reloaded' if old_blink_contact is not None else 'Loaded', blink_contact.name))
+                elif old_blink_contact is not None:
+                    logger.log_debug('Deleted System Address Book contact %s' % old_blink_contact.name)
+            removed.update(old_blink_contacts)
 
-                blink_contact = SystemAddressBookBlinkContact(ab_contact)
-                if blink_contact.uris:
-                    logger.log_debug('Loaded System Address Book contact %s' % blink_contact.name)
-                    self.contacts.append(blink_contact)
-                else:
-                    blink_contact.destroy()
+        else:
+            BlinkLogger().log_debug('Loading Contacts from System Address Book')
+            if book is None:
+                removed = self._remove_records(self.records.keys())
+                self._update_contacts(removed.values(), [])
+                return
 
-            # updated
-            if updatedRecords:
-                for blink_contact in self.contacts:
-                    for record in updatedRecords:
-                        if blink_contact.id != record:
-                            continue
+            # persons already loaded and not modified since are kept, the ones loaded by an earlier run of Blink
+            # and not modified since are built from the snapshot and only the others are read from the address book
+            seen = set()
+            restored = []
+            modified = []
+            for ab_contact in book.people():
+                record = ab_contact.uniqueId()
+                seen.add(record)
+                person = self.snapshot.get(record, self._modification_time(ab_contact))
+                if person is None:
+                    modified.append((record, ab_contact))
+                elif record not in self.records:
+                    restored.append((ab_contact, person))
+
+            removed = self._remove_records(chain((record for record, ab_contact in modified), set(self.records).union(self.snapshot.records).difference(seen)))
+
+            added = []
+            for ab_contact, person in restored:
+                blink_contact = self._add_person(ab_contact, person)
+                if blink_contact is not None:
+                    added.append(blink_contact)
+
+            loaded = 0
+            for record, ab_contact in modified:
+                if loaded % 10 == 0:
+                    time.sleep(0.01)
+                loaded += 1
+                blink_contact = self._add_person(ab_contact)
+                if blink_contact is not None:
+                    added.append(blink_contact)
+            BlinkLogger().log_debug('System Address Book Contacts loaded (%d from snapshot, %d updated)' % (len(restored), loaded))
+
+        self.snapshot.save()
+        self._update_contacts(removed.values(), added)
+
+    def _modification_time(self, ab_contact):
+        date = ab_contact.valueForProperty_(AddressBook.kABModificationDateProperty)
+        return date.timeIntervalSinceReferenceDate() if date is not None else None
+
+    def _add_person(self, ab_contact, person=None):
+        if person is None:
+            person = SystemAddressBookBlinkContact.read_person(ab_contact)
+        blink_contact = SystemAddressBookBlinkContact(ab_contact, person)
+        if not blink_contact.uris:
+            blink_contact.destroy()
+            blink_contact = None
+        record = ab_contact.uniqueId()
+        self.records[record] = blink_contact
+        self.snapshot.update(record, self._modification_time(ab_contact), person)
+        return blink_contact
+
+    def _remove_records(self, records):
+        # forgets the records, returns their contacts by record. The contacts are dropped from the group by _update_contacts
+        removed = {}
+        records = list(records)
+        for record in records:
+            blink_contact = self.records.pop(record, None)
+            if blink_contact is not None:
+                removed[record] = blink_contact
+        self.snapshot.remove(records)
+        return removed
 
-                        ab_contact = book.recordForUniqueId_(record)
+    @run_in_gui_thread
+    def _update_contacts(self, removed, added):
+        # the group contacts are read in the GUI thread, so they are only changed there, in a single pass
+        if removed:
+            removed_contacts = set(id(blink_contact) for blink_contact in removed)
+            self.contacts = [blink_contact for blink_contact in self.contacts if id(blink_contact) not in removed_contacts]
+            for blink_contact in removed:
+                blink_contact.destroy()
+        self.contacts.extend(added)
+        self.sortContacts()
+        NotificationCenter().post_notification("BlinkContactsHaveChanged", sender=self)
 
-                        if type(ab_contact) != AddressBook.ABPerson:
-                            continue
 
-                        self.contacts.remove(blink_contact)
-                        blink_contact.destroy()
+class ContactListChangeScheduler(NSObject):
+    """Collects the contacts changed within a short interval and announces them with a single BlinkContactListDidChange"""
+    implements(IObserver)
 
-                        blink_contact = SystemAddressBookBlinkContact(ab_contact)
-                        if blink_contact.uris:
-                            logger.log_debug('Reloaded System Address Book contact %s' % blink_contact.name)
-                            self.contacts.append(blink_contact)
-                        else:
-                            logger.log_debug('Deleted System Address Book contact %s' % blink_contact.name)
-                            blink_contact.destroy()
+    interval = 0.05
 
-        else:
-            BlinkLogger().log_debug('Loading Contacts from System Address Book')
-            for blink_contact in self.contacts:
-                self.contacts.remove(blink_contact)
-                blink_contact.destroy()
+    def __new__(cls, *args, **kwargs):
+        return cls.alloc().init()
 
-            if book is None:
-                nc.post_notification("BlinkContactsHaveChanged", sender=self)
-                return
+    def __init__(self):
+        self.contacts = set()
+        self.timer = None
+        NotificationCenter().add_observer(self, name="BlinkContactsHaveChanged")
 
-            for i, ab_contact in enumerate(book.people()):
-                if i % 10  == 0:
-                    time.sleep(0.01)
-                blink_contact = SystemAddressBookBlinkContact(ab_contact)
-                if blink_contact.uris:
-                    self.contacts.append(blink_contact)
-                else:
-                    blink_contact.destroy()
-            BlinkLogger().log_debug('System Address Book Contacts loaded')
+    @allocate_autorelease_pool
+    @run_in_gui_thread
+    def handle_notification(self, notification):
+        self.contacts.add(notification.sender)
+        if self.timer is None:
+            self.timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(self.interval, self, "changesTimer:", None, False)
+            NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSRunLoopCommonModes)
+            NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSEventTrackingRunLoopMode)
 
-        self.sortContacts()
-        nc.post_notification("BlinkContactsHaveChanged", sender=self)
+    def changesTimer_(self, timer):
+        self.timer = None
+        contacts, self.contacts = self.contacts, set()
+        NotificationCenter().post_notification("BlinkContactListDidChange", sender=self, data=NotificationData(contacts=contacts))
 
 
 class CustomListModel(NSObject):
@@ -2435,6 +2681,8 @@ class ContactListModel(CustomListModel):
         self.missed_calls_group = MissedCallsBlinkGroup()
         self.outgoing_calls_group = OutgoingCallsBlinkGroup()
         self.incoming_calls_group = IncomingCallsBlinkGroup()
+        self.presence_uri_index = BlinkPresenceURIIndex()
+        self.change_scheduler = ContactListChangeScheduler()
         self.contact_backup_timer = None
 
         return self
@@ -2495,17 +2743,17 @@ class ContactListModel(CustomListModel):
             self.addressbook_group.loadAddressBook(notification.userInfo())
 
     def hasContactMatchingURI(self, uri, exact_match=False):
-        return any(blink_contact.matchesURI(uri, exact_match) for group in self.groupsList if not group.ignore_search for blink_contact in group.contacts)
+        return any(True for group in self.groupsList if not group.ignore_search for blink_contact in group.contactsMatchingURI(uri, exact_match))
 
     def getFirstContactMatchingURI(self, uri, exact_match=False):
         try:
-            return (blink_contact for group in self.groupsList if not group.ignore_search for blink_contact in group.contacts if blink_contact.matchesURI(uri, exact_match)).next()
+            return (blink_contact for group in self.groupsList if not group.ignore_search for blink_contact in group.contactsMatchingURI(uri, exact_match)).next()
         except StopIteration:
             return None
 
     def getFirstContactFromAllContactsGroupMatchingURI(self, uri, exact_match=False):
         try:
-            return (blink_contact for blink_contact in self.all_contacts_group.contacts if blink_contact.matchesURI(uri, exact_match)).next()
+            return self.all_contacts_group.contactsMatchingURI(uri, exact_match).next()
         except StopIteration:
             return None
 
@@ -2515,6 +2763,20 @@ class ContactListModel(CustomListModel):
         except StopIteration:
             return None
 
+    def getPresenceContactsMatchingURIs(self, uris):
+        # exact matches for a batch of presence resources, returns a mapping of (blink_contact, group) to the uris that matched it
+        self.presence_uri_index.refresh([group for group in self.groupsList if group != self.online_contacts_group])
+        matches = {}
+        for uri in uris:
+            if split_uri(uri)[1]:
+                contacts = self.presence_uri_index.contacts_matching_uri(uri)
+            else:
+                # uris without a domain match by prefix
+                contacts = self.getPresenceContactsMatchingURI(uri, exact_match=True)
+            for item in contacts:
+                matches.setdefault(item, []).append(uri)
+        return matches
+
     def presencePolicyExistsForURI_(self, uri):
         uri = sip_prefix_pattern.sub('', uri)
         for policy in AddressbookManager().get_policies():
@@ -3380,16 +3642,24 @@ class ContactListModel(CustomListModel):
 
     def _NH_AddressbookContactDidChange(self, notification):
         contact = notification.sender
+        self.presence_uri_index.invalidate()
 
         uri_attributes = set(['default_uri', 'uris'])
         icon_attributes = set(['icon_info.url', 'icon_info.etag', 'icon_info.local'])
 
+        if 'name' in notification.data.modified or uri_attributes.intersection(notification.data.modified):
+            # the search indexes only notice contacts being added or removed, not their names or URIs changing
+            for blink_group in (blink_group for blink_group in self.groupsList if any(item.contact == contact for item in blink_group.contacts if isinstance(item, BlinkPresenceContact))):
+                blink_group.search_index.invalidate()
+
         if set(uri_attributes | icon_attributes).intersection(notification.data.modified):
             groups = [blink_group for blink_group in self.groupsList if any(isinstance(item, BlinkPresenceContact) and item.contact == contact for item in blink_group.contacts)]
             for blink_contact in (blink_contact for blink_contact in chain(*(g.contacts for g in groups)) if blink_contact.contact == contact):
                 if uri_attributes.intersection(notification.data.modified):
                     blink_contact.detail = blink_contact.uri
                     blink_contact._set_username_and_domain()
+                    for g in groups:
+                        g.uri_index.invalidate()
 
                     for uri in blink_contact.pidfs_map.copy().keys():
                         if blink_contact is None:
@@ -3617,7 +3887,7 @@ class ContactListModel(CustomListModel):
         return (blink_contact for blink_contact in self.all_contacts_group.contacts if blink_contact.name == name)
 
     def getBlinkContactsForURI(self, uri, exact_match=False):
-        return (blink_contact for blink_contact in self.all_contacts_group.contacts if blink_contact.matchesURI(uri, exact_match))
+        return self.all_contacts_group.contactsMatchingURI(uri, exact_match)
 
     def getBlinkGroupsForBlinkContact(self, blink_contact):
         allowed_groups = [group for group in self.groupsList if group.add_contact_allowed]
@@ -83,11 +83,15 @@ import random
 import shutil
 import string
 import ldap
+import time
 import uuid
 
 from collections import deque
 from dateutil.tz import tzlocal
 from itertools import chain
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
+from threading import Lock
 
 from application.notification import NotificationCenter, IObserver, NotificationData
 from application.python import Null
@@ -143,7 +147,8 @@ from util import (allocate_autorelease_pool,
                   sip_prefix_pattern,
                   sipuri_components_from_string,
                   translate_alpha2digit,
-                  AccountInfo)
+                  AccountInfo,
+                  LRUCache)
 
 
 PARTICIPANTS_MENU_ADD_CONFERENCE_CONTACT = 314
@@ -328,6 +333,8 @@ class ContactWindowController(NSWindowController):
     new_audio_sample_rate = None
     last_status_per_device =  {}
     created_accounts = set()
+    # CPIM identity -> icon path, None for our own accounts. Cleared when contacts, accounts or icons change
+    cpim_identity_cache = LRUCache(1000)
 
     def awakeFromNib(self):
         BlinkLogger().log_debug('Starting Contact Manager')
@@ -369,7 +376,7 @@ class ContactWindowController(NSWindowController):
         nc.add_observer(self, name="ActiveAudioSessionChanged")
         nc.add_observer(self, name="BlinkChatWindowClosed")
         nc.add_observer(self, name="BlinkConferenceGotUpdate")
-        nc.add_observer(self, name="BlinkContactsHaveChanged")
+        nc.add_observer(self, name="BlinkContactListDidChange")
         nc.add_observer(self, name="BlinkMuteChangedState")
         nc.add_observer(self, name="BlinkShouldTerminate")
         nc.add_observer(self, name="BlinkSessionChangedState")
@@ -384,7 +391,7 @@ class ContactWindowController(NSWindowController):
         nc.add_observer(self, name="CFGSettingsObjectWasCreated")
         nc.add_observer(self, name="ChatReplicationJournalEntryReceived")
         nc.add_observer(self, name="DefaultAudioDeviceDidChange")
-        nc.add_observer(self, name="LDAPDirectorySearchFoundContact")
+        nc.add_observer(self, name="LDAPDirectorySearchFoundContacts")
         nc.add_observer(self, name="MediaStreamDidInitialize")
         nc.add_observer(self, name="SIPApplicationWillStart")
         nc.add_observer(self, name="SIPApplicationWillEnd")
@@ -400,6 +407,7 @@ class ContactWindowController(NSWindowController):
         nc.add_observer(self, name="AddressbookGroupWasActivated")
         nc.add_observer(self, name="AddressbookGroupWasDeleted")
         nc.add_observer(self, name="AddressbookGroupDidChange")
+        nc.add_observer(self, name="AddressbookContactDidChange")
         nc.add_observer(self, name="BonjourGroupWasActivated")
         nc.add_observer(self, name="BonjourGroupWasDeactivated")
         nc.add_observer(self, name="VirtualGroupWasActivated")
@@ -1008,21 +1016,14 @@ class ContactWindowController(NSWindowController):
         resource_map = notification.data.resource_map
         BlinkLogger().log_debug('Account %s got availability %s for %d SIP URIs: %s' % (notification.sender.id, 'full state' if notification.data.full_state else 'update', len(resource_map.keys()), resource_map.keys()))
 
-        blink_contacts_set = set()
-        for key, value in resource_map.iteritems():
-            m = self.model.getPresenceContactsMatchingURI(key, exact_match=True)
-            if m is None:
-                continue
-
-            for b in m:
-                blink_contacts_set.add(b)
+        matches = self.model.getPresenceContactsMatchingURIs(resource_map.iterkeys())
 
         changed_blink_contacts = []
-        for blink_contact, group in blink_contacts_set:
+        for (blink_contact, group), uris in matches.iteritems():
             if blink_contact.contact is None:
                 continue
-            contact_uris = list(uri.uri for uri in iter(blink_contact.contact.uris))
-            resources = dict((key, value) for key, value in resource_map.iteritems() if key in contact_uris)
+            contact_uris = set(uri.uri for uri in blink_contact.contact.uris)
+            resources = dict((uri, resource_map[uri]) for uri in uris if uri in contact_uris)
             if resources:
                 changed = blink_contact.handle_presence_resources(resources, notification.sender.id, notification.data.full_state, log=isinstance(group, AllContactsBlinkGroup))
 
@@ -1030,15 +1031,25 @@ class ContactWindowController(NSWindowController):
                     BlinkLogger().log_debug('Availability for %s in group %s has changed' % (blink_contact.name, group.name))
                     changed_blink_contacts.append((blink_contact,group))
 
+        # reload each changed item once, the online group is reloaded with its children after all contacts were handled
+        reload_items = set()
+        online_group_changed = False
         for blink_contact, group in changed_blink_contacts:
-            self.contactOutline.reloadItem_reloadChildren_(blink_contact, False)
+            reload_items.add(blink_contact)
             if isinstance(group, AllContactsBlinkGroup):
-                online_group_changed = blink_contact.addToOrRemoveFromOnlineGroup()
-                if online_group_changed:
-                    self.contactOutline.reloadItem_reloadChildren_(online_group_changed, True)
+                item = blink_contact.addToOrRemoveFromOnlineGroup()
+                if item is self.model.online_contacts_group:
+                    online_group_changed = True
+                elif item is not None:
+                    reload_items.add(item)
+
+        if online_group_changed:
+            self.contactOutline.reloadItem_reloadChildren_(self.model.online_contacts_group, True)
+        for item in reload_items:
+            self.contactOutline.reloadItem_reloadChildren_(item, False)
 
         if changed_blink_contacts:
-            BlinkLogger().log_debug("Availability for %d out of %d contacts have been updated" % (len(changed_blink_contacts), len(blink_contacts_set)))
+            BlinkLogger().log_debug("Availability for %d out of %d contacts have been updated" % (len(changed_blink_contacts), len(matches)))
 
 
     def _NH_AddressbookGroupWasActivated(self, notification):
@@ -1050,6 +1061,11 @@ class ContactWindowController(NSWindowController):
     def _NH_AddressbookGroupDidChange(self, notification):
         self.updateGroupMenu()
 
+    def _NH_AddressbookContactDidChange(self, notification):
+        # a contact that got its first icon or lost it has another icon path now
+        if set(['icon_info.url', 'icon_info.etag', 'icon_info.local']).intersection(notification.data.modified):
+            self.cpim_identity_cache.clear()
+
     _NH_VirtualGroupWasActivated = _NH_AddressbookGroupWasActivated
     _NH_VirtualGroupWasDeleted = _NH_AddressbookGroupWasDeleted
     _NH_VirtualGroupDidChange = _NH_AddressbookGroupDidChange
@@ -1058,6 +1074,7 @@ class ContactWindowController(NSWindowController):
         account = notification.data.account
         self.accounts.insert(account.order, AccountInfo(account))
         self.refreshAccountList()
+        self.cpim_identity_cache.clear()
 
     def newAccountHasBeenAddedNotice_(self, timer):
         NSApp.stopModalWithCode_(NSAlertAlternateReturn)
@@ -1066,6 +1083,7 @@ class ContactWindowController(NSWindowController):
         position = self.accounts.index(notification.data.account)
         del self.accounts[position]
         self.refreshAccountList()
+        self.cpim_identity_cache.clear()
 
     def _NH_SIPAccountDidActivate(self, notification):
         account = notification.sender
@@ -1221,7 +1239,7 @@ class ContactWindowController(NSWindowController):
         self.removePresenceContactForOurselves()
 
     def _NH_BlinkShouldTerminate(self, notification):
-        NotificationCenter().remove_observer(self, name="BlinkContactsHaveChanged")
+        NotificationCenter().remove_observer(self, name="BlinkContactListDidChange")
         self.model.groupsList = []
         self.refreshContactsList()
         self.window().orderOut_(self)
@@ -1237,8 +1255,14 @@ class ContactWindowController(NSWindowController):
     def _NH_BlinkChatWindowClosed(self, notification):
         self.showAudioDrawer()
 
-    def _NH_BlinkContactsHaveChanged(self, notification):
-        self.refreshContactsList(notification.sender)
+    def _NH_BlinkContactListDidChange(self, notification):
+        changed_items = notification.data.contacts
+        self.cpim_identity_cache.clear()
+        if self.model in changed_items:
+            self.refreshContactsList()
+        else:
+            for item in changed_items:
+                self.refreshContactsList(item)
         self.searchContacts()
 
     def _NH_BlinkSessionChangedState(self, notification):
@@ -1302,6 +1326,9 @@ class ContactWindowController(NSWindowController):
             else:
                 self.window().setTitle_(NSApp.delegate().applicationNamePrint)
 
+        if notification.data.modified.has_key("presence_state.icon"):
+            self.cpim_identity_cache.clear()
+
         if notification.data.modified.has_key("ldap.enabled"):
             self.refreshLdapDirectory()
 
@@ -1343,13 +1370,14 @@ class ContactWindowController(NSWindowController):
             self.setSelectedInputAudioDeviceForLevelMeter()
             self.updateAudioDeviceLabel()
 
-    def _NH_LDAPDirectorySearchFoundContact(self, notification):
-        if notification.sender == self.ldap_search:
-            for type, uri in notification.data.uris:
-                if uri:
-                    exists = uri in (contact.uri for contact in self.searchResultsModel.groupsList)
-                    if not exists:
-                        contact = LdapSearchResultContact(str(uri), uri_type=format_uri_type(type), name=notification.data.name, icon=NSImage.imageNamed_("ldap"))
+    def _NH_LDAPDirectorySearchFoundContacts(self, notification):
+        if notification.sender == self.ldap_search and notification.data.keyword == self.ldap_search.keyword:
+            existing_uris = set(contact.uri for contact in chain(self.local_found_contacts, self.ldap_found_contacts))
+            for name, uris in notification.data.contacts:
+                for type, uri in uris:
+                    if uri and uri not in existing_uris:
+                        existing_uris.add(uri)
+                        contact = LdapSearchResultContact(str(uri), uri_type=format_uri_type(type), name=name, icon=NSImage.imageNamed_("ldap"))
                         contact.detail = '%s (%s)' % (str(uri), format_uri_type(type))
                         self.ldap_found_contacts.append(contact)
 
@@ -1614,6 +1642,23 @@ class ContactWindowController(NSWindowController):
                 return path
         return DefaultUserAvatar().path if not is_focus else DefaultMultiUserAvatar().path
 
+    def iconPathForCPIMIdentity(self, identity):
+        # replaying chat history resolves the same few senders over and over again
+        try:
+            path = self.cpim_identity_cache[identity]
+        except KeyError:
+            uri = sipuri_components_from_string(identity)[0]
+            if AccountManager().has_account(uri):
+                # our own icon can change, it is looked up each time
+                path = None
+            else:
+                contact = self.getFirstContactMatchingURI(uri)
+                path = contact.avatar.path if contact else None
+                if path is None or not os.path.isfile(path):
+                    path = DefaultUserAvatar().path
+            self.cpim_identity_cache[identity] = path
+        return path if path is not None else self.iconPathForSelf()
+
     def iconPathForSelf(self):
         settings = SIPSimpleSettings()
         if settings.presence_state.icon and os.path.exists(settings.presence_state.icon.path):
@@ -2092,27 +2137,31 @@ class ContactWindowController(NSWindowController):
         self.updateStartSessionButtons()
 
         if self.mainTabView.selectedTabViewItem().identifier() == "search":
-            self.local_found_contacts = []
-            local_found_contacts = [contact for group in self.model.groupsList if group.ignore_search is False for contact in group.contacts if (text in contact or contact.matchesURI(text))]
-            found_count = {}
-            for local_found_contact in local_found_contacts:
-                if hasattr(local_found_contact, 'contact') and local_found_contact.contact is not None:
-                    if local_found_contact.contact.id in found_count.keys():
-                        continue
-                    else:
-                        self.local_found_contacts.append(local_found_contact)
-                        found_count[local_found_contact.contact.id] = True
-                else:
-                    self.local_found_contacts.append(local_found_contact)
+            local_found_contacts = []
+            found_ids = set()
+            for group in self.model.groupsList:
+                if group.ignore_search is not False:
+                    continue
+                for rank, local_found_contact in group.contactsMatchingText(text):
+                    if hasattr(local_found_contact, 'contact') and local_found_contact.contact is not None:
+                        if local_found_contact.contact.id in found_ids:
+                            continue
+                        found_ids.add(local_found_contact.contact.id)
+                    local_found_contacts.append((rank, local_found_contact))
+            # exact and prefix matches first, the sort is stable so the contacts list order is kept otherwise
+            local_found_contacts.sort(key=lambda item: item[0])
+            self.local_found_contacts = [contact for rank, contact in local_found_contacts]
 
+            self.ldap_found_contacts = []
             active_account = self.activeAccount()
             if active_account:
-                # perform LDAP search
+                # perform LDAP search, results of recent searches are added right away
                 if len(text) > 3 and self.ldap_directory is not None:
-                    self.ldap_found_contacts = []
                     if self.ldap_search.ldap_query_id is not None:
                         self.ldap_search.cancel()
                     self.ldap_search.search(text)
+                elif self.ldap_search is not None:
+                    self.ldap_search.cancel()
 
                 # create a syntetic contact with what we typed
                 try:
@@ -2137,7 +2186,7 @@ class ContactWindowController(NSWindowController):
 
                         self.addContactButtonSearch.setEnabled_(not exists)
 
-                self.searchResultsModel.groupsList = self.local_found_contacts
+                self.searchResultsModel.groupsList = self.local_found_contacts + self.ldap_found_contacts
                 self.searchOutline.reloadData()
 
     @objc.IBAction
@@ -5347,99 +5396,203 @@ class ContactWindowController(NSWindowController):
 
 
 class LdapDirectory(object):
+    # number of bound connections kept open for reuse
+    pool_size = 2
+    # connections idle for longer than this are checked before they are used again
+    keepalive_interval = 60
+
     def __init__(self, ldap_settings):
         self.connected = False
         self.server = '%s://%s:%d' % ('ldap' if ldap_settings.transport == 'tcp' else 'ldaps', ldap_settings.hostname, ldap_settings.port)
         self.username = ldap_settings.username or ''
         self.password = ldap_settings.password or ''
         self.dn = ldap_settings.dn or ''
+        self.size_limit = 100
+        self.lock = Lock()
+        self.idle_connections = []
 
-        self.l = ldap.initialize(self.server)
+    def _create_connection(self):
+        l = ldap.initialize(self.server)
         tls_folder = ApplicationData.get('tls')
         ca_path = os.path.join(tls_folder, 'ca.crt')
-        self.l.set_option(ldap.OPT_X_TLS_CERTFILE, ca_path)
-        self.l.set_option(ldap.OPT_NETWORK_TIMEOUT, 5)
-        self.l.set_option(ldap.OPT_TIMEOUT, 5)
-        self.l.set_option(ldap.OPT_TIMELIMIT, 10)
-        self.l.set_option(ldap.OPT_SIZELIMIT, 100)
-
-    def connect(self):
-        if self.connected is False:
+        l.set_option(ldap.OPT_X_TLS_CERTFILE, ca_path)
+        l.set_option(ldap.OPT_NETWORK_TIMEOUT, 5)
+        l.set_option(ldap.OPT_TIMEOUT, 5)
+        l.set_option(ldap.OPT_TIMELIMIT, 10)
+        l.set_option(ldap.OPT_SIZELIMIT, self.size_limit)
+        l.simple_bind_s(self.username, self.password)
+        return l
+
+    def acquire(self):
+        # return a bound connection, reusing an idle one if it is still alive. Returns None if the server cannot be reached
+        while True:
+            with self.lock:
+                try:
+                    l, last_used = self.idle_connections.pop()
+                except IndexError:
+                    break
+            if time.time() - last_used < self.keepalive_interval:
+                return l
             try:
-                self.l.simple_bind_s(self.username, self.password)
-                BlinkLogger().log_info('Connected to LDAP server %s' % self.server)
-                self.connected = True
-            except ldap.LDAPError, e:
-                BlinkLogger().log_info('Connection to LDAP server %s failed: %s' % (self.server, e))
-                self.connected = False
+                l.whoami_s()
+            except ldap.LDAPError:
+                self._close_connection(l)
+            else:
+                return l
+        try:
+            l = self._create_connection()
+        except ldap.LDAPError, e:
+            BlinkLogger().log_info('Connection to LDAP server %s failed: %s' % (self.server, e))
+            self.connected = False
+            return None
+        if not self.connected:
+            BlinkLogger().log_info('Connected to LDAP server %s' % self.server)
+        self.connected = True
+        return l
+
+    def release(self, l):
+        with self.lock:
+            if self.connected and len(self.idle_connections) < self.pool_size:
+                self.idle_connections.append((l, time.time()))
+                return
+        self._close_connection(l)
+
+    def _close_connection(self, l):
+        try:
+            l.unbind_ext_s()
+        except ldap.LDAPError:
+            pass
 
     def disconnect(self):
-        if self.l is not None and self.connected:
-            try:
-                self.l.unbind_ext_s()
-                BlinkLogger().log_info('Disconnected from LDAP server %s' % self.server)
-            except ldap.LDAPError:
-                pass
+        with self.lock:
+            connections, self.idle_connections = self.idle_connections, []
+        for l, last_used in connections:
+            self._close_connection(l)
+        if self.connected:
+            BlinkLogger().log_info('Disconnected from LDAP server %s' % self.server)
+        self.connected = False
 
 
 class LdapSearch(object):
+    attributes = ['cn', 'telephoneNumber', 'workNumber', 'mobile', 'SIPIdentitySIPURI']
+    page_size = 25
+    # results of recent searches are reused for this many seconds
+    cache_ttl = 300
+
     def __init__(self, ldap_directory):
         self.ldap_directory = ldap_directory
         self.ldap_query_id = None
+        self.keyword = None
+        # lowercase keyword -> (timestamp, [((name, uris), cn values)], complete)
+        self.cache = LRUCache(50)
 
     def cancel(self):
-        if self.ldap_query_id and self.ldap_directory.connected:
-            try:
-                self.ldap_directory.l.cancel(self.ldap_query_id)
-            except ldap.LDAPError:
-                return
+        # the search thread abandons the query when it sees the keyword changed
+        self.keyword = None
 
-    @run_in_thread('ldap-query')
     def search(self, keyword):
         if not self.ldap_directory:
             return
-
-        self.ldap_directory.connect()
-        if self.ldap_directory.connected:
-            filter = "cn=" + "*" + keyword.encode("utf-8") + "*"
+        self.keyword = keyword
+        contacts = self._cached_results(keyword)
+        if contacts is not None:
+            self.ldap_query_id = None
+            if contacts:
+                NotificationCenter().post_notification("LDAPDirectorySearchFoundContacts", sender=self, data=NotificationData(keyword=keyword, contacts=contacts))
+            return
+        self.ldap_query_id = keyword
+        call_in_thread('ldap-query', self._search, keyword)
+
+    def _cached_results(self, keyword):
+        # a complete result set of a prefix holds every match of the longer keyword too, as the filter is cn=*keyword*
+        key = keyword.lower()
+        now = time.time()
+        for length in xrange(len(key), 3, -1):
             try:
-                self.ldap_query_id = self.ldap_directory.l.search(self.ldap_directory.dn, ldap.SCOPE_SUBTREE, filter)
-            except ldap.LDAPError:
-                return
+                timestamp, contacts, complete = self.cache[key[:length]]
+            except KeyError:
+                continue
+            if now - timestamp > self.cache_ttl:
+                continue
+            if length == len(key):
+                return [contact for contact, names in contacts]
+            if complete:
+                # the server matches any of the cn values of an entry, not only the one used as the contact name
+                return [contact for contact, names in contacts if any(key in name.decode('utf-8', 'ignore').lower() for name in names)]
+        return None
 
-            while 1:
-                try:
-                    result_type, result_data = self.ldap_directory.l.result(self.ldap_query_id, all=0)
-                except ldap.LDAPError:
-                    return
+    @allocate_autorelease_pool
+    def _search(self, keyword):
+        l = self.ldap_directory.acquire()
+        if l is None:
+            if self.keyword == keyword:
+                self.ldap_query_id = None
+            return
 
-                if (result_data == []):
-                    break
-                else:
-                    if result_type == ldap.RES_SEARCH_ENTRY:
-                        i = 1
-                        for dn, entry in result_data:
-                            if i % 10 == 0:
-                                time.sleep(0.01)
-                            uris = []
-                            i += 1
-                            if entry.has_key('telephoneNumber'):
-                                for _entry in entry['telephoneNumber']:
-                                    address = ('telephone', str(_entry))
-                                    uris.append(address)
-                            if entry.has_key('workNumber'):
-                                for _entry in entry['workNumber']:
-                                    address = ('work', str(_entry))
-                                    uris.append(address)
-                            if entry.has_key('mobile'):
-                                for _entry in entry['mobile']:
-                                    address = ('mobile', str(_entry))
-                                    uris.append(address)
-                            if entry.has_key('SIPIdentitySIPURI'):
-                                for _entry in entry['SIPIdentitySIPURI']:
-                                    address = ('sip', sip_prefix_pattern.sub("", str(_entry)))
-                                    uris.append(address)
-                            if uris:
-                                data = NotificationData(name=entry['cn'][0], uris=uris)
-                                NotificationCenter().post_notification("LDAPDirectorySearchFoundContact", sender=self, data=data)
+        try:
+            results, complete = self._paged_search(l, keyword)
+        except ldap.LDAPError, e:
+            BlinkLogger().log_info('LDAP search on %s failed: %s' % (self.ldap_directory.server, e))
+            self.ldap_directory._close_connection(l)
+        else:
+            self.ldap_directory.release(l)
+            if results is not None:
+                self.cache[keyword.lower()] = (time.time(), results, complete)
+
+        if self.keyword == keyword:
             self.ldap_query_id = None
+
+    def _paged_search(self, l, keyword):
+        # posts the contacts found in each page and returns all of them, each with the cn values of its entry, together with a
+        # flag telling if they are every match of the keyword, which is only known when the server ended the paged search by
+        # itself. Returns None for the results if the keyword changed before the search ended
+        filter = "cn=*%s*" % escape_filter_chars(keyword.encode("utf-8"))
+        page_control = SimplePagedResultsControl(True, size=self.page_size, cookie='')
+        results = []
+        while self.keyword == keyword:
+            msgid = l.search_ext(self.ldap_directory.dn, ldap.SCOPE_SUBTREE, filter, self.attributes, serverctrls=[page_control])
+            try:
+                result_type, result_data, result_msgid, server_controls = l.result3(msgid)
+            except ldap.SIZELIMIT_EXCEEDED:
+                return results, False
+
+            found = [(self._contact_from_entry(entry), entry.get('cn', [])) for dn, entry in result_data if dn is not None]
+            found = [(contact, names) for contact, names in found if contact is not None]
+            if found:
+                results.extend(found)
+                contacts = [contact for contact, names in found]
+                if self.keyword == keyword:
+                    NotificationCenter().post_notification("LDAPDirectorySearchFoundContacts", sender=self, data=NotificationData(keyword=keyword, contacts=contacts))
+
+            page_control.cookie = next((control.cookie for control in server_controls if control.controlType == SimplePagedResultsControl.controlType), '')
+            if not page_control.cookie:
+                return results, True
+
+        if page_control.cookie:
+            # a page size of 0 tells the server to discard the rest of the paged search
+            page_control.size = 0
+            l.result3(l.search_ext(self.ldap_directory.dn, ldap.SCOPE_SUBTREE, filter, self.attributes, serverctrls=[page_control]))
+        return None, False
+
+    @staticmethod
+    def _contact_from_entry(entry):
+        uris = []
+        if entry.has_key('telephoneNumber'):
+            for _entry in entry['telephoneNumber']:
+                address = ('telephone', str(_entry))
+                uris.append(address)
+        if entry.has_key('workNumber'):
+            for _entry in entry['workNumber']:
+                address = ('work', str(_entry))
+                uris.append(address)
+        if entry.has_key('mobile'):
+            for _entry in entry['mobile']:
+                address = ('mobile', str(_entry))
+                uris.append(address)
+        if entry.has_key('SIPIdentitySIPURI'):
+            for _entry in entry['SIPIdentitySIPURI']:
+                address = ('sip', sip_prefix_pattern.sub("", str(_entry)))
+                uris.append(address)
+        if uris:
+            return entry['cn'][0], uris
+        return None
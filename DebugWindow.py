@@ -12,12 +12,14 @@ from Foundation import (NSAttributedString,
                         NSFont,
                         NSMakeRange,
                         NSMutableAttributedString,
+                        NSNotFound,
                         NSNotificationCenter,
                         NSObject,
                         NSString
                         )
 import objc
 
+from collections import deque
 from datetime import datetime
 
 from application.notification import NotificationCenter, IObserver
@@ -103,8 +105,13 @@ class DebugWindow(NSObject):
     notificationsCheckBox = objc.IBOutlet()
     pjsipCheckBox = objc.IBOutlet()
 
-    notifications = []
-    notifications_unfiltered = []
+    # at most notifications_limit notifications are kept, text views are trimmed back once they exceed text_view_limit characters
+    notifications_limit = 5000
+    text_view_limit = 2000000
+
+    notifications = deque(maxlen=notifications_limit)
+    notifications_unfiltered = deque(maxlen=notifications_limit)
+    notifications_filter = u''
 
     lastSIPMessageWasDNS = False
 
@@ -137,6 +144,9 @@ class DebugWindow(NSObject):
     def init(self):
         self = super(DebugWindow, self).init()
 
+        self.notifications = deque(maxlen=self.notifications_limit)
+        self.notifications_unfiltered = deque(maxlen=self.notifications_limit)
+
         NSBundle.loadNibNamed_owner_("DebugWindow", self)
 
         for textView in [self.activityTextView, self.sipTextView, self.rtpTextView, self.msrpTextView, self.xcapTextView, self.pjsipTextView]:
@@ -304,8 +314,8 @@ class DebugWindow(NSObject):
         elif sender.tag() == 105:
             self.xcapTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.xcapTextView.textStorage().length()))
         elif sender.tag() == 103:
-            self.notifications = []
-            self.notifications_unfiltered = []
+            self.notifications.clear()
+            self.notifications_unfiltered.clear()
             self.notificationsBytes = 0
             self.notificationsTextView.reloadData()
             self.notificationsInfoLabel.setStringValue_('')
@@ -321,10 +331,32 @@ class DebugWindow(NSObject):
 
     def renderNotifications(self):
         text = unicode(self.filterNotificationsSearchBox.stringValue().strip().lower())
-        self.notifications = [notification for notification in self.notifications_unfiltered if text in notification[0].lower()] if text else self.notifications_unfiltered
-        self.notificationsTextView.noteNumberOfRowsChanged()
+        self.notifications_filter = text
+        self.notifications = deque((notification for notification in self.notifications_unfiltered if text in notification[4]), self.notifications_limit) if text else self.notifications_unfiltered
+        self.notificationsTextView.reloadData()
+        self.updateNotificationsView()
+
+    def addNotification(self, notification):
+        # only the new notification is tested against the active search
+        rows = len(self.notifications)
+        if len(self.notifications_unfiltered) == self.notifications_limit:
+            self.notificationsBytes -= self.notifications_unfiltered[0][5]
+        self.notifications_unfiltered.append(notification)
+        self.notificationsBytes += notification[5]
+        if self.notifications is not self.notifications_unfiltered:
+            if self.notifications_filter not in notification[4]:
+                return
+            self.notifications.append(notification)
+        if rows == self.notifications_limit:
+            # the oldest row was dropped, so all rows moved
+            self.notificationsTextView.reloadData()
+        else:
+            self.notificationsTextView.noteNumberOfRowsChanged()
+        self.updateNotificationsView()
+
+    def updateNotificationsView(self):
         self.notificationsTextView.scrollRowToVisible_(len(self.notifications)-1)
-        self.notificationsInfoLabel.setStringValue_('%d notifications, %sytes' % (len(self.notifications), format_size(self.notificationsBytes)) if not text else '%d notifications matched' % len(self.notifications))
+        self.notificationsInfoLabel.setStringValue_('%d notifications, %sytes' % (len(self.notifications), format_size(self.notificationsBytes)) if not self.notifications_filter else '%d notifications matched' % len(self.notifications))
 
     def dealloc(self):
         # Observers added in init
@@ -349,18 +381,30 @@ class DebugWindow(NSObject):
 
         super(DebugWindow, self).dealloc()
 
+    def scroll_to_end(self, textView):
+        storage = textView.textStorage()
+        length = storage.length()
+        if length > self.text_view_limit:
+            # drop the oldest lines, keeping three quarters of the limit
+            start = length - self.text_view_limit * 3 / 4
+            newline = storage.string().rangeOfString_options_range_(u"\n", 0, NSMakeRange(start, length - start))
+            if newline.location != NSNotFound:
+                start = newline.location + 1
+            storage.deleteCharactersInRange_(NSMakeRange(0, start))
+        textView.scrollRangeToVisible_(NSMakeRange(storage.length()-1, 1))
+
     def append_line(self, textView, line):
         if isinstance(line, NSAttributedString):
             textView.textStorage().appendAttributedString_(line)
         else:
             textView.textStorage().appendAttributedString_(NSAttributedString.alloc().initWithString_(line+"\n"))
 
-        textView.scrollRangeToVisible_(NSMakeRange(textView.textStorage().length()-1, 1))
+        self.scroll_to_end(textView)
 
     def append_error_line(self, textView, line):
         red = NSDictionary.dictionaryWithObject_forKey_(NSColor.redColor(), NSForegroundColorAttributeName)
         textView.textStorage().appendAttributedString_(NSAttributedString.alloc().initWithString_attributes_(line+"\n", red))
-        textView.scrollRangeToVisible_(NSMakeRange(textView.textStorage().length()-1, 1))
+        self.scroll_to_end(textView)
 
     @allocate_autorelease_pool
     @run_in_gui_thread
@@ -403,7 +447,7 @@ class DebugWindow(NSObject):
 
         astring = NSAttributedString.alloc().initWithString_(text)
         self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.scroll_to_end(self.rtpTextView)
 
     @allocate_autorelease_pool
     def renderSIP(self, notification):
@@ -508,7 +552,7 @@ class DebugWindow(NSObject):
 
         self.sipTextView.textStorage().appendAttributedString_(text)
         self.sipTextView.textStorage().appendAttributedString_(self.newline)
-        self.sipTextView.scrollRangeToVisible_(NSMakeRange(self.sipTextView.textStorage().length()-1, 1))
+        self.scroll_to_end(self.sipTextView)
 
     def renderDNS(self, text):
         settings = SIPSimpleSettings()
@@ -561,12 +605,13 @@ class DebugWindow(NSObject):
             ts = notification.datetime
             ts = ts.replace(microsecond=0) if type(ts) == datetime else ""
 
-            self.notificationsBytes += len(notification.name) + len(str(notification.sender)) + len(attribs) + len(str(ts))
-            self.notifications_unfiltered.append((NSString.stringWithString_(notification.name),
-                                            NSString.stringWithString_(str(notification.sender)),
-                                            NSString.stringWithString_(attribs),
-                                            NSString.stringWithString_(str(ts))))
-            self.renderNotifications()
+            size = len(notification.name) + len(str(notification.sender)) + len(attribs) + len(str(ts))
+            self.addNotification((NSString.stringWithString_(notification.name),
+                                  NSString.stringWithString_(str(notification.sender)),
+                                  NSString.stringWithString_(attribs),
+                                  NSString.stringWithString_(str(ts)),
+                                  notification.name.lower(),
+                                  size))
 
     def _NH_CFGSettingsObjectDidChange(self, notification):
         sender = notification.sender
@@ -583,7 +628,7 @@ class DebugWindow(NSObject):
         text = '%s Audio session to %s has quality issues: loss %s, rtt: %s\n' % (notification.datetime, notification.sender.sessionController.target_uri, notification.data.packet_loss, notification.data.latency)
         astring = NSAttributedString.alloc().initWithString_(text)
         self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.scroll_to_end(self.rtpTextView)
 
     def _NH_MSRPTransportTrace(self, notification):
         settings = SIPSimpleSettings()
@@ -663,7 +708,7 @@ class DebugWindow(NSObject):
             text += '%s RTP audio stream is encrypted\n' % notification.datetime
         astring = NSAttributedString.alloc().initWithString_(text)
         self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.scroll_to_end(self.rtpTextView)
 
     def _NH_AudioStreamICENegotiationDidSucceed(self, notification):
         data = notification.data
@@ -690,7 +735,7 @@ class DebugWindow(NSObject):
             text += '\t%s\n' % check
         astring = NSAttributedString.alloc().initWithString_(text)
         self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.scroll_to_end(self.rtpTextView)
 
     def _NH_AudioStreamICENegotiationDidFail(self, notification):
         data = notification.data
@@ -698,7 +743,7 @@ class DebugWindow(NSObject):
         text = '%s ICE negotiation failed: %s\n' % (notification.datetime, data.reason)
         astring = NSAttributedString.alloc().initWithString_(text)
         self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.scroll_to_end(self.rtpTextView)
 
     def _NH_SIPEngineLog(self, notification):
         if self.pjsipCheckBox.state() == NSOnState:
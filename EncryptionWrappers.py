@@ -1,30 +1,47 @@
 # Copyright (C) 2012 AG Projects. See LICENSE for details.
 #
 
-import cStringIO
+import hashlib
+
+from M2Crypto import m2
 from M2Crypto.EVP import Cipher
 from base64 import b64encode, b64decode
+from collections import OrderedDict
 
-__all__ = ['encryptor', 'decryptor']
+__all__ = ['encryptor', 'decryptor', 'encrypt_file', 'decrypt_file']
 
 
 ENC=1
 DEC=0
 
+CHUNK_SIZE=64*1024
+
+DERIVED_KEYS_CACHE_SIZE=16
+
+# derived keys of the most recently used passwords, by a digest of the password so the password itself is not kept
+_derived_keys = OrderedDict()
+
+
+def derive_key(key):
+    # Same key derivation M2Crypto does for key_as_bytes=1, computed once per password
+    digest = hashlib.sha256(key).digest()
+    try:
+        derived_key = _derived_keys.pop(digest)
+    except KeyError:
+        derived_key = m2.bytes_to_key(m2.aes_128_cbc(), m2.sha1(), key, 'saltsalt', '\0' * 16, 5)
+        if len(_derived_keys) >= DERIVED_KEYS_CACHE_SIZE:
+            _derived_keys.popitem(last=False)
+    _derived_keys[digest] = derived_key
+    return derived_key
 
 def build_cipher(key, op):
-    return Cipher(alg='aes_128_cbc', key=key, iv='\0' * 16, op=op, key_as_bytes=1, d='sha1', salt='saltsalt', i=5)
+    return Cipher(alg='aes_128_cbc', key=derive_key(key), iv='\0' * 16, op=op, key_as_bytes=0)
 
 def encryptor(key):
     # Return the encryption function
     def encrypt(data, b64_encode=False):
         cipher = build_cipher(key, ENC)
-        pbuf=cStringIO.StringIO(data)
-        cbuf=cStringIO.StringIO()
-        ctxt=cipher_filter(cipher, pbuf, cbuf)
-        pbuf.close()
-        cbuf.close()
-        del cipher
+        ctxt = cipher.update(data) + cipher.final()
         if b64_encode:
             return b64encode(ctxt)
         else:
@@ -37,21 +54,21 @@ def decryptor(key):
         if b64_decode:
             data = b64decode(data)
         cipher = build_cipher(key, DEC)
-        pbuf=cStringIO.StringIO()
-        cbuf=cStringIO.StringIO(data)
-        ptxt=cipher_filter(cipher, cbuf, pbuf)
-        pbuf.close()
-        cbuf.close()
-        del cipher
-        return ptxt
+        return cipher.update(data) + cipher.final()
     return decrypt
 
-def cipher_filter(cipher, inf, outf):
+def encrypt_file(key, inf, outf, chunk_size=CHUNK_SIZE):
+    # Encrypt the contents of file-like object inf into file-like object outf
+    cipher_filter(build_cipher(key, ENC), inf, outf, chunk_size)
+
+def decrypt_file(key, inf, outf, chunk_size=CHUNK_SIZE):
+    # Decrypt the contents of file-like object inf into file-like object outf
+    cipher_filter(build_cipher(key, DEC), inf, outf, chunk_size)
+
+def cipher_filter(cipher, inf, outf, chunk_size=CHUNK_SIZE):
     while 1:
-        buf=inf.read()
+        buf=inf.read(chunk_size)
         if not buf:
             break
         outf.write(cipher.update(buf))
     outf.write(cipher.final())
-    return outf.getvalue()
-
@@ -278,7 +278,7 @@ class FileTransferItemView(NSView):
         self.updateProgressInfo()
 
     def _NH_BlinkFileTransferHashUpdate(self, notification):
-        self.updateChecksumProgressInfo(notification.data.progress)
+        self.updateChecksumProgressInfo(notification.data.progress, notification.data.throughput)
 
     def _NH_BlinkFileTransferDidComputeHash(self, notification):
         pass
@@ -288,9 +288,12 @@ class FileTransferItemView(NSView):
         self.sizeText.setStringValue_(self.transfer.progress_text)
         self.progressBar.setDoubleValue_(self.transfer.progress*100)
 
-    def updateChecksumProgressInfo(self, progress):
+    def updateChecksumProgressInfo(self, progress, throughput=None):
         self.checksumProgressBar.setDoubleValue_(progress)
-        self.sizeText.setStringValue_('Calculating checksum: %s%%' % progress)
+        if throughput:
+            self.sizeText.setStringValue_('Calculating checksum: %s%% (%s/s)' % (progress, format_size(throughput, 1024)))
+        else:
+            self.sizeText.setStringValue_('Calculating checksum: %s%%' % progress)
 
 
 
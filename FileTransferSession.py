@@ -5,21 +5,23 @@ from Foundation import NSDownloadsDirectory, NSSearchPathForDirectoriesInDomains
 
 import hashlib
 import datetime
+import mmap
 import os
 import re
 import time
 import unicodedata
 import uuid
+from itertools import count
 
 from application.notification import NotificationCenter, IObserver, NotificationData
-from application.python import Null, limit
+from application.python import Null
 from sipsimple.account import Account, BonjourAccount
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import ToHeader, SIPURI
 from sipsimple.lookup import DNSLookup
 from sipsimple.session import Session
 from sipsimple.streams import FileTransferStream, FileSelector
-from sipsimple.threading import run_in_thread
+from sipsimple.threading import call_in_thread, run_in_thread
 from sipsimple.threading.green import run_in_green_thread
 from sipsimple.util import ISOTimestamp
 from threading import Event
@@ -28,8 +30,41 @@ from twisted.internet.error import ConnectionLost
 from zope.interface import implements
 
 from BlinkLogger import BlinkLogger
+from FileWriteBuffer import FileWriteBuffer
 from HistoryManager import FileTransferHistory, ChatHistory
-from util import allocate_autorelease_pool, format_size, format_identity_to_string
+from util import allocate_autorelease_pool, format_size, format_identity_to_string, LRUCache
+
+
+# checksums of outgoing files are computed in this many named threads, so several files can be hashed at the same time
+CHECKSUM_THREADS = 4
+checksum_thread_counter = count()
+
+# (path, size, mtime, inode) -> sha1 of the files sent recently
+checksum_cache = LRUCache(100)
+
+CHECKSUM_CHUNK_SIZE = 4*1024*1024
+
+# minimum interval in seconds between two progress notifications of a transfer
+PROGRESS_UPDATE_INTERVAL = 0.5
+
+
+def iter_file_chunks(fd, chunk_size):
+    # map the file in memory so chunks are hashed without copying them, fall back to reading them for files that cannot be mapped
+    try:
+        content = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError, mmap.error):
+        fd.seek(0)
+        while True:
+            data = fd.read(chunk_size)
+            if not data:
+                break
+            yield data
+        return
+    try:
+        for pos in xrange(0, len(content), chunk_size):
+            yield buffer(content, pos, chunk_size)
+    finally:
+        content.close()
 
 
 def format_duration(t):
@@ -70,6 +105,7 @@ class FileTransfer(object):
     transfer_rate = None
     last_rate_pos = 0
     last_rate_time = 0
+    last_progress_time = 0
     rate_history = None
     ft_info = None
 
@@ -135,13 +171,23 @@ class FileTransfer(object):
                 self.last_rate_pos = self.file_pos
 
                 self.transfer_rate = sum(self.rate_history) / len(self.rate_history)
+
+                notification_center = NotificationCenter()
+                notification_center.post_notification("BlinkFileTransferSpeedDidUpdate", sender=self)
         else:
             self.last_rate_time = time.time()
             self.last_rate_pos = self.file_pos
             self.rate_history = []
 
+    def update_progress(self):
+        # chunks arrive far more often than the progress can be displayed, only post an update every PROGRESS_UPDATE_INTERVAL
+        now = time.time()
+        if now - self.last_progress_time < PROGRESS_UPDATE_INTERVAL:
+            return
+        self.last_progress_time = now
+        self.status = self.format_progress()
         notification_center = NotificationCenter()
-        notification_center.post_notification("BlinkFileTransferSpeedDidUpdate", sender=self)
+        notification_center.post_notification("BlinkFileTransferUpdate", sender=self)
 
     @run_in_green_thread
     def add_to_history(self):
@@ -198,6 +244,7 @@ class IncomingFileTransferHandler(FileTransfer):
         self.target_uri = session.remote_identity.uri
         self.timer = None
         self.transfer_id = str(uuid.uuid1())
+        self.write_buffer = None
         self.direction = 'incoming'
 
     @property
@@ -225,6 +272,7 @@ class IncomingFileTransferHandler(FileTransfer):
 
         self.log_info(u"Will write file to %s" % self.file_path)
         self.file_selector.fd = open(self.file_path, "w+")
+        self.write_buffer = FileWriteBuffer(self.file_selector.fd, self.hash)
 
         self.ft_info.status = "preparing"
         self.status = "Accepting File Transfer..."
@@ -243,17 +291,20 @@ class IncomingFileTransferHandler(FileTransfer):
             self.ft_info.status = "Interrupted" if self.started else "Cancelled"
         self.end()
 
-    @run_in_thread('file-transfer')
+    @run_in_thread('file-transfer-io')
     def write_chunk(self, data):
         notification_center = NotificationCenter()
         if data is not None:
             try:
-                self.file_selector.fd.write(data)
+                self.write_buffer.write(data)
             except EnvironmentError, e:
                 notification_center.post_notification('IncomingFileTransferHandlerGotError', sender=self, data=NotificationData(error=str(e)))
-            else:
-                self.hash.update(data)
         else:
+            if not self.error:
+                try:
+                    self.write_buffer.flush()
+                except EnvironmentError, e:
+                    notification_center.post_notification('IncomingFileTransferHandlerGotError', sender=self, data=NotificationData(error=str(e)))
             self.file_selector.fd.close()
             if self.error:
                 notification_center.post_notification('IncomingFileTransferHandlerDidFail', sender=self)
@@ -304,10 +355,8 @@ class IncomingFileTransferHandler(FileTransfer):
         self.write_chunk(data.content)
 
         self.update_transfer_rate()
-        self.status = self.format_progress()
         self.ft_info.status = "transferring"
-        notification_center = NotificationCenter()
-        notification_center.post_notification("BlinkFileTransferUpdate", sender=self)
+        self.update_progress()
 
     def _NH_FileTransferStreamDidFinish(self, sender, data):
         self.finished_transfer = True
@@ -439,9 +488,9 @@ class OutgoingPushFileTransferHandler(FileTransfer):
         self.log_info(u"Computing checksum for file %s" % os.path.basename(self.file_path))
 
         self.stop_event.clear()
-        self.initiate_file_transfer()
+        call_in_thread('file-transfer-checksum-%d' % (next(checksum_thread_counter) % CHECKSUM_THREADS), self.initiate_file_transfer)
 
-    @run_in_thread('file-transfer')
+    @allocate_autorelease_pool
     def initiate_file_transfer(self):
         notification_center = NotificationCenter()
         notification_center.add_observer(self, sender=self)
@@ -456,27 +505,53 @@ class OutgoingPushFileTransferHandler(FileTransfer):
         # compute the file hash first
         self.ft_info.status = "preparing"
         self.status = "Computing checksum..."
-        hash = hashlib.sha1()
-        pos = progress = 0
-        chunk_size = limit(self.file_selector.size/100, min=65536, max=1048576)
-        notification_center.post_notification('BlinkFileTransferHashUpdate', sender=self, data=NotificationData(progress=0))
-        while not self.stop_event.isSet():
-            content = self.file_selector.fd.read(chunk_size)
-            if not content:
-                break
-            hash.update(content)
-            pos += len(content)
-            old_progress, progress = progress, int(float(pos)/self.file_selector.size*100)
-            if old_progress != progress:
-                notification_center.post_notification('BlinkFileTransferHashUpdate', sender=self, data=NotificationData(progress=progress))
+        try:
+            stat = os.fstat(self.file_selector.fd.fileno())
+        except OSError:
+            cache_key = None
         else:
-            self.file_selector.fd.close()
-            notification_center.post_notification('BlinkFileTransferDidNotComputeHash', sender=self, data=NotificationData(reason='Cancelled computing checksum'))
-            return
+            cache_key = (self.file_path, stat.st_size, stat.st_mtime, stat.st_ino)
+
+        try:
+            hash = checksum_cache[cache_key].copy()
+        except KeyError:
+            hash = self.compute_checksum()
+            if hash is None:
+                self.file_selector.fd.close()
+                notification_center.post_notification('BlinkFileTransferDidNotComputeHash', sender=self, data=NotificationData(reason='Cancelled computing checksum'))
+                return
+            if cache_key is not None:
+                checksum_cache[cache_key] = hash.copy()
+        else:
+            self.log_info(u"Using cached checksum for file %s" % os.path.basename(self.file_path))
+            notification_center.post_notification('BlinkFileTransferHashUpdate', sender=self, data=NotificationData(progress=100, throughput=None))
         self.file_selector.fd.seek(0)
         self.file_selector.hash = hash
         notification_center.post_notification('BlinkFileTransferDidComputeHash', sender=self)
 
+    def compute_checksum(self):
+        notification_center = NotificationCenter()
+        hash = hashlib.sha1()
+        pos = progress = 0
+        size = self.file_selector.size
+        start_time = time.time()
+        notification_center.post_notification('BlinkFileTransferHashUpdate', sender=self, data=NotificationData(progress=0, throughput=None))
+        chunks = iter_file_chunks(self.file_selector.fd, CHECKSUM_CHUNK_SIZE)
+        try:
+            for content in chunks:
+                if self.stop_event.isSet():
+                    return None
+                hash.update(content)
+                pos += len(content)
+                old_progress, progress = progress, int(float(pos)/size*100)
+                if old_progress != progress:
+                    elapsed = time.time() - start_time
+                    throughput = int(pos/elapsed) if elapsed else None
+                    notification_center.post_notification('BlinkFileTransferHashUpdate', sender=self, data=NotificationData(progress=progress, throughput=throughput))
+        finally:
+            chunks.close()
+        return hash
+
     def cancel(self):
         if not self.finished_transfer:
             self.fail_reason = "Interrupted" if self.started else "Cancelled"
@@ -556,10 +631,7 @@ class OutgoingPushFileTransferHandler(FileTransfer):
     def _NH_FileTransferStreamDidDeliverChunk(self, sender, data):
         self.file_pos = data.transferred_bytes
         self.update_transfer_rate()
-        self.status = self.format_progress()
-
-        notification_center = NotificationCenter()
-        notification_center.post_notification("BlinkFileTransferUpdate", sender=self)
+        self.update_progress()
 
     def _NH_FileTransferStreamDidFinish(self, sender, data):
         self.log_info("File successfully transferred")
@@ -783,10 +855,8 @@ class OutgoingPullFileTransferHandler(FileTransfer):
         self.write_chunk(data.content)
 
         self.update_transfer_rate()
-        self.status = self.format_progress()
         self.ft_info.status = "transferring"
-        notification_center = NotificationCenter()
-        notification_center.post_notification("BlinkFileTransferUpdate", sender=self)
+        self.update_progress()
 
     def _NH_FileTransferStreamDidFinish(self, sender, data):
         self.finished_transfer = True
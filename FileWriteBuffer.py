@@ -0,0 +1,54 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+__all__ = ['FileWriteBuffer', 'WRITE_BUFFER_SIZE', 'WRITE_ALIGNMENT']
+
+
+# incoming chunks are collected and written to disk once this many bytes are buffered, in multiples of WRITE_ALIGNMENT
+WRITE_BUFFER_SIZE = 1024*1024
+WRITE_ALIGNMENT = 64*1024
+
+
+class FileWriteBuffer(object):
+    """
+        Collects the chunks of a file being received and writes them with a single call once size bytes are buffered.
+        Each of those writes ends on an alignment boundary of the file, the rest stays buffered for the next one.
+        The data is added to hash right after it is written, while it is still in the cache.
+        """
+
+    def __init__(self, fd, hash, size=WRITE_BUFFER_SIZE, alignment=WRITE_ALIGNMENT, position=0):
+        self.fd = fd
+        self.hash = hash
+        self.size = size
+        self.alignment = alignment
+        self.position = position
+        self.chunks = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.size:
+            self.flush(aligned=True)
+
+    def flush(self, aligned=False):
+        # raises EnvironmentError if the data cannot be written, the buffered data is dropped in that case
+        if not self.chunks:
+            return
+        data = ''.join(self.chunks)
+        size = len(data)
+        if aligned:
+            size = (self.position + size) // self.alignment * self.alignment - self.position
+            if not size:
+                return
+        content = buffer(data, 0, size)
+        try:
+            self.fd.write(content)
+        except EnvironmentError:
+            self.chunks = []
+            self.buffered = 0
+            raise
+        self.hash.update(content)
+        self.position += size
+        self.chunks = [data[size:]] if size < len(data) else []
+        self.buffered = len(data) - size
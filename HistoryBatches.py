@@ -0,0 +1,165 @@
+# Copyright (C) 2011 AG Projects. See LICENSE for details.
+#
+
+"""Batched writes of the history database and of the chat journal pushed to the replication server"""
+
+from datetime import datetime
+from threading import Lock
+
+__all__ = ['format_db_time', 'format_db_text', 'execute_batch', 'insert_session_entries', 'insert_chat_messages', 'WriteBehindQueue', 'journal_batches', 'remove_acknowledged_entries', 'IncomingJournal']
+
+
+SESSIONS_INSERT_QUERY = """INSERT OR IGNORE INTO sessions (session_id, media_types, direction, status, failure_reason, start_time, end_time, duration,
+                           sip_callid, sip_fromtag, sip_totag, local_uri, remote_uri, remote_focus, participants, hidden, am_filename)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+CHAT_MESSAGES_INSERT_QUERY = """INSERT OR IGNORE INTO chat_messages (msgid, sip_callid, sip_fromtag, sip_totag, time, date, media_type, direction, local_uri, remote_uri,
+                                cpim_from, cpim_to, cpim_timestamp, body, content_type, private, status, uuid, journal_id, encryption)
+                                VALUES (?, ?, '', '', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+# messages already stored only get their status and journal id updated
+CHAT_MESSAGES_UPDATE_QUERY = """UPDATE chat_messages SET status = ?, journal_id = ?
+                                WHERE msgid = ? AND local_uri = ? AND remote_uri = ? AND (status != ? OR journal_id IS NULL OR journal_id != ?)"""
+
+
+def format_db_time(value):
+    return value.strftime("%Y-%m-%d %H:%M:%S") if isinstance(value, datetime) else value
+
+
+def format_db_text(value):
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('latin1')
+    return value
+
+
+def execute_batch(db, statements):
+    # Caller needs to be in the db thread
+    connection = db.getConnection()
+    isolation_level = connection.isolation_level
+    # let the sqlite module wrap all statements in a single transaction instead of committing each row
+    connection.isolation_level = ''
+    try:
+        cursor = connection.cursor()
+        for query, rows in statements:
+            cursor.executemany(query, rows)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.isolation_level = isolation_level
+        db.releaseConnection(connection)
+
+
+def insert_session_entries(db, rows):
+    # rows hold the values of SESSIONS_INSERT_QUERY, entries already stored are left alone
+    execute_batch(db, [(SESSIONS_INSERT_QUERY, rows)])
+
+
+def insert_chat_messages(db, rows):
+    # rows hold the values of CHAT_MESSAGES_INSERT_QUERY: msgid, sip_callid, time, date, media_type, direction, local_uri, remote_uri,
+    # cpim_from, cpim_to, cpim_timestamp, body, content_type, private, status, uuid, journal_id and encryption
+    updates = [(row[14], row[16], row[0], row[6], row[7], row[14], row[16]) for row in rows]
+    execute_batch(db, [(CHAT_MESSAGES_INSERT_QUERY, rows), (CHAT_MESSAGES_UPDATE_QUERY, updates)])
+
+
+class WriteBehindQueue(object):
+    """
+        Collects rows added one by one and hands them in batches to writer. executor(func) must run func in the
+        thread that owns the database, one function at a time and in the order they were scheduled, so a burst of
+        rows is written by a single call and anything scheduled after a row was added sees it stored.
+        """
+
+    def __init__(self, writer, executor):
+        self.writer = writer
+        self.executor = executor
+        self.rows = []
+        self.lock = Lock()
+
+    def put(self, row):
+        with self.lock:
+            self.rows.append(row)
+            if len(self.rows) > 1:
+                # a flush is already scheduled and will pick this row too
+                return
+        self.executor(self._flush)
+
+    def _flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if rows:
+            self.writer(rows)
+
+
+def journal_batches(entries, in_flight, count, max_entries, max_size):
+    # entries maps msgid to the queued {'id', 'data'} entry, the ones with a msgid in in_flight are waiting for a
+    # previous push and are left out. Up to count batches bounded by number of entries and size of the data are
+    # returned, an entry larger than max_size is sent on its own
+    pending = [entry for msgid, entry in entries.iteritems() if msgid not in in_flight]
+    batches = []
+    while pending and len(batches) < count:
+        batch = {}
+        size = 0
+        while pending and len(batch) < max_entries:
+            entry = pending[-1]
+            if batch and size + len(entry['data']) > max_size:
+                break
+            pending.pop()
+            batch[entry['id']] = entry
+            size += len(entry['data'])
+        batches.append(batch)
+    return batches
+
+
+def remove_acknowledged_entries(entries, batch):
+    # removes from entries the ones pushed with batch and returns their msgids. A message queued again while the
+    # batch was in flight has a new entry which still needs to be pushed, so it is kept
+    removed = []
+    for msgid, entry in batch.iteritems():
+        if entries.get(msgid) is entry:
+            del entries[msgid]
+            removed.append(msgid)
+    return removed
+
+
+class IncomingJournal(object):
+    """
+        The chat journal being received from the replication server. Its results are handed out in batches of
+        batch_size, so a long journal is applied to the local history while the rest of it is still being received,
+        but only once the server said the request succeeded. Results received before that are kept until then and
+        dropped if it failed.
+        """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.members = {}
+        self.summary = []
+        self.results = []
+        self.count = 0
+
+    @property
+    def success(self):
+        return bool(self.members.get('success'))
+
+    def add_events(self, events):
+        # events are the (name, value, is_item) tuples returned by JSONStreamDecoder, returns the results to apply now
+        for name, value, is_item in events:
+            if not is_item:
+                self.members[name] = value
+            elif name == 'summary':
+                self.summary.append(value)
+            elif name == 'results':
+                self.results.append(value)
+                self.count += 1
+        if self.success and len(self.results) >= self.batch_size:
+            results, self.results = self.results, []
+            return results
+        return []
+
+    def finish(self):
+        # returns the results not handed out yet, none if the request failed
+        results, self.results = self.results, []
+        return results if self.success else []
@@ -23,6 +23,7 @@ import shutil
 import time
 import urlparse
 import urllib
+from collections import namedtuple
 from datetime import datetime
 from uuid import uuid1
 
@@ -41,9 +42,10 @@ from twisted.internet.threads import deferToThreadPool
 from twisted.python.threadpool import ThreadPool
 
 from BlinkLogger import BlinkLogger
+from HistoryBatches import format_db_time, format_db_text, execute_batch, insert_session_entries, insert_chat_messages, WriteBehindQueue, journal_batches, remove_acknowledged_entries, IncomingJournal
 from EncryptionWrappers import encryptor, decryptor
 from resources import ApplicationData
-from util import allocate_autorelease_pool, format_identity_to_string, sipuri_components_from_string, run_in_gui_thread
+from util import allocate_autorelease_pool, format_identity_to_string, sipuri_components_from_string, run_in_gui_thread, JSONStreamDecoder
 
 from sipsimple.account import Account, AccountManager, BonjourAccount
 from sipsimple.configuration.settings import SIPSimpleSettings
@@ -66,6 +68,30 @@ def run_in_db_thread(func):
     return wrapper
 
 
+def call_in_db_thread(func, *args, **kw):
+    return deferToThreadPool(reactor, pool, func, *args, **kw)
+
+
+# composite indexes added by the schema versions, shared by the migrations and by the tables created from scratch
+SESSIONS_INDEXES = {
+    # history groups filter on direction, status and hidden ordered by start time
+    'direction_status_hidden_start_time_index': '(direction, status, hidden, start_time)',
+    'hidden_start_time_index': '(hidden, start_time)',
+    # server history sync looks up calls by call id and from tag
+    'sip_callid_fromtag_index': '(sip_callid, sip_fromtag)'
+}
+
+CHAT_MESSAGES_INDEXES = {
+    # messages of a conversation ordered by time
+    'remote_uri_media_type_time_index': '(remote_uri, media_type, time)',
+    # daily entries of an account and of a conversation
+    'local_uri_date_index': '(local_uri, date)',
+    'remote_uri_date_media_type_index': '(remote_uri, date, media_type)',
+    # messages of a session
+    'sip_callid_index': '(sip_callid)'
+}
+
+
 class TableVersionEntry(SQLObject):
     class sqlmeta:
         table = 'versions'
@@ -146,13 +172,14 @@ class SessionHistoryEntry(SQLObject):
 
 class SessionHistory(object):
     __metaclass__ = Singleton
-    __version__ = 5
+    __version__ = 6
 
     def __init__(self):
         path = ApplicationData.get('history')
         makedirs(path)
         db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
         TableVersions()    # initialize versions table
+        self.write_queue = WriteBehindQueue(self._add_entries, call_in_db_thread)
         self._initialize(db_uri)
 
     @run_in_db_thread
@@ -169,6 +196,8 @@ class SessionHistory(object):
                 try:
                     SessionHistoryEntry.createTable()
                     BlinkLogger().log_debug(u"Created sessions table %s" % SessionHistoryEntry.sqlmeta.table)
+                    self._create_indexes()
+                    TableVersions().set_table_version(SessionHistoryEntry.sqlmeta.table, self.__version__)
                 except Exception, e:
                     BlinkLogger().log_error(u"Error creating table %s: %s" % (SessionHistoryEntry.sqlmeta.table,e))
         except Exception, e:
@@ -176,6 +205,8 @@ class SessionHistory(object):
 
     @allocate_autorelease_pool
     def _migrate_version(self, previous_version):
+        # tables created before versioning was introduced have no version entry
+        version = previous_version.version if previous_version is not None else 0
         if previous_version is None:
             query = "SELECT id, local_uri, remote_uri FROM sessions"
             try:
@@ -192,7 +223,7 @@ class SessionHistory(object):
                         self.db.queryAll(query)
                     except Exception, e:
                         BlinkLogger().log_error(u"Error updating table %s: %s" % (ChatMessage.sqlmeta.table, e))
-        elif previous_version.version < 3:
+        elif version < 3:
             query = "ALTER TABLE sessions add column 'hidden' INTEGER DEFAULT 0"
             try:
                 self.db.queryAll(query)
@@ -200,7 +231,7 @@ class SessionHistory(object):
             except Exception, e:
                 BlinkLogger().log_error(u"Error alter table %s: %s" % (SessionHistoryEntry.sqlmeta.table, e))
 
-        if previous_version.version < 4:
+        if version < 4:
             query = "CREATE INDEX IF NOT EXISTS sip_callid_index ON sessions (sip_callid)"
             try:
                 self.db.queryAll(query)
@@ -222,43 +253,70 @@ class SessionHistory(object):
             except Exception, e:
                 BlinkLogger().log_error(u"Error adding index start_time_index to table %s: %s" % (SessionHistoryEntry.sqlmeta.table, e))
 
-        if previous_version.version < 5:
+        if version < 5:
             query = "ALTER TABLE sessions add column 'am_filename' LONGTEXT DEFAULT ''"
             try:
                 self.db.queryAll(query)
                 BlinkLogger().log_debug(u"Added column 'am_filename' to table %s" % SessionHistoryEntry.sqlmeta.table)
+            except dberrors.OperationalError, e:
+                if not str(e).startswith('duplicate column name'):
+                    BlinkLogger().log_error(u"Error alter table %s: %s" % (SessionHistoryEntry.sqlmeta.table, e))
             except Exception, e:
                 BlinkLogger().log_error(u"Error alter table %s: %s" % (SessionHistoryEntry.sqlmeta.table, e))
 
+        if version < 6:
+            self._create_indexes()
+
         TableVersions().set_table_version(SessionHistoryEntry.sqlmeta.table, self.__version__)
 
-    @run_in_db_thread
+    def _create_indexes(self):
+        # Caller needs to be in the db thread
+        for name, columns in SESSIONS_INDEXES.iteritems():
+            query = "CREATE INDEX IF NOT EXISTS %s ON sessions %s" % (name, columns)
+            try:
+                self.db.queryAll(query)
+                BlinkLogger().log_debug(u"Added index %s to table %s" % (name, SessionHistoryEntry.sqlmeta.table))
+            except Exception, e:
+                BlinkLogger().log_error(u"Error adding index %s to table %s: %s" % (name, SessionHistoryEntry.sqlmeta.table, e))
+
     def add_entry(self, session_id, media_type, direction, status, failure_reason, start_time, end_time, duration, local_uri, remote_uri, remote_focus, participants, call_id, from_tag, to_tag, am_filename):
-        try:
-            SessionHistoryEntry(
-                          session_id          = session_id,
-                          media_types         = media_type,
-                          direction           = direction,
-                          status              = status,
-                          failure_reason      = failure_reason,
-                          start_time          = start_time,
-                          end_time            = end_time,
-                          duration            = duration,
-                          local_uri           = local_uri,
-                          remote_uri          = remote_uri,
-                          remote_focus        = remote_focus,
-                          participants        = participants,
-                          sip_callid          = call_id,
-                          sip_fromtag         = from_tag,
-                          sip_totag           = to_tag,
-                          am_filename         = am_filename
-                          )
-            return True
-        except dberrors.DuplicateEntryError:
+        # the entry is written later in the db thread together with the other entries added meanwhile, so nothing is returned.
+        # Errors are logged, use add_entries to get a deferred with the result
+        self.write_queue.put(dict(session_id=session_id, media_type=media_type, direction=direction, status=status, failure_reason=failure_reason, start_time=start_time, end_time=end_time, duration=duration, local_uri=local_uri, remote_uri=remote_uri, remote_focus=remote_focus, participants=participants, call_id=call_id, from_tag=from_tag, to_tag=to_tag, am_filename=am_filename))
+
+    @run_in_db_thread
+    def add_entries(self, entries):
+        return self._add_entries(entries)
+
+    def _add_entries(self, entries):
+        # Caller needs to be in the db thread
+        rows = []
+        for entry in entries:
+            rows.append((entry['session_id'],
+                         entry['media_type'],
+                         entry['direction'],
+                         entry['status'],
+                         entry['failure_reason'],
+                         format_db_time(entry['start_time']),
+                         format_db_time(entry['end_time']),
+                         entry['duration'],
+                         entry['call_id'],
+                         entry['from_tag'],
+                         entry['to_tag'],
+                         format_db_text(entry['local_uri']),
+                         format_db_text(entry['remote_uri']),
+                         entry['remote_focus'],
+                         format_db_text(entry['participants']),
+                         0,
+                         format_db_text(entry['am_filename'])))
+        if not rows:
             return True
+        try:
+            insert_session_entries(self.db, rows)
         except Exception, e:
-            BlinkLogger().log_error(u"Error adding record %s to sessions table: %s" % (session_id, e))
+            BlinkLogger().log_error(u"Error adding %d records to sessions table: %s" % (len(rows), e))
             return False
+        return True
 
     @run_in_db_thread
     def _get_entries(self, direction, status, remote_focus, count, call_id, from_tag, to_tag, remote_uris, hidden, after_date):
@@ -297,6 +355,25 @@ class SessionHistory(object):
     def get_entries(self, direction=None, status=None, remote_focus=None, count=12, call_id=None, from_tag=None, to_tag=None, remote_uris=None, hidden=None, after_date=None):
         return block_on(self._get_entries(direction, status, remote_focus, count, call_id, from_tag, to_tag, remote_uris, hidden, after_date))
 
+    @run_in_db_thread
+    def _get_known_calls(self, calls):
+        # calls is a list of (direction, call_id, from_tag) tuples
+        known = set()
+        for i in xrange(0, len(calls), 500):
+            chunk = calls[i:i+500]
+            call_ids_sql = ",".join(SessionHistoryEntry.sqlrepr(call_id) for direction, call_id, from_tag in chunk)
+            from_tags_sql = ",".join(SessionHistoryEntry.sqlrepr(from_tag) for direction, call_id, from_tag in chunk)
+            query = "select direction, sip_callid, sip_fromtag from sessions where sip_callid in (%s) and sip_fromtag in (%s)" % (call_ids_sql, from_tags_sql)
+            try:
+                known.update(tuple(row) for row in self.db.queryAll(query))
+            except Exception, e:
+                BlinkLogger().log_error(u"Error getting calls from sessions history table: %s" % e)
+                return None
+        return known.intersection(calls)
+
+    def get_known_calls(self, calls):
+        return block_on(self._get_known_calls(list(calls)))
+
     def hide_entries(self, session_ids):
         return block_on(self._hide_entries(session_ids))
 
@@ -423,15 +500,22 @@ class ChatMessage(SQLObject):
     journal_id        = StringCol()
     encryption        = StringCol(default='')
 
+# Lightweight chat message returned by ChatHistory.iter_messages, time is kept as stored so that (time, id) can be used as cursor
+ChatMessageRow = namedtuple('ChatMessageRow', ['id', 'msgid', 'direction', 'time', 'date', 'sip_callid', 'local_uri', 'remote_uri', 'cpim_from', 'cpim_to',
+                                               'cpim_timestamp', 'body', 'content_type', 'private', 'status', 'media_type', 'encryption'])
+
+
 class ChatHistory(object):
     __metaclass__ = Singleton
-    __version__ = 5
+    __version__ = 7
+    fts_enabled = False
 
     def __init__(self):
         path = ApplicationData.get('history')
         makedirs(path)
         db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
         TableVersions()    # initialize versions table
+        self.write_queue = WriteBehindQueue(self._add_messages, call_in_db_thread)
         self._initialize(db_uri)
 
     @run_in_db_thread
@@ -448,11 +532,56 @@ class ChatHistory(object):
                 try:
                     ChatMessage.createTable()
                     BlinkLogger().log_debug(u"Created history table %s" % ChatMessage.sqlmeta.table)
+                    self._create_indexes()
+                    TableVersions().set_table_version(ChatMessage.sqlmeta.table, self.__version__)
                 except Exception, e:
                     BlinkLogger().log_error(u"Error creating history table %s: %s" % (ChatMessage.sqlmeta.table,e))
         except Exception, e:
             BlinkLogger().log_error(u"Error checking history table %s: %s" % (ChatMessage.sqlmeta.table,e))
 
+        self._create_search_index()
+
+    def _create_search_index(self, rebuild=False):
+        # Caller needs to be in the db thread
+        triggers = {
+            'chat_messages_fts_insert': "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN INSERT INTO chat_messages_fts(rowid, body) VALUES (new.id, new.body); END",
+            'chat_messages_fts_delete': "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN INSERT INTO chat_messages_fts(chat_messages_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+            'chat_messages_fts_update': "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_update AFTER UPDATE OF body ON chat_messages BEGIN INSERT INTO chat_messages_fts(chat_messages_fts, rowid, body) VALUES ('delete', old.id, old.body); INSERT INTO chat_messages_fts(rowid, body) VALUES (new.id, new.body); END"
+        }
+        try:
+            existing_triggers = list(self.db.queryAll("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'chat_messages_fts_%'"))
+            self.db.queryAll("CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(body, content='chat_messages', content_rowid='id')")
+            for query in triggers.values():
+                self.db.queryAll(query)
+            if rebuild or len(existing_triggers) != len(triggers):
+                # the index missed the messages added while the triggers did not exist
+                self.db.queryAll("INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')")
+                BlinkLogger().log_debug(u"Built full text search index for table %s" % ChatMessage.sqlmeta.table)
+        except Exception, e:
+            BlinkLogger().log_info(u"Full text search of chat history is not available: %s" % e)
+            self.fts_enabled = False
+            # triggers referring to an unusable index would make all inserts fail
+            for name in triggers.keys():
+                try:
+                    self.db.queryAll("DROP TRIGGER IF EXISTS %s" % name)
+                except Exception:
+                    pass
+        else:
+            self.fts_enabled = True
+
+    def _search_match(self, search_text):
+        # all terms must be present, each one matches as a word prefix
+        terms = search_text.split()
+        if not self.fts_enabled or not terms:
+            return None
+        return ' '.join('"%s"*' % term.replace('"', '""') for term in terms)
+
+    def _search_text_sql(self, search_text):
+        match = self._search_match(search_text)
+        if match is not None:
+            return "id in (select rowid from chat_messages_fts where chat_messages_fts match %s)" % ChatMessage.sqlrepr(match)
+        return "body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+
     @allocate_autorelease_pool
     def _migrate_version(self, previous_version):
         if previous_version is None:
@@ -531,90 +660,110 @@ class ChatHistory(object):
                 if not str(e).startswith('duplicate column name'):
                     BlinkLogger().log_error(u"Error adding column uuid to table %s: %s" % (ChatMessage.sqlmeta.table, e))
 
+        if next_upgrade_version < 6:
+            self._create_search_index(rebuild=True)
+
+        if next_upgrade_version < 7:
+            self._create_indexes()
 
         TableVersions().set_table_version(ChatMessage.sqlmeta.table, self.__version__)
 
-    @run_in_db_thread
+    def _create_indexes(self):
+        # Caller needs to be in the db thread
+        for name, columns in CHAT_MESSAGES_INDEXES.iteritems():
+            query = "CREATE INDEX IF NOT EXISTS %s ON chat_messages %s" % (name, columns)
+            try:
+                self.db.queryAll(query)
+            except Exception, e:
+                BlinkLogger().log_error(u"Error adding index %s to table %s: %s" % (name, ChatMessage.sqlmeta.table, e))
+
     def add_message(self, msgid, media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, cpim_timestamp, body, content_type, private, status, time='', uuid='', journal_id='', skip_replication=False, call_id='', encryption=''):
-        try:
-            if not journal_id and not skip_replication:
-                settings = SIPSimpleSettings()
-                uuid = settings.instance_id
-                time_entry          = datetime.utcnow()
-                date_entry          = datetime.utcnow().date()
-                journal_entry= {
-                    'msgid'               : msgid,
-                    'time'                : time_entry.strftime("%Y-%m-%d %H:%M:%S"),
-                    'date'                : date_entry.strftime("%Y-%m-%d"),
-                    'media_type'          : media_type,
-                    'direction'           : direction,
-                    'local_uri'           : local_uri,
-                    'remote_uri'          : remote_uri,
-                    'cpim_from'           : cpim_from,
-                    'cpim_to'             : cpim_to,
-                    'cpim_timestamp'      : cpim_timestamp,
-                    'body'                : body,
-                    'content_type'        : content_type,
-                    'private'             : private,
-                    'status'              : status,
-                    'call_id'             : call_id,
-                    'encryption'          : encryption
-                }
-
-                notification_center = NotificationCenter()
-                notification_center.post_notification('ChatReplicationJournalEntryAdded', sender=self, data=NotificationData(entry=journal_entry))
-            else:
-                try:
-                    time_entry = datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
-                    date_entry          = time_entry.date()
-                except Exception:
-                    time_entry          = datetime.utcnow()
-                    date_entry          = datetime.utcnow().date()
+        # the message is written later in the db thread together with the other messages added meanwhile, so nothing is returned.
+        # Errors are logged, use add_messages to get a deferred with the result
+        self.write_queue.put(dict(msgid=msgid, media_type=media_type, local_uri=local_uri, remote_uri=remote_uri, direction=direction, cpim_from=cpim_from, cpim_to=cpim_to, cpim_timestamp=cpim_timestamp, body=body, content_type=content_type, private=private, status=status, time=time, uuid=uuid, journal_id=journal_id, skip_replication=skip_replication, call_id=call_id, encryption=encryption))
 
-            if call_id and media_type == 'sms':
-                try:
-                    results = ChatMessage.selectBy(sip_callid=call_id)
-                    message = results.getOne()
-                except SQLObjectNotFound:
-                    pass
+    @run_in_db_thread
+    def add_messages(self, messages):
+        return self._add_messages(messages)
 
-            ChatMessage(
-                          msgid               = msgid,
-                          sip_callid          = call_id,
-                          time                = time_entry,
-                          date                = date_entry,
-                          media_type          = media_type,
-                          direction           = direction,
-                          local_uri           = local_uri,
-                          remote_uri          = remote_uri,
-                          cpim_from           = cpim_from,
-                          cpim_to             = cpim_to,
-                          cpim_timestamp      = cpim_timestamp,
-                          body                = body,
-                          content_type        = content_type,
-                          private             = private,
-                          status              = status,
-                          uuid                = uuid,
-                          journal_id          = journal_id,
-                          encryption          = encryption
-                          )
-            return True
-        except dberrors.DuplicateEntryError:
+    def _add_messages(self, messages):
+        # Caller needs to be in the db thread
+        rows = []
+        journal_entries = []
+        for message in messages:
             try:
-                results = ChatMessage.selectBy(msgid=msgid, local_uri=local_uri, remote_uri=remote_uri)
-                message = results.getOne()
-                if message.status != status:
-                    message.status = status
-
-                if message.journal_id != journal_id:
-                    message.journal_id = journal_id
-
-                return True
+                row, journal_entry = self._message_row(**message)
             except Exception, e:
-                BlinkLogger().log_error(u"Error updating record %s: %s" % (msgid, e))
+                BlinkLogger().log_error(u"Error adding record %s to history table: %s" % (message.get('msgid'), e))
+            else:
+                rows.append(row)
+                if journal_entry is not None:
+                    journal_entries.append(journal_entry)
+        if not rows:
+            return True
+        try:
+            insert_chat_messages(self.db, rows)
         except Exception, e:
-            BlinkLogger().log_error(u"Error adding record %s to history table: %s" % (msgid, e))
-        return False
+            BlinkLogger().log_error(u"Error adding %d records to history table: %s" % (len(rows), e))
+            return False
+        # only messages that were stored are replicated
+        notification_center = NotificationCenter()
+        for journal_entry in journal_entries:
+            notification_center.post_notification('ChatReplicationJournalEntryAdded', sender=self, data=NotificationData(entry=journal_entry))
+        return True
+
+    def _message_row(self, msgid, media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, cpim_timestamp, body, content_type, private, status, time='', uuid='', journal_id='', skip_replication=False, call_id='', encryption=''):
+        if not journal_id and not skip_replication:
+            settings = SIPSimpleSettings()
+            uuid = settings.instance_id
+            time_entry          = datetime.utcnow()
+            date_entry          = datetime.utcnow().date()
+            journal_entry= {
+                'msgid'               : msgid,
+                'time'                : time_entry.strftime("%Y-%m-%d %H:%M:%S"),
+                'date'                : date_entry.strftime("%Y-%m-%d"),
+                'media_type'          : media_type,
+                'direction'           : direction,
+                'local_uri'           : local_uri,
+                'remote_uri'          : remote_uri,
+                'cpim_from'           : cpim_from,
+                'cpim_to'             : cpim_to,
+                'cpim_timestamp'      : cpim_timestamp,
+                'body'                : body,
+                'content_type'        : content_type,
+                'private'             : private,
+                'status'              : status,
+                'call_id'             : call_id,
+                'encryption'          : encryption
+            }
+        else:
+            journal_entry = None
+            try:
+                time_entry = datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
+                date_entry          = time_entry.date()
+            except Exception:
+                time_entry          = datetime.utcnow()
+                date_entry          = datetime.utcnow().date()
+
+        row = (msgid,
+               call_id,
+               format_db_time(time_entry),
+               date_entry.strftime("%Y-%m-%d"),
+               media_type,
+               direction,
+               format_db_text(local_uri),
+               format_db_text(remote_uri),
+               format_db_text(cpim_from),
+               format_db_text(cpim_to),
+               cpim_timestamp,
+               format_db_text(body),
+               content_type,
+               private,
+               status,
+               uuid,
+               journal_id,
+               encryption)
+        return row, journal_entry
 
     @run_in_db_thread
     def update_from_journal_put_results(self, msgid, journal_id):
@@ -642,7 +791,7 @@ class ChatHistory(object):
         if media_type:
             query += " and media_type = %s" % ChatMessage.sqlrepr(media_type)
         if search_text:
-            query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+            query += " and %s" % self._search_text_sql(search_text)
         if after_date:
             query += " and date >= %s" % ChatMessage.sqlrepr(after_date)
         if before_date:
@@ -668,7 +817,7 @@ class ChatHistory(object):
             if media_type:
                 query += " and media_type = %s" % ChatMessage.sqlrepr(media_type)
             if search_text:
-                query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+                query += " and %s" % self._search_text_sql(search_text)
             if after_date:
                 query += " and date >= %s" % ChatMessage.sqlrepr(after_date)
             if before_date:
@@ -682,7 +831,7 @@ class ChatHistory(object):
             if media_type:
                 query += " and media_type = %s" % ChatMessage.sqlrepr(media_type)
             if search_text:
-                query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+                query += " and %s" % self._search_text_sql(search_text)
             if after_date:
                 query += " and date >= %s" % ChatMessage.sqlrepr(after_date)
             if before_date:
@@ -700,7 +849,7 @@ class ChatHistory(object):
             if media_type:
                 query += " and media_type = %s" % ChatMessage.sqlrepr(media_type)
             if search_text:
-                query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+                query += " and %s" % self._search_text_sql(search_text)
             if after_date:
                 query += " and date >= %s" % ChatMessage.sqlrepr(after_date)
             if before_date:
@@ -750,7 +899,7 @@ class ChatHistory(object):
             media_type_sql = media_type_sql.lstrip("(")
             query += " and media_type in (%s)" % media_type_sql
         if search_text:
-            query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+            query += " and %s" % self._search_text_sql(search_text)
         if date:
             query += " and date like %s" % ChatMessage.sqlrepr(date+'%')
         if after_date:
@@ -768,6 +917,93 @@ class ChatHistory(object):
     def get_messages(self, msgid=None, call_id=None, local_uri=None, remote_uri=None, media_type=None, date=None, after_date=None, before_date=None, search_text=None, orderBy='time', orderType='desc', count=100):
         return block_on(self._get_messages(msgid, call_id, local_uri, remote_uri, media_type, date, after_date, before_date, search_text, orderBy, orderType, count))
 
+    @run_in_db_thread
+    def _get_messages_page(self, local_uri, remote_uri, media_type, date, after_date, before_date, search_text, before, page_size):
+        query = "select %s from chat_messages where 1=1" % ', '.join(ChatMessageRow._fields)
+        if local_uri:
+            query += " and local_uri=%s" % ChatMessage.sqlrepr(local_uri)
+        if remote_uri:
+            if isinstance(remote_uri, basestring):
+                remote_uri = (remote_uri,)
+            query += " and remote_uri in (%s)" % ','.join(ChatMessage.sqlrepr(uri) for uri in remote_uri)
+        if media_type:
+            if isinstance(media_type, basestring):
+                media_type = (media_type,)
+            query += " and media_type in (%s)" % ','.join(ChatMessage.sqlrepr(media) for media in media_type)
+        if search_text:
+            query += " and %s" % self._search_text_sql(search_text)
+        if date:
+            query += " and date like %s" % ChatMessage.sqlrepr(date+'%')
+        if after_date:
+            query += " and date >= %s" % ChatMessage.sqlrepr(after_date)
+        if before_date:
+            query += " and date < %s" % ChatMessage.sqlrepr(before_date)
+        if before is not None:
+            time, id = before
+            time = ChatMessage.sqlrepr(format_db_time(time))
+            query += " and (time < %s or (time = %s and id < %d))" % (time, time, id)
+        query += " order by time desc, id desc limit %d" % page_size
+
+        try:
+            rows = self.db.queryAll(query)
+        except Exception, e:
+            BlinkLogger().log_error(u"Error getting chat messages from chat history table: %s" % e)
+            return []
+
+        messages = []
+        for row in rows:
+            row = list(row)
+            # raw rows bypass SQLObject, decode the UnicodeCol columns ourselves
+            for index in (6, 7, 8, 9, 11):
+                row[index] = format_db_text(row[index])
+            try:
+                row[4] = datetime.strptime(str(row[4])[:10], "%Y-%m-%d").date()
+            except ValueError:
+                row[4] = None
+            messages.append(ChatMessageRow(*row))
+        return messages
+
+    def iter_messages(self, local_uri=None, remote_uri=None, media_type=None, date=None, after_date=None, before_date=None, search_text=None, before=None, page_size=100):
+        # yields messages newest first, fetching page_size rows at a time older than the (time, id) cursor given in before
+        while True:
+            messages = block_on(self._get_messages_page(local_uri, remote_uri, media_type, date, after_date, before_date, search_text, before, page_size))
+            for message in messages:
+                yield message
+            if len(messages) < page_size:
+                break
+            before = (messages[-1].time, messages[-1].id)
+
+    @run_in_db_thread
+    def _search_messages(self, search_text, local_uri, remote_uri, media_type, count):
+        where = ''
+        if local_uri:
+            where += " and chat_messages.local_uri=%s" % ChatMessage.sqlrepr(local_uri)
+        if remote_uri:
+            where += " and chat_messages.remote_uri in (%s)" % ','.join(ChatMessage.sqlrepr(uri) for uri in remote_uri)
+        if media_type:
+            where += " and chat_messages.media_type=%s" % ChatMessage.sqlrepr(media_type)
+
+        match = self._search_match(search_text)
+        if match is not None:
+            query = "select chat_messages.id, snippet(chat_messages_fts, 0, '<b>', '</b>', '...', 16) from chat_messages_fts join chat_messages on chat_messages.id = chat_messages_fts.rowid"
+            query += " where chat_messages_fts match %s%s order by rank limit %d" % (ChatMessage.sqlrepr(match), where, count)
+        else:
+            query = "select id, NULL from chat_messages where body like %s%s order by time desc limit %d" % (ChatMessage.sqlrepr('%'+search_text+'%'), where, count)
+
+        try:
+            rows = list(self.db.queryAll(query))
+            if not rows:
+                return []
+            messages = dict((message.id, message) for message in ChatMessage.select("id in (%s)" % ','.join(str(row[0]) for row in rows)))
+        except Exception, e:
+            BlinkLogger().log_error(u"Error searching chat messages in chat history table: %s" % e)
+            return []
+        return [(messages[id], snippet) for id, snippet in rows if id in messages]
+
+    def search_messages(self, search_text, local_uri=None, remote_uri=None, media_type=None, count=100):
+        # returns (message, snippet) tuples ordered by relevance, without snippets when full text search is not available
+        return block_on(self._search_messages(search_text, local_uri, remote_uri, media_type, count))
+
     @run_in_db_thread
     def delete_journaled_messages(self, account, journal_ids, after_date):
         # TODO
@@ -1007,7 +1243,7 @@ class SessionHistoryReplicator(object):
             'authRequestCount': 0,
             'timer': timer,
             'url': url,
-            'data': ''
+            'parser': JSONStreamDecoder(('received', 'placed'))
         }
         self.updateGetCallsTimer_(None)
 
@@ -1045,7 +1281,7 @@ class SessionHistoryReplicator(object):
                     connection.cancel()
                 request = NSURLRequest.requestWithURL_cachePolicy_timeoutInterval_(nsurl, NSURLRequestReloadIgnoringLocalAndRemoteCacheData, 15)
                 connection = NSURLConnection.alloc().initWithRequest_delegate_(request, self)
-                self.last_calls_connections[key]['data'] = ''
+                self.last_calls_connections[key]['parser'] = JSONStreamDecoder(('received', 'placed'))
                 self.last_calls_connections[key]['authRequestCount'] = 0
                 self.last_calls_connections[key]['connection'] = connection
 
@@ -1061,7 +1297,20 @@ class SessionHistoryReplicator(object):
             except KeyError:
                 pass
             else:
-                self.last_calls_connections[key]['data'] = self.last_calls_connections[key]['data'] + str(data)
+                try:
+                    events = self.last_calls_connections[key]['parser'].feed(str(data))
+                except (ValueError, cjson.DecodeError):
+                    BlinkLogger().log_debug(u"Failed to parse calls history for %s from %s" % (key, self.last_calls_connections[key]['url']))
+                    self.last_calls_connections[key]['connection'].cancel()
+                    self.last_calls_connections[key]['connection'] = None
+                    return
+
+                calls = {}
+                for direction, call, is_item in events:
+                    if is_item:
+                        calls.setdefault(direction, []).append(call)
+                if calls:
+                    self.syncServerHistoryWithLocalHistory(account, calls)
 
     def connectionDidFinishLoading_(self, connection):
         try:
@@ -1076,11 +1325,9 @@ class SessionHistoryReplicator(object):
                 pass
             else:
                 try:
-                    calls = cjson.decode(self.last_calls_connections[key]['data'])
-                except (TypeError, cjson.DecodeError):
+                    self.last_calls_connections[key]['parser'].close()
+                except ValueError:
                     BlinkLogger().log_debug(u"Failed to parse calls history for %s from %s" % (key, self.last_calls_connections[key]['url']))
-                else:
-                    self.syncServerHistoryWithLocalHistory(account, calls)
 
     # NSURLConnection delegate method
     def connection_didFailWithError_(self, connection, error):
@@ -1095,162 +1342,138 @@ class SessionHistoryReplicator(object):
         if calls is None:
             return
 
-        notification_center = NotificationCenter()
-        growl_notifications = {}
-        try:
-            if calls['received']:
-                for call in calls['received']:
-                    direction = 'incoming'
-                    local_entry = SessionHistory().get_entries(direction=direction, count=1, call_id=call['sessionId'], from_tag=call['fromTag'])
-                    if not len(local_entry):
-                        id=str(uuid1())
-                        participants = ""
-                        focus = "0"
-                        local_uri = str(account.id)
-                        try:
-                            remote_uri, display_name, full_uri, fancy_uri = sipuri_components_from_string(call['remoteParty'])
-                            status = call['status']
-                            duration = call['duration']
-                            call_id = call['sessionId']
-                            from_tag = call['fromTag']
-                            to_tag = call['toTag']
-                            startTime = call['startTime']
-                            stopTime = call['stopTime']
-                            media = call['media']
-                        except KeyError:
-                            continue
+        server_calls = []
+        for direction, key in (('incoming', 'received'), ('outgoing', 'placed')):
+            try:
+                direction_calls = calls[key] or []
+            except (KeyError, TypeError):
+                continue
+            for call in direction_calls:
+                try:
+                    remote_uri, display_name, full_uri, fancy_uri = sipuri_components_from_string(call['remoteParty'])
+                    status = call['status']
+                    duration = call['duration']
+                    call_id = call['sessionId']
+                    from_tag = call['fromTag']
+                    to_tag = call['toTag']
+                    startTime = call['startTime']
+                    stopTime = call['stopTime']
+                    media = call['media']
+                except (KeyError, TypeError):
+                    continue
+
+                try:
+                    start_time = datetime.strptime(startTime, "%Y-%m-%d  %H:%M:%S")
+                except (TypeError, ValueError):
+                    continue
 
-                        media_type = ", ".join(media) or 'audio'
+                try:
+                    end_time = datetime.strptime(stopTime, "%Y-%m-%d  %H:%M:%S")
+                except (TypeError, ValueError):
+                    end_time = start_time
 
-                        try:
-                            start_time = datetime.strptime(startTime, "%Y-%m-%d  %H:%M:%S")
-                        except (TypeError, ValueError):
-                            continue
+                server_calls.append((direction, remote_uri, status, duration, call_id, from_tag, to_tag, start_time, end_time, media))
 
-                        try:
-                            end_time = datetime.strptime(stopTime, "%Y-%m-%d  %H:%M:%S")
-                        except (TypeError, ValueError):
-                            end_time = start_time
-
-                        success = 'completed' if duration > 0 else 'missed'
-
-                        BlinkLogger().log_debug(u"Adding incoming %s call %s at %s from %s from server history" % (success, call_id, start_time, remote_uri))
-                        self.sessionControllersManager.add_to_history(id, media_type, direction, success, status, start_time, end_time, duration, local_uri, remote_uri, focus, participants, call_id, from_tag, to_tag, '')
-                        if 'audio' in media:
-                            direction = 'incoming'
-                            status = 'delivered'
-                            cpim_from = remote_uri
-                            cpim_to = local_uri
-                            timestamp = str(ISOTimestamp.now())
-                            if success == 'missed':
-                                message = '<h3>Missed Incoming Audio Call</h3>'
-                                #message += '<h4>Technicall Information</h4><table class=table_session_info><tr><td class=td_session_info>Call Id</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>From Tag</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>To Tag</td><td class=td_session_info>%s</td></tr></table>' % (call_id, from_tag, to_tag)
-                                media_type = 'missed-call'
-                            else:
-                                duration = self.sessionControllersManager.get_printed_duration(start_time, end_time)
-                                message = '<h3>Incoming Audio Call</h3>'
-                                message += '<p>The call has been answered elsewhere'
-                                message += '<p>Call duration: %s' % duration
-                                #message += '<h4>Technicall Information</h4><table class=table_session_info><tr><td class=td_session_info>Call Id</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>From Tag</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>To Tag</td><td class=td_session_info>%s</td></tr></table>' % (call_id, from_tag, to_tag)
-                                media_type = 'audio'
-                            self.sessionControllersManager.add_to_chat_history(id, media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, status, skip_replication=True)
-                            notification_center.post_notification('AudioCallLoggedToHistory', sender=self, data=NotificationData(direction=direction, history_entry=False, remote_party=remote_uri, local_party=local_uri, check_contact=True, missed=bool(media_type =='missed-call')))
-
-                        if 'audio' in call['media'] and success == 'missed' and remote_uri not in growl_notifications.keys():
-                            now = datetime(*time.localtime()[:6])
-                            elapsed = now - start_time
-                            elapsed_hours = elapsed.days * 24 + elapsed.seconds / (60*60)
-                            if elapsed_hours < 48:
-                                growl_data = NotificationData()
-                                try:
-                                    uri = SIPURI.parse('sip:'+str(remote_uri))
-                                except Exception:
-                                    pass
-                                else:
-                                    growl_data.caller = format_identity_to_string(uri, check_contact=True, format='compact')
-                                    growl_data.timestamp = start_time
-                                    growl_data.streams = media_type
-                                    growl_data.account = str(account.id)
-                                    notification_center.post_notification("GrowlMissedCall", sender=self, data=growl_data)
-                                    growl_notifications[remote_uri] = True
-
-                                    nc_title = 'Missed Call (' + media_type  + ')'
-                                    nc_subtitle = 'From %s' % format_identity_to_string(uri, check_contact=True, format='full')
-                                    nc_body = 'Missed call at %s' % start_time.strftime("%Y-%m-%d %H:%M")
-                                    NSApp.delegate().gui_notify(nc_title, nc_body, nc_subtitle)
+        if not server_calls:
+            return
 
-        except (KeyError, ValueError):
-            pass
-        except Exception, e:
-            BlinkLogger().log_error(u"Error: %s" % e)
+        known_calls = SessionHistory().get_known_calls((call[0], call[4], call[5]) for call in server_calls)
+        if known_calls is None:
+            return
 
+        entries = []
+        messages = []
+        notifications = []
+        growl_notifications = {}
+        local_uri = str(account.id)
         try:
-            if calls['placed']:
-                for call in calls['placed']:
-                    direction = 'outgoing'
-                    local_entry = SessionHistory().get_entries(direction=direction, count=1, call_id=call['sessionId'], from_tag=call['fromTag'])
-                    if not len(local_entry):
-                        id=str(uuid1())
-                        participants = ""
-                        focus = "0"
-                        local_uri = str(account.id)
-                        try:
-                            remote_uri, display_name, full_uri, fancy_uri = sipuri_components_from_string(call['remoteParty'])
-                            status = call['status']
-                            duration = call['duration']
-                            call_id = call['sessionId']
-                            from_tag = call['fromTag']
-                            to_tag = call['toTag']
-                            startTime = call['startTime']
-                            stopTime = call['stopTime']
-                            media = call['media']
-                        except KeyError:
-                            continue
+            for direction, remote_uri, status, duration, call_id, from_tag, to_tag, start_time, end_time, media in server_calls:
+                if (direction, call_id, from_tag) in known_calls:
+                    continue
+                known_calls.add((direction, call_id, from_tag))
 
-                        media_type = ", ".join(media) or 'audio'
+                id = str(uuid1())
+                media_type = ", ".join(media) or 'audio'
 
-                        try:
-                            start_time = datetime.strptime(startTime, "%Y-%m-%d  %H:%M:%S")
-                        except (TypeError, ValueError):
-                            continue
+                if direction == 'incoming':
+                    success = 'completed' if duration > 0 else 'missed'
+                    BlinkLogger().log_debug(u"Adding incoming %s call %s at %s from %s from server history" % (success, call_id, start_time, remote_uri))
+                else:
+                    if duration > 0:
+                        success = 'completed'
+                    else:
+                        success = 'cancelled' if status == "487" else 'failed'
+                    BlinkLogger().log_debug(u"Adding outgoing %s call %s at %s to %s from server history" % (success, call_id, start_time, remote_uri))
 
-                        try:
-                            end_time = datetime.strptime(stopTime, "%Y-%m-%d  %H:%M:%S")
-                        except (TypeError, ValueError):
-                            end_time = start_time
+                entries.append(dict(session_id=id, media_type=media_type, direction=direction, status=success, failure_reason=status, start_time=start_time, end_time=end_time, duration=duration, local_uri=local_uri, remote_uri=remote_uri, remote_focus="0", participants="", call_id=call_id, from_tag=from_tag, to_tag=to_tag, am_filename=''))
 
-                        if duration > 0:
-                            success = 'completed'
+                if 'audio' in media:
+                    if direction == 'incoming':
+                        if success == 'missed':
+                            message = '<h3>Missed Incoming Audio Call</h3>'
+                            #message += '<h4>Technicall Information</h4><table class=table_session_info><tr><td class=td_session_info>Call Id</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>From Tag</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>To Tag</td><td class=td_session_info>%s</td></tr></table>' % (call_id, from_tag, to_tag)
+                            message_media_type = 'missed-call'
                         else:
-                            success = 'cancelled' if status == "487" else 'failed'
-
-                        BlinkLogger().log_debug(u"Adding outgoing %s call %s at %s to %s from server history" % (success, call_id, start_time, remote_uri))
-                        self.sessionControllersManager.add_to_history(id, media_type, direction, success, status, start_time, end_time, duration, local_uri, remote_uri, focus, participants, call_id, from_tag, to_tag, '')
-                        if 'audio' in media:
-                            local_uri = local_uri
-                            remote_uri = remote_uri
-                            direction = 'incoming'
-                            status = 'delivered'
-                            cpim_from = remote_uri
-                            cpim_to = local_uri
-                            timestamp = str(ISOTimestamp.now())
-                            media_type = 'audio'
-                            if success == 'failed':
-                                message = '<h3>Failed Outgoing Audio Call</h3>'
-                                message += '<p>Reason: %s' % status
-                            elif success == 'cancelled':
-                                message= '<h3>Cancelled Outgoing Audio Call</h3>'
-                            else:
-                                duration = self.sessionControllersManager.get_printed_duration(start_time, end_time)
-                                message= '<h3>Outgoing Audio Call</h3>'
-                                message += '<p>Call duration: %s' % duration
-                            self.sessionControllersManager.add_to_chat_history(id, media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, status, skip_replication=True)
-                            NotificationCenter().post_notification('AudioCallLoggedToHistory', sender=self, data=NotificationData(direction='outgoing', history_entry=False, remote_party=remote_uri, local_party=local_uri, check_contact=True, missed=False))
+                            printed_duration = self.sessionControllersManager.get_printed_duration(start_time, end_time)
+                            message = '<h3>Incoming Audio Call</h3>'
+                            message += '<p>The call has been answered elsewhere'
+                            message += '<p>Call duration: %s' % printed_duration
+                            #message += '<h4>Technicall Information</h4><table class=table_session_info><tr><td class=td_session_info>Call Id</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>From Tag</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>To Tag</td><td class=td_session_info>%s</td></tr></table>' % (call_id, from_tag, to_tag)
+                            message_media_type = 'audio'
+                        notifications.append(NotificationData(direction=direction, history_entry=False, remote_party=remote_uri, local_party=local_uri, check_contact=True, missed=bool(message_media_type =='missed-call')))
+                    else:
+                        message_media_type = 'audio'
+                        if success == 'failed':
+                            message = '<h3>Failed Outgoing Audio Call</h3>'
+                            message += '<p>Reason: %s' % status
+                        elif success == 'cancelled':
+                            message= '<h3>Cancelled Outgoing Audio Call</h3>'
+                        else:
+                            printed_duration = self.sessionControllersManager.get_printed_duration(start_time, end_time)
+                            message= '<h3>Outgoing Audio Call</h3>'
+                            message += '<p>Call duration: %s' % printed_duration
+                        notifications.append(NotificationData(direction='outgoing', history_entry=False, remote_party=remote_uri, local_party=local_uri, check_contact=True, missed=False))
+                    messages.append(dict(msgid=id, media_type=message_media_type, local_uri=local_uri, remote_uri=remote_uri, direction='incoming', cpim_from=remote_uri, cpim_to=local_uri, cpim_timestamp=str(ISOTimestamp.now()), body=message, content_type="html", private="0", status='delivered', skip_replication=True))
+
+                if direction == 'incoming' and 'audio' in media and success == 'missed' and remote_uri not in growl_notifications.keys():
+                    now = datetime(*time.localtime()[:6])
+                    elapsed = now - start_time
+                    elapsed_hours = elapsed.days * 24 + elapsed.seconds / (60*60)
+                    if elapsed_hours < 48:
+                        try:
+                            uri = SIPURI.parse('sip:'+str(remote_uri))
+                        except Exception:
+                            pass
+                        else:
+                            growl_notifications[remote_uri] = (uri, start_time, media_type)
         except (KeyError, ValueError):
             pass
         except Exception, e:
             BlinkLogger().log_error(u"Error: %s" % e)
 
+        # all missing calls are stored at once, each table in a single transaction
+        if entries and not block_on(SessionHistory().add_entries(entries)):
+            return
+        if messages:
+            block_on(ChatHistory().add_messages(messages))
+
+        notification_center = NotificationCenter()
+        for notification_data in notifications:
+            notification_center.post_notification('AudioCallLoggedToHistory', sender=self, data=notification_data)
+
+        for uri, start_time, media_type in growl_notifications.itervalues():
+            growl_data = NotificationData()
+            growl_data.caller = format_identity_to_string(uri, check_contact=True, format='compact')
+            growl_data.timestamp = start_time
+            growl_data.streams = media_type
+            growl_data.account = str(account.id)
+            notification_center.post_notification("GrowlMissedCall", sender=self, data=growl_data)
+
+            nc_title = 'Missed Call (' + media_type  + ')'
+            nc_subtitle = 'From %s' % format_identity_to_string(uri, check_contact=True, format='full')
+            nc_body = 'Missed call at %s' % start_time.strftime("%Y-%m-%d %H:%M")
+            NSApp.delegate().gui_notify(nc_title, nc_body, nc_subtitle)
+
     # NSURLConnection delegate method
     def connection_didReceiveAuthenticationChallenge_(self, connection, challenge):
         try:
@@ -1273,6 +1496,66 @@ class SessionHistoryReplicator(object):
                     challenge.sender().useCredential_forAuthenticationChallenge_(credential, challenge)
 
 
+class ChatReplicationJournalEntry(SQLObject):
+    class sqlmeta:
+        table = 'chat_replication_journal'
+    account           = UnicodeCol(length=128)
+    action            = StringCol()
+    entry_id          = StringCol()
+    data              = UnicodeCol(sqlType='LONGTEXT')
+    entry_idx         = DatabaseIndex('account', 'action', 'entry_id', unique=True)
+
+
+class ChatReplicationJournal(object):
+    """Durable queue of the chat journal entries waiting to be pushed to or deleted from the replication server"""
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        path = ApplicationData.get('history')
+        makedirs(path)
+        db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
+        self._initialize(db_uri)
+
+    @run_in_db_thread
+    def _initialize(self, db_uri):
+        self.db = connectionForURI(db_uri)
+        ChatReplicationJournalEntry._connection = self.db
+        try:
+            ChatReplicationJournalEntry.createTable(ifNotExists=True)
+        except Exception, e:
+            BlinkLogger().log_error(u"Error checking table %s: %s" % (ChatReplicationJournalEntry.sqlmeta.table, e))
+
+    @run_in_db_thread
+    def add_entries(self, entries):
+        # entries are (account, action, entry_id, data) tuples, action being 'put' or 'delete'
+        query = "INSERT OR REPLACE INTO chat_replication_journal (account, action, entry_id, data) VALUES (?, ?, ?, ?)"
+        try:
+            execute_batch(self.db, [(query, [(format_db_text(account), action, entry_id, format_db_text(data)) for account, action, entry_id, data in entries])])
+        except Exception, e:
+            BlinkLogger().log_error(u"Error adding %d entries to chat replication journal: %s" % (len(entries), e))
+            return False
+        return True
+
+    @run_in_db_thread
+    def remove_entries(self, account, action, entry_ids):
+        query = "DELETE FROM chat_replication_journal WHERE account = ? AND action = ? AND entry_id = ?"
+        try:
+            execute_batch(self.db, [(query, [(format_db_text(account), action, entry_id) for entry_id in entry_ids])])
+        except Exception, e:
+            BlinkLogger().log_error(u"Error removing %d entries from chat replication journal: %s" % (len(entry_ids), e))
+
+    @run_in_db_thread
+    def _get_entries(self):
+        try:
+            return list(self.db.queryAll("SELECT account, action, entry_id, data FROM chat_replication_journal ORDER BY id"))
+        except Exception, e:
+            BlinkLogger().log_error(u"Error reading chat replication journal: %s" % e)
+            return []
+
+    def get_entries(self):
+        return block_on(self._get_entries())
+
+
 class ChatHistoryReplicator(object):
     __metaclass__ = Singleton
     implements(IObserver)
@@ -1289,6 +1572,18 @@ class ChatHistoryReplicator(object):
     paused = False
     debug = False
     sync_counter = {}
+    push_retry_time = {}
+    push_failures = {}
+
+    # journal entries are pushed in batches bounded by number of entries and encoded size,
+    # at most push_window batches per account are in flight at the same time
+    push_batch_entries = 100
+    push_batch_size = 256 * 1024
+    push_window = 2
+    push_max_backoff = 3600
+
+    # number of incoming journal entries applied to the local history at once while the journal is being received
+    incoming_batch_entries = 500
 
     def __init__(self):
         BlinkLogger().log_debug('Starting Chat History Replicator')
@@ -1340,17 +1635,30 @@ class ChatHistoryReplicator(object):
             except shutil.Error:
                 pass
 
+        self.journal = ChatReplicationJournal()
+
+        # journals of older versions were pickled when quitting, move their entries into the journal table
+        legacy_entries = []
         try:
             with open(ApplicationData.get('chat_replication/chat_replication_journal.pickle'), 'r') as f:
-                self.outgoing_entries = cPickle.load(f)
+                outgoing_entries = cPickle.load(f)
         except Exception:
             pass
+        else:
+            for account, entries in outgoing_entries.iteritems():
+                legacy_entries.extend((account, 'put', entry['id'], entry['data']) for entry in entries.itervalues())
 
         try:
             with open(ApplicationData.get('chat_replication/chat_replication_delete_journal.pickle'), 'r') as f:
-                self.for_delete_entries = cPickle.load(f)
+                for_delete_entries = cPickle.load(f)
         except Exception:
             pass
+        else:
+            for account, journal_ids in for_delete_entries.iteritems():
+                legacy_entries.extend((account, 'delete', journal_id, '') for journal_id in journal_ids)
+
+        if legacy_entries:
+            self.journal.add_entries(legacy_entries).addCallback(self._remove_legacy_journal)
 
         try:
             with open(ApplicationData.get('chat_replication/chat_replication_timestamp.pickle'), 'r') as f:
@@ -1358,29 +1666,37 @@ class ChatHistoryReplicator(object):
         except Exception:
             pass
 
+        self.load_journal()
+
         self.timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(80.0, self, "updateTimer:", None, True)
         NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSRunLoopCommonModes)
         NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSEventTrackingRunLoopMode)
 
-    def save_delete_journal_on_disk(self):
-        storage_path = ApplicationData.get('chat_replication/chat_replication_delete_journal.pickle')
-        try:
-            cPickle.dump(self.for_delete_entries, open(storage_path, "w+"))
-        except (cPickle.PickleError, IOError):
-            pass
+    def _remove_legacy_journal(self, success):
+        if not success:
+            return
+        for name in ('chat_replication_journal.pickle', 'chat_replication_delete_journal.pickle'):
+            try:
+                os.unlink(ApplicationData.get('chat_replication/%s' % name))
+            except OSError:
+                pass
 
-    def save_journal_on_disk(self):
-        storage_path = ApplicationData.get('chat_replication/chat_replication_journal.pickle')
-        try:
-            cPickle.dump(self.outgoing_entries, open(storage_path, "w+"))
-        except (cPickle.PickleError, IOError):
-            pass
+    @run_in_green_thread
+    def load_journal(self):
+        for account, action, entry_id, data in self.journal.get_entries():
+            if action == 'put':
+                self.outgoing_entries.setdefault(account, {})[entry_id] = {'data': data, 'id': entry_id}
+            elif action == 'delete':
+                self.for_delete_entries.setdefault(account, set()).add(entry_id)
 
     def save_journal_timestamp_on_disk(self):
         storage_path = ApplicationData.get('chat_replication/chat_replication_timestamp.pickle')
+        # write a new file and move it in place so that a crash while saving does not lose the previous timestamps
         try:
-            cPickle.dump(self.last_journal_timestamp, open(storage_path, "w+"))
-        except (cPickle.PickleError, IOError):
+            with open(storage_path + '.tmp', 'w') as f:
+                cPickle.dump(self.last_journal_timestamp, f)
+            os.rename(storage_path + '.tmp', storage_path)
+        except (cPickle.PickleError, IOError, OSError):
             pass
 
     @allocate_autorelease_pool
@@ -1389,8 +1705,6 @@ class ChatHistoryReplicator(object):
         handler(notification.sender, notification.data)
 
     def _NH_BlinkWillTerminate(self, sender, data):
-        self.save_journal_on_disk()
-        self.save_delete_journal_on_disk()
         self.save_journal_timestamp_on_disk()
 
     def _NH_SystemWillSleep(self, sender, data):
@@ -1404,6 +1718,7 @@ class ChatHistoryReplicator(object):
         self.updateTimer_(None)
 
     def _NH_ChatReplicationJournalEntryDeleted(self, sender, data):
+        journal_entries = []
         for entry in data.entries:
             journal_id = entry[0]
             account = entry[1]
@@ -1418,6 +1733,10 @@ class ChatHistoryReplicator(object):
                 self.for_delete_entries.setdefault(account, set())
                 self.for_delete_entries[account].add(journal_id)
                 BlinkLogger().log_debug(u"Scheduling deletion of chat journal id %s for account %s" % (journal_id, account))
+                journal_entries.append((account, 'delete', journal_id, ''))
+
+        if journal_entries:
+            self.journal.add_entries(journal_entries)
 
     def _NH_ChatReplicationJournalEntryAdded(self, sender, data):
         try:
@@ -1453,6 +1772,7 @@ class ChatHistoryReplicator(object):
                 self.outgoing_entries[account][data.entry['msgid']] = {'data': entry,
                                                                        'id'   : data.entry['msgid']
                                                                       }
+                self.journal.add_entries([(account, 'put', data.entry['msgid'], entry)])
 
     def _NH_CFGSettingsObjectDidChange(self, sender, data):
         if isinstance(sender, Account) and sender.enabled:
@@ -1480,7 +1800,7 @@ class ChatHistoryReplicator(object):
         except KeyError:
             BlinkLogger().log_debug(u"Invalid answer from chat history server")
             self.disableReplication(account, 'Invalid server answer')
-            return
+            return False
 
         if not success:
             try:
@@ -1490,14 +1810,14 @@ class ChatHistoryReplicator(object):
                 self.disableReplication(account)
             else:
                 self.disableReplication(account, journal['error_message'])
-            return
+            return False
 
         try:
             results = journal['results']
         except KeyError:
             BlinkLogger().log_debug(u"No outgoing results returned by chat history server push of %s" % account)
             #self.disableReplication(account, 'No results')
-            return
+            return True
 
         for entry in results:
             try:
@@ -1509,63 +1829,11 @@ class ChatHistoryReplicator(object):
                 BlinkLogger().log_debug(u"Update local chat history message %s with remote journal id %s" % (msgid, journal_id))
                 ChatHistory().update_from_journal_put_results(msgid, journal_id)
 
+        return True
+
     @run_in_green_thread
     @allocate_autorelease_pool
-    def addLocalHistoryFromRemoteJournalEntries(self, journal, account):
-        try:
-            counter = self.sync_counter[account]
-        except KeyError:
-            self.sync_counter[account] = 1
-        else:
-            self.sync_counter[account] += 1
-
-        try:
-            success = journal['success']
-        except KeyError:
-            BlinkLogger().log_debug(u"Invalid answer from chat history server of %s" % account)
-            self.disableReplication(account, 'Invalid answer')
-            return
-
-        if not success:
-            try:
-                BlinkLogger().log_debug(u"Error from chat history server of %s: %s" % (account, journal['error_message']))
-            except KeyError:
-                BlinkLogger().log_debug(u"Unknown error from chat history server of %s" % account)
-                self.disableReplication(account)
-            else:
-                self.disableReplication(account, journal['error_message'])
-            return
-
-        try:
-            results = journal['summary']
-        except KeyError:
-            pass
-        else:
-            try:
-                first_row = results[0]
-                last_row = results[-1]
-            except IndexError:
-                pass
-            else:
-                self.replication_server_summary[account] = results
-                oldest = datetime.fromtimestamp(int(first_row['timestamp'])).strftime('%Y-%m-%d %H:%M:%S')
-                BlinkLogger().log_debug(u"Account %s has %d messages on chat history server since %s" % (account, len(results), oldest))
-                try:
-                    journal_ids = (result['journal_id'] for result in results)
-                except KeyError:
-                    pass
-                else:
-                    ChatHistory().delete_journaled_messages(str(account), journal_ids, oldest)
-
-        try:
-            results = journal['results']
-        except KeyError:
-            BlinkLogger().log_debug(u"No incoming results returned by chat history server of %s" % account)
-            #self.disableReplication(account, 'No results')
-            return
-        else:
-            BlinkLogger().log_debug(u"Received %s results from chat history server of %s" % (len(results) or 'no new', account))
-
+    def addLocalHistoryFromRemoteJournalEntries(self, results, account, notify=False):
         replication_password = None
         try:
             acc = AccountManager().get_account(account)
@@ -1579,6 +1847,7 @@ class ChatHistoryReplicator(object):
             return
 
         notify_data = {}
+        messages = []
         for entry in results:
             try:
                 data           = entry['data']
@@ -1597,6 +1866,8 @@ class ChatHistoryReplicator(object):
             except KeyError:
                 BlinkLogger().log_debug(u"Failed to parse chat history server results for %s" % account)
                 self.disableReplication(account)
+                if messages:
+                    ChatHistory().add_messages(messages)
                 return
 
             if replication_password:
@@ -1625,7 +1896,7 @@ class ChatHistoryReplicator(object):
                     except KeyError:
                         data['encryption'] = ''
 
-                    ChatHistory().add_message(data['msgid'], data['media_type'], data['local_uri'], data['remote_uri'], data['direction'], data['cpim_from'], data['cpim_to'], data['cpim_timestamp'], data['body'], data['content_type'], data['private'], data['status'], time=data['time'], uuid=uuid, journal_id=journal_id, call_id=data['call_id'], encryption=data['encryption'])
+                    messages.append(dict(msgid=data['msgid'], media_type=data['media_type'], local_uri=data['local_uri'], remote_uri=data['remote_uri'], direction=data['direction'], cpim_from=data['cpim_from'], cpim_to=data['cpim_to'], cpim_timestamp=data['cpim_timestamp'], body=data['body'], content_type=data['content_type'], private=data['private'], status=data['status'], time=data['time'], uuid=uuid, journal_id=journal_id, call_id=data['call_id'], encryption=data['encryption']))
                     now = datetime(*time.localtime()[:6])
                     start_time = datetime.strptime(data['time'], "%Y-%m-%d %H:%M:%S")
                     elapsed = now - start_time
@@ -1638,7 +1909,7 @@ class ChatHistoryReplicator(object):
                         else:
                             notify_data[data['remote_uri']] += 1
 
-                        if data['media_type'] == 'chat' and self.sync_counter[account] > 1:
+                        if data['media_type'] == 'chat' and notify:
                             notification_data = NotificationData()
                             notification_data.chat_message = data
                             NotificationCenter().post_notification('ChatReplicationJournalEntryReceived', sender=self, data=notification_data)
@@ -1650,13 +1921,62 @@ class ChatHistoryReplicator(object):
 
                 except KeyError:
                     BlinkLogger().log_debug(u"Failed to apply chat history server journal to local chat history database for %s" % account)
+                    if messages:
+                        ChatHistory().add_messages(messages)
                     return
 
-        if notify_data:
-            for key in notify_data.keys():
-                log_text = '%d new chat messages for %s retrieved from chat history server' % (notify_data[key], key)
-                BlinkLogger().log_debug(log_text)
+        if messages:
+            ChatHistory().add_messages(messages)
+
+        for key in notify_data.keys():
+            log_text = '%d new chat messages for %s retrieved from chat history server' % (notify_data[key], key)
+            BlinkLogger().log_debug(log_text)
+
+    @run_in_green_thread
+    @allocate_autorelease_pool
+    def finishIncomingReplication(self, journal, summary, count, account):
+        try:
+            counter = self.sync_counter[account]
+        except KeyError:
+            self.sync_counter[account] = 1
         else:
+            self.sync_counter[account] += 1
+
+        try:
+            success = journal['success']
+        except KeyError:
+            BlinkLogger().log_debug(u"Invalid answer from chat history server of %s" % account)
+            self.disableReplication(account, 'Invalid answer')
+            return
+
+        if not success:
+            try:
+                BlinkLogger().log_debug(u"Error from chat history server of %s: %s" % (account, journal['error_message']))
+            except KeyError:
+                BlinkLogger().log_debug(u"Unknown error from chat history server of %s" % account)
+                self.disableReplication(account)
+            else:
+                self.disableReplication(account, journal['error_message'])
+            return
+
+        try:
+            first_row = summary[0]
+            last_row = summary[-1]
+        except IndexError:
+            pass
+        else:
+            self.replication_server_summary[account] = summary
+            oldest = datetime.fromtimestamp(int(first_row['timestamp'])).strftime('%Y-%m-%d %H:%M:%S')
+            BlinkLogger().log_debug(u"Account %s has %d messages on chat history server since %s" % (account, len(summary), oldest))
+            try:
+                journal_ids = (result['journal_id'] for result in summary)
+            except KeyError:
+                pass
+            else:
+                ChatHistory().delete_journaled_messages(str(account), journal_ids, oldest)
+
+        BlinkLogger().log_debug(u"Received %s results from chat history server of %s" % (count or 'no new', account))
+        if not count:
             BlinkLogger().log_debug('Local chat history is in sync with chat history server for %s' % account)
 
     @allocate_autorelease_pool
@@ -1666,35 +1986,8 @@ class ChatHistoryReplicator(object):
             return
         accounts = (account for account in AccountManager().iter_accounts() if account is not BonjourAccount() and account.enabled and not account.chat.disable_replication and account.server.settings_url and account.chat.replication_password and account.id not in self.disabled_accounts)
         for account in accounts:
-            try:
-                outgoing_entries = self.outgoing_entries[account.id]
-            except KeyError:
-                pass
-            else:
-                connection = None
-                try:
-                    connection = self.connections_for_outgoing_replication[account.id]['connection']
-                except KeyError:
-                    pass
-
-                if not connection and outgoing_entries:
-                    try:
-                        entries = cjson.encode(outgoing_entries)
-                    except (TypeError, cjson.EncodeError), e:
-                        BlinkLogger().log_debug("Failed to encode chat journal entries for %s: %s" % (account, e))
-                    else:
-                        query_string = "action=put_journal_entries&realm=%s" % account.id.domain
-                        url = urlparse.urlunparse(account.server.settings_url[:4] + (query_string,) + account.server.settings_url[5:])
-                        nsurl = NSURL.URLWithString_(url)
-                        settings = SIPSimpleSettings()
-                        query_string_variables = {'uuid': settings.instance_id, 'data': entries}
-                        query_string = urllib.urlencode(query_string_variables)
-                        data = NSString.stringWithString_(query_string)
-                        request = NSMutableURLRequest.requestWithURL_cachePolicy_timeoutInterval_(nsurl, NSURLRequestReloadIgnoringLocalAndRemoteCacheData, 15)
-                        request.setHTTPMethod_("POST")
-                        request.setHTTPBody_(data.dataUsingEncoding_(NSUTF8StringEncoding))
-                        connection = NSURLConnection.alloc().initWithRequest_delegate_(request, self)
-                        self.connections_for_outgoing_replication[account.id] = {'postData': self.outgoing_entries[account.id], 'responseData': '', 'authRequestCount': 0, 'connection': connection, 'url': url}
+            if self.outgoing_entries.get(account.id) and time.time() >= self.push_retry_time.get(account.id, 0):
+                self.pushJournalEntries(account)
 
             try:
                 delete_entries = self.for_delete_entries[account.id]
@@ -1725,7 +2018,7 @@ class ChatHistoryReplicator(object):
                         request.setHTTPMethod_("POST")
                         request.setHTTPBody_(data.dataUsingEncoding_(NSUTF8StringEncoding))
                         connection = NSURLConnection.alloc().initWithRequest_delegate_(request, self)
-                        self.connections_for_delete_replication[account.id] = {'postData': self.for_delete_entries[account.id], 'responseData': '', 'authRequestCount': 0, 'connection': connection, 'url': url}
+                        self.connections_for_delete_replication[account.id] = {'postData': set(delete_entries), 'responseData': '', 'authRequestCount': 0, 'connection': connection, 'url': url}
 
             connection = None
             try:
@@ -1736,6 +2029,53 @@ class ChatHistoryReplicator(object):
             if not connection:
                 self.prepareConnectionForIncomingReplication(account)
 
+    def pushJournalEntries(self, account):
+        batches = self.connections_for_outgoing_replication.setdefault(account.id, [])
+        in_flight = set(msgid for batch in batches for msgid in batch['postData'])
+        for entries in journal_batches(self.outgoing_entries[account.id], in_flight, self.push_window - len(batches), self.push_batch_entries, self.push_batch_size):
+            batch = self.startConnectionForOutgoingReplication(account, entries)
+            if batch is None:
+                break
+            batches.append(batch)
+
+    def startConnectionForOutgoingReplication(self, account, entries):
+        try:
+            data = cjson.encode(entries)
+        except (TypeError, cjson.EncodeError), e:
+            BlinkLogger().log_debug("Failed to encode chat journal entries for %s: %s" % (account, e))
+            return None
+
+        query_string = "action=put_journal_entries&realm=%s" % account.id.domain
+        url = urlparse.urlunparse(account.server.settings_url[:4] + (query_string,) + account.server.settings_url[5:])
+        nsurl = NSURL.URLWithString_(url)
+        settings = SIPSimpleSettings()
+        query_string_variables = {'uuid': settings.instance_id, 'data': data}
+        query_string = urllib.urlencode(query_string_variables)
+        data = NSString.stringWithString_(query_string)
+        request = NSMutableURLRequest.requestWithURL_cachePolicy_timeoutInterval_(nsurl, NSURLRequestReloadIgnoringLocalAndRemoteCacheData, 15)
+        request.setHTTPMethod_("POST")
+        request.setHTTPBody_(data.dataUsingEncoding_(NSUTF8StringEncoding))
+        connection = NSURLConnection.alloc().initWithRequest_delegate_(request, self)
+        return {'postData': entries, 'responseData': '', 'authRequestCount': 0, 'connection': connection, 'url': url}
+
+    def getOutgoingReplicationBatch(self, connection):
+        for account, batches in self.connections_for_outgoing_replication.iteritems():
+            for batch in batches:
+                if batch['connection'] == connection:
+                    return account, batch
+        return None, None
+
+    def outgoingReplicationBatchDidFail(self, account, batch):
+        try:
+            self.connections_for_outgoing_replication[account].remove(batch)
+        except (KeyError, ValueError):
+            pass
+        failures = self.push_failures.get(account, 0) + 1
+        self.push_failures[account] = failures
+        delay = min(80 * 2 ** (failures - 1), self.push_max_backoff)
+        self.push_retry_time[account] = time.time() + delay
+        BlinkLogger().log_debug(u"Chat journal push for %s failed %d times, retrying in %d seconds" % (account, failures, delay))
+
     @run_in_green_thread
     def prepareConnectionForIncomingReplication(self, account):
         try:
@@ -1765,23 +2105,39 @@ class ChatHistoryReplicator(object):
         nsurl = NSURL.URLWithString_(url)
         request = NSURLRequest.requestWithURL_cachePolicy_timeoutInterval_(nsurl, NSURLRequestReloadIgnoringLocalAndRemoteCacheData, 15)
         connection = NSURLConnection.alloc().initWithRequest_delegate_(request, self)
-        self.connections_for_incoming_replication[account.id] = {'responseData': '','authRequestCount': 0, 'connection':connection, 'url': url}
+        self.connections_for_incoming_replication[account.id] = {'parser': JSONStreamDecoder(('summary', 'results')),
+                                                                 'journal': IncomingJournal(self.incoming_batch_entries),
+                                                                 'notify': self.sync_counter.get(account.id, 0) > 0,
+                                                                 'authRequestCount': 0,
+                                                                 'connection': connection,
+                                                                 'url': url}
+
+    def handleIncomingJournalEvents(self, account, replication, events):
+        # journal entries are applied in batches while the rest of the journal is still being received
+        results = replication['journal'].add_events(events)
+        if results:
+            self.addLocalHistoryFromRemoteJournalEntries(results, account, replication['notify'])
 
     # NSURLConnection delegate methods
     def connection_didReceiveData_(self, connection, data):
-        try:
-            key = (account for account in self.connections_for_outgoing_replication.keys() if self.connections_for_outgoing_replication[account]['connection'] == connection).next()
-        except StopIteration:
-            pass
-        else:
-            self.connections_for_outgoing_replication[key]['responseData'] = self.connections_for_outgoing_replication[key]['responseData'] + str(data)
+        key, batch = self.getOutgoingReplicationBatch(connection)
+        if batch is not None:
+            batch['responseData'] = batch['responseData'] + str(data)
 
         try:
             key = (account for account in self.connections_for_incoming_replication.keys() if self.connections_for_incoming_replication[account]['connection'] == connection).next()
         except StopIteration:
             pass
         else:
-            self.connections_for_incoming_replication[key]['responseData'] = self.connections_for_incoming_replication[key]['responseData'] + str(data)
+            replication = self.connections_for_incoming_replication[key]
+            try:
+                events = replication['parser'].feed(str(data))
+            except (ValueError, cjson.DecodeError), e:
+                BlinkLogger().log_error("Failed to parse chat journal for %s from %s: %s" % (key, replication['url'], e))
+                replication['connection'].cancel()
+                del self.connections_for_incoming_replication[key]
+            else:
+                self.handleIncomingJournalEvents(key, replication, events)
 
         try:
             key = (account for account in self.connections_for_delete_replication.keys() if self.connections_for_delete_replication[account]['connection'] == connection).next()
@@ -1791,12 +2147,9 @@ class ChatHistoryReplicator(object):
             self.connections_for_delete_replication[key]['responseData'] = self.connections_for_delete_replication[key]['responseData'] + str(data)
 
     def connectionDidFinishLoading_(self, connection):
-        try:
-            key = (account for account in self.connections_for_outgoing_replication.keys() if self.connections_for_outgoing_replication[account]['connection'] == connection).next()
-        except StopIteration:
-            pass
-        else:
-            BlinkLogger().log_debug(u"Outgoing chat journal for %s pushed to %s" % (key, self.connections_for_outgoing_replication[key]['url']))
+        key, batch = self.getOutgoingReplicationBatch(connection)
+        if batch is not None:
+            BlinkLogger().log_debug(u"Outgoing chat journal for %s pushed to %s" % (key, batch['url']))
             try:
                 account = AccountManager().get_account(key)
             except KeyError:
@@ -1805,27 +2158,26 @@ class ChatHistoryReplicator(object):
                 except KeyError:
                     pass
             else:
-                self.connections_for_outgoing_replication[account.id]['connection'] = None
                 try:
-                    data = cjson.decode(self.connections_for_outgoing_replication[key]['responseData'])
+                    data = cjson.decode(batch['responseData'])
                 except (TypeError, cjson.DecodeError), e:
-                    BlinkLogger().log_error("Failed to parse chat journal push response for %s from %s: %s" % (key, self.connections_for_outgoing_replication[key]['url'], e))
+                    BlinkLogger().log_error("Failed to parse chat journal push response for %s from %s: %s" % (key, batch['url'], e))
+                    acknowledged = False
                 else:
-                    self.updateLocalHistoryWithRemoteJournalId(data, key)
-
-                try:
-                    for key in self.connections_for_outgoing_replication[key]['postData'].keys():
-                        try:
-                            del self.outgoing_entries[account.id][key]
-                        except KeyError:
-                            pass
-                except KeyError:
-                    pass
-
-                try:
-                    del self.connections_for_outgoing_replication[key]
-                except KeyError:
-                    pass
+                    acknowledged = self.updateLocalHistoryWithRemoteJournalId(data, key)
+
+                if acknowledged:
+                    # only entries acknowledged by the server are removed, the others are pushed again later
+                    self.connections_for_outgoing_replication[key].remove(batch)
+                    pushed_ids = remove_acknowledged_entries(self.outgoing_entries.setdefault(account.id, {}), batch['postData'])
+                    if pushed_ids:
+                        self.journal.remove_entries(account.id, 'put', pushed_ids)
+                    self.push_failures.pop(key, None)
+                    self.push_retry_time.pop(key, None)
+                    if self.outgoing_entries.get(account.id) and account.id not in self.disabled_accounts and not self.paused:
+                        self.pushJournalEntries(account)
+                else:
+                    self.outgoingReplicationBatchDidFail(key, batch)
 
         try:
             key = (account for account in self.connections_for_incoming_replication.keys() if self.connections_for_incoming_replication[account]['connection'] == connection).next()
@@ -1841,13 +2193,17 @@ class ChatHistoryReplicator(object):
                 except KeyError:
                     pass
             else:
+                replication = self.connections_for_incoming_replication.pop(key)
                 try:
-                    data = cjson.decode(self.connections_for_incoming_replication[key]['responseData'])
-                except (TypeError, cjson.DecodeError), e:
-                    BlinkLogger().log_error("Failed to parse chat journal for %s from %s: %s" % (key, self.connections_for_incoming_replication[key]['url'], e))
+                    replication['parser'].close()
+                except ValueError, e:
+                    BlinkLogger().log_error("Failed to parse chat journal for %s from %s: %s" % (key, replication['url'], e))
                 else:
-                    self.addLocalHistoryFromRemoteJournalEntries(data, key)
-                del self.connections_for_incoming_replication[key]
+                    journal = replication['journal']
+                    results = journal.finish()
+                    if results:
+                        self.addLocalHistoryFromRemoteJournalEntries(results, key, replication['notify'])
+                    self.finishIncomingReplication(journal.members, journal.summary, journal.count, key)
 
         try:
             key = (account for account in self.connections_for_delete_replication.keys() if self.connections_for_delete_replication[account]['connection'] == connection).next()
@@ -1885,10 +2241,16 @@ class ChatHistoryReplicator(object):
                             BlinkLogger().log_debug(u"Delete journal entries succeeded for account %s" % account.id)
 
                     try:
-                        for entry in self.connections_for_delete_replication[key]['postData'].copy():
-                            self.for_delete_entries[account.id].discard(entry)
+                        deleted_ids = list(self.connections_for_delete_replication[key]['postData'])
                     except KeyError:
-                        pass
+                        deleted_ids = []
+                    for entry in deleted_ids:
+                        try:
+                            self.for_delete_entries[account.id].discard(entry)
+                        except KeyError:
+                            pass
+                    if deleted_ids:
+                        self.journal.remove_entries(account.id, 'delete', deleted_ids)
 
                     try:
                         del self.connections_for_delete_replication[key]
@@ -1896,23 +2258,15 @@ class ChatHistoryReplicator(object):
                         pass
 
     def connection_didFailWithError_(self, connection, error):
-        try:
-            key = (account for account in self.connections_for_outgoing_replication.keys() if self.connections_for_outgoing_replication[account]['connection'] == connection).next()
-        except StopIteration:
-            return
-        else:
-            try:
-                connection = self.connections_for_outgoing_replication[key]['connection']
-            except KeyError:
-                pass
-            else:
-                BlinkLogger().log_debug(u"Failed to retrieve chat messages for %s from %s: %s" % (key, self.connections_for_outgoing_replication[key]['url'], error))
-                self.connections_for_outgoing_replication[key]['connection'] = None
+        key, batch = self.getOutgoingReplicationBatch(connection)
+        if batch is not None:
+            BlinkLogger().log_debug(u"Failed to push chat messages for %s to %s: %s" % (key, batch['url'], error))
+            self.outgoingReplicationBatchDidFail(key, batch)
 
         try:
             key = (account for account in self.connections_for_incoming_replication.keys() if self.connections_for_incoming_replication[account]['connection'] == connection).next()
         except StopIteration:
-            return
+            pass
         else:
             try:
                 connection = self.connections_for_incoming_replication[key]['connection']
@@ -1938,22 +2292,16 @@ class ChatHistoryReplicator(object):
                 del self.connections_for_delete_replication[key]
 
     def connection_didReceiveAuthenticationChallenge_(self, connection, challenge):
-        try:
-            key = (account for account in self.connections_for_outgoing_replication.keys() if self.connections_for_outgoing_replication[account]['connection'] == connection).next()
-        except StopIteration:
-            pass
-        else:
+        key, batch = self.getOutgoingReplicationBatch(connection)
+        if batch is not None:
             try:
                 account = AccountManager().get_account(key)
             except KeyError:
                 pass
             else:
-                try:
-                    self.connections_for_outgoing_replication[key]['authRequestCount'] += 1
-                except KeyError:
-                    self.connections_for_outgoing_replication[key]['authRequestCount'] = 1
+                batch['authRequestCount'] += 1
 
-                if self.connections_for_outgoing_replication[key]['authRequestCount'] < 2:
+                if batch['authRequestCount'] < 2:
                     credential = NSURLCredential.credentialWithUser_password_persistence_(account.id.username, account.server.web_password or account.auth.password, NSURLCredentialPersistenceForSession)
                     challenge.sender().useCredential_forAuthenticationChallenge_(credential, challenge)
 
@@ -35,6 +35,7 @@ from Foundation import (NSBundle,
 import objc
 
 import datetime
+from itertools import islice
 
 from application.notification import IObserver, NotificationCenter
 from application.python import Null
@@ -45,7 +46,7 @@ from zope.interface import implements
 from BlinkLogger import BlinkLogger
 from ContactListModel import BlinkHistoryViewerContact, BlinkPresenceContact
 from HistoryManager import ChatHistory, SessionHistory
-from util import allocate_autorelease_pool, is_anonymous ,sipuri_components_from_string, run_in_gui_thread
+from util import allocate_autorelease_pool, is_anonymous, run_in_gui_thread
 
 
 SQL_LIMIT=1000
@@ -150,7 +151,7 @@ class HistoryViewer(NSWindowController):
             self.notification_center = NotificationCenter()
             self.notification_center.add_observer(self, name='ChatViewControllerDidDisplayMessage')
             self.notification_center.add_observer(self, name='AudioCallLoggedToHistory')
-            self.notification_center.add_observer(self, name='BlinkContactsHaveChanged')
+            self.notification_center.add_observer(self, name='BlinkContactListDidChange')
             self.notification_center.add_observer(self, name='BlinkTableViewSelectionChaged')
             self.notification_center.add_observer(self, name='BlinkConferenceContactPresenceHasChanged')
             self.notification_center.add_observer(self, name='BlinkShouldTerminate')
@@ -393,15 +394,20 @@ class HistoryViewer(NSWindowController):
             if not before_date:
                 before_date = self.before_date if self.before_date else None
 
-            results = self.chat_history.get_messages(count=count, local_uri=local_uri, remote_uri=remote_uri, media_type=media_type, date=date, search_text=search_text, after_date=after_date, before_date=before_date)
+            if search_text and not (date or after_date or before_date):
+                # show the best matches first when searching without a time range
+                results = self.chat_history.search_messages(search_text, local_uri=local_uri, remote_uri=remote_uri, media_type=media_type, count=count)
+                self.messages = [message for message, snippet in results]
+                start = 0
+            else:
+                results = self.chat_history.iter_messages(local_uri=local_uri, remote_uri=remote_uri, media_type=media_type, date=date, search_text=search_text, after_date=after_date, before_date=before_date, page_size=count)
 
-            # cache message for pagination
-            self.messages=[]
-            for e in reversed(results):
-                self.messages.append(e)
+                # cache message for pagination
+                self.messages = list(islice(results, count))
+                self.messages.reverse()
 
-            # reset pagination to the last page
-            start = len(self.messages) - len(self.messages)%MAX_MESSAGES_PER_PAGE if len(self.messages) > MAX_MESSAGES_PER_PAGE else 0
+                # reset pagination to the last page
+                start = len(self.messages) - len(self.messages)%MAX_MESSAGES_PER_PAGE if len(self.messages) > MAX_MESSAGES_PER_PAGE else 0
             self.renderMessages(start)
         self.updateBusyIndicator(False)
 
@@ -414,8 +420,12 @@ class HistoryViewer(NSWindowController):
         start_from = start or self.start
 
         end = start_from + MAX_MESSAGES_PER_PAGE if start_from + MAX_MESSAGES_PER_PAGE < len(self.messages) else len(self.messages)
+        entries = []
         for row in self.messages[start_from:end]:
-            self.renderMessage(row)
+            entry = self.messageEntry(row)
+            if entry is not None:
+                entries.append(entry)
+        self.chatViewController.showMessages(entries)
 
         self.paginationButton.setEnabled_forSegment_(True if len(self.messages)>MAX_MESSAGES_PER_PAGE and start_from > MAX_MESSAGES_PER_PAGE else False, 0)
         self.paginationButton.setEnabled_forSegment_(True if start_from else False, 1)
@@ -434,23 +444,20 @@ class HistoryViewer(NSWindowController):
 
         self.foundMessagesLabel.setStringValue_(text)
 
-    @allocate_autorelease_pool
-    @run_in_gui_thread
-    def renderMessage(self, message):
+    def messageEntry(self, message):
         if message.direction == 'outgoing':
             icon = NSApp.delegate().contactsWindowController.iconPathForSelf()
         else:
-            sender_uri = sipuri_components_from_string(message.cpim_from)[0]
             # TODO: How to render the icons from Address Book? Especially in sandbox mode we do not have access to other folders
-            icon = NSApp.delegate().contactsWindowController.iconPathForURI(sender_uri)
+            icon = NSApp.delegate().contactsWindowController.iconPathForCPIMIdentity(message.cpim_from)
         try:
             timestamp=ISOTimestamp(message.cpim_timestamp)
         except Exception:
-            pass
+            return None
         else:
             is_html = False if message.content_type == 'text' else True
             private = True if message.private == "1" else False
-            self.chatViewController.showMessage(message.sip_callid, message.msgid, message.direction, message.cpim_from, icon, message.body, timestamp, is_private=private, recipient=message.cpim_to, state=message.status, is_html=is_html, history_entry=True, media_type=message.media_type, encryption=message.encryption if message.media_type == 'chat' else None)
+            return self.chatViewController.messageEntry(message.sip_callid, message.msgid, message.direction, message.cpim_from, icon, message.body, timestamp, is_private=private, recipient=message.cpim_to, state=message.status, is_html=is_html, media_type=message.media_type, encryption=message.encryption if message.media_type == 'chat' else None)
 
     @objc.IBAction
     def paginateResults_(self, sender):
@@ -770,7 +777,7 @@ class HistoryViewer(NSWindowController):
             if not exists:
                 self.refreshContacts()
 
-    def _NH_BlinkContactsHaveChanged(self, notification):
+    def _NH_BlinkContactListDidChange(self, notification):
         self.refresh_contacts_counter += 1
 
     def refreshContactsTimer_(self, timer):
@@ -0,0 +1,193 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import datetime
+import re
+import urllib
+
+__all__ = ['PresenceAggregate']
+
+
+sip_prefix_pattern = re.compile("^(sip:|sips:)")
+
+
+class PresenceAggregate(object):
+    """Availability, devices and notes aggregated from a set of pidfs, independent of the contact they belong to"""
+
+    def __init__(self, pidfs):
+        basic_status = 'closed'
+        status = {'available': False, 'away': False, 'busy': False, 'offline': False}
+        has_notes = 0
+        devices = {}
+        # minutes from UTC of the devices, their local time changes while the aggregate is cached and is computed when read
+        time_offsets = {}
+        urls = []
+        transitions = []
+        for pidf in pidfs:
+            aor = str(urllib.unquote(pidf.entity))
+            if not aor.startswith(('sip:', 'sips:')):
+                aor = 'sip:'+aor
+            # make a list of latest services
+            most_recent_service_timestamp = None
+            most_recent_service = None
+            most_recent_services = []
+            for service in pidf.services:
+                if hasattr(service, 'timestamp') and service.timestamp is not None:
+                    if most_recent_service_timestamp is None:
+                        # add service
+                        most_recent_service_timestamp = service.timestamp.value
+                        most_recent_service = service
+                    elif service.timestamp.value >= most_recent_service_timestamp:
+                        if service.user_input is not None and service.user_input.value == 'idle':
+                            # replace older idle with newer
+                            if most_recent_service.user_input is not None and most_recent_service.user_input.value == 'idle':
+                                most_recent_service_timestamp = service.timestamp.value
+                                most_recent_service = service
+                        else:
+                            # replace idle with non-idle
+                            if service.status.basic == 'open':
+                                most_recent_service_timestamp = service.timestamp.value
+                                most_recent_service = service
+                    elif service.timestamp.value < most_recent_service_timestamp:
+                        # replace newer idle with older non-idle
+                        if service.user_input is not None and service.user_input.value != 'idle' and most_recent_service.user_input is not None and most_recent_service.user_input.value == 'idle':
+                            most_recent_service_timestamp = service.timestamp.value
+                            most_recent_service = service
+                else:
+                    # services without timestamp will be weighted later
+                    most_recent_services.append(service)
+
+            if most_recent_service is not None:
+                most_recent_services.append(most_recent_service)
+
+            if basic_status is 'closed':
+                basic_status = 'open' if any(service for service in pidf.services if service in most_recent_services and service.status.basic == 'open') else 'closed'
+
+            _busy = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'busy')
+            if status['busy'] is False:
+                status['busy'] = _busy
+
+            _available = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'available' or (service.status.extended == None and basic_status == 'open'))
+            if status['available'] is False:
+                status['available'] = _available
+
+            _away = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'away')
+            if status['away'] is False:
+                status['away'] = _away
+
+            _offline = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'offline')
+            if status['offline'] is False:
+                status['offline'] = _offline
+
+            if _busy:
+                device_wining_status = 'busy'
+            elif _available:
+                device_wining_status = 'available'
+            elif _away:
+                device_wining_status = 'away'
+            else:
+                device_wining_status = 'offline'
+
+            _presence_open_notes = sorted([unicode(note) for service in pidf.services if service in most_recent_services and service.status.basic == 'open' for note in service.notes if note])
+            _presence_closed_notes = sorted([unicode(note) for service in pidf.services if service in most_recent_services and service.status.basic == 'closed' for note in service.notes if note])
+
+            _presence_notes =  _presence_closed_notes if device_wining_status == 'offline' else _presence_open_notes
+
+            has_notes += len(_presence_notes)
+
+            for service in pidf.services:
+                if service.homepage is not None and service.homepage.value:
+                    urls.append(service.homepage.value)
+                uri_text = sip_prefix_pattern.sub('', aor)
+
+                caps = set()
+                if service.capabilities is not None:
+                    if service.capabilities.audio:
+                        caps.add("audio")
+                    if service.capabilities.message:
+                        caps.add("chat")
+                    if service.capabilities.file_transfer:
+                        caps.add("file-transfer")
+                    if service.capabilities.screen_sharing_server:
+                        caps.add("screen-sharing-server")
+                    if service.capabilities.screen_sharing_client:
+                        caps.add("screen-sharing-client")
+
+                contact = urllib.unquote(service.contact.value) if service.contact is not None else aor
+                if not contact.startswith(('sip:', 'sips:')):
+                    contact = 'sip:'+contact
+
+                if service in most_recent_services and service.icon is not None:
+                    icon = unicode(service.icon)
+                else:
+                    icon = None
+
+                if service.device_info is not None:
+                    if service.device_info.time_offset is not None:
+                        time_offset_minutes = int(service.device_info.time_offset)
+                        time_offset = time_offset_minutes/60.0
+                        if time_offset == int(time_offset):
+                            offset_info = '(UTC+%d%s)' % (time_offset, (service.device_info.time_offset.description is not None and (' (%s)' % service.device_info.time_offset.description) or ''))
+                        else:
+                            offset_info = '(UTC+%.1f%s)' % (time_offset, (service.device_info.time_offset.description is not None and (' (%s)' % service.device_info.time_offset.description) or ''))
+                    else:
+                        time_offset_minutes = None
+                        offset_info = None
+                    if service.status.extended is not None:
+                        device_wining_status = str(service.status.extended)
+                    device_text = '%s running %s' % (service.device_info.description, service.device_info.user_agent) if service.device_info.user_agent else service.device_info.description
+                    description = service.device_info.description
+                    user_agent = service.device_info.user_agent
+
+                else:
+                    device_text = '%s' % service.id
+                    description = None
+                    user_agent = None
+                    time_offset_minutes = None
+                    offset_info = None
+
+                try:
+                    device = devices[service.id]
+                except KeyError:
+                    devices[service.id] = {
+                        'id'          : service.id,
+                        'description' : description,
+                        'user_agent'  : user_agent,
+                        'contact'     : contact,
+                        'location'    : service.map.value if service.map is not None else None,
+                        'local_time'  : None,
+                        'time_offset' : offset_info,
+                        'notes'       : _presence_notes,
+                        'status'      : device_wining_status,
+                        'caps'        : caps,
+                        'icon'        : icon,
+                        'aor'         : [aor],
+                        'timestamp'   : service.timestamp if hasattr(service, 'timestamp') and service.timestamp is not None else None
+                        }
+                    time_offsets[service.id] = time_offset_minutes
+                else:
+                    device['aor'].append(aor)
+
+                if service in most_recent_services:
+                    transitions.append((service.id, device_text, uri_text, device_wining_status, _presence_notes))
+
+        self.pidfs = pidfs
+        self.status = status
+        self.devices = devices
+        self.time_offsets = time_offsets
+        self.urls = urls
+        self.has_notes = has_notes
+        # (service id, device text, uri, status, notes) of the most recent services, used for logging availability transitions
+        self.transitions = transitions
+
+    def copy_devices(self):
+        # each contact copy gets its own device dictionaries, so changing one does not alter the shared aggregate
+        now = datetime.datetime.utcnow()
+        devices = {}
+        for service_id, device in self.devices.iteritems():
+            device = dict(device, aor=list(device['aor']), caps=set(device['caps']), notes=list(device['notes']))
+            time_offset = self.time_offsets.get(service_id)
+            if time_offset is not None:
+                device['local_time'] = "%s %s" % ((now + datetime.timedelta(minutes=time_offset)).strftime("%H:%M"), device['time_offset'])
+            devices[service_id] = device
+        return devices
@@ -25,6 +25,7 @@ from WebKit import WebActionOriginalURLKey
 
 import datetime
 import hashlib
+from itertools import islice
 
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null
@@ -44,7 +45,7 @@ from BlinkLogger import BlinkLogger
 from ChatViewController import MSG_STATE_DEFERRED, MSG_STATE_DELIVERED, MSG_STATE_FAILED
 from HistoryManager import ChatHistory
 from SmileyManager import SmileyManager
-from util import allocate_autorelease_pool, format_identity_to_string, sipuri_components_from_string, run_in_gui_thread
+from util import allocate_autorelease_pool, format_identity_to_string, run_in_gui_thread
 
 
 MAX_MESSAGE_LENGTH = 1300
@@ -100,7 +101,7 @@ class SMSViewController(NSObject):
     handle_scrolling = True
     scrollingTimer = None
     scrolling_back = False
-    message_count_from_history = 0
+    history_cursor = None
 
     account = None
     target_uri = None
@@ -454,103 +455,79 @@ class SMSViewController(NSObject):
          self.replay_history()
 
     def scroll_back_in_time(self):
-         self.chatViewController.clear()
-         self.chatViewController.resetRenderedMessages()
-         self.replay_history()
+         self.replay_history(older=True)
 
     @run_in_green_thread
-    def replay_history(self):
+    def replay_history(self, older=False):
         blink_contact = NSApp.delegate().contactsWindowController.getFirstContactMatchingURI(self.target_uri)
         if not blink_contact:
             remote_uris = self.remote_uri
         else:
             remote_uris = list(str(uri.uri) for uri in blink_contact.uris if '@' in uri.uri)
 
+        if older and self.history_cursor is None:
+            results = []
+        else:
+            # fetch only the page of messages older than the oldest one already displayed
+            before = self.history_cursor if older else None
+            results = list(islice(self.history.iter_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), search_text=self.chatViewController.search_text, before=before, page_size=self.showHistoryEntries), self.showHistoryEntries))
 
-        zoom_factor = self.chatViewController.scrolling_zoom_factor
+        if results:
+            self.history_cursor = (results[-1].time, results[-1].id)
 
-        if zoom_factor:
-            period_array = {
-                1: datetime.datetime.now()-datetime.timedelta(days=2),
-                2: datetime.datetime.now()-datetime.timedelta(days=7),
-                3: datetime.datetime.now()-datetime.timedelta(days=31),
-                4: datetime.datetime.now()-datetime.timedelta(days=90),
-                5: datetime.datetime.now()-datetime.timedelta(days=180),
-                6: datetime.datetime.now()-datetime.timedelta(days=365),
-                7: datetime.datetime.now()-datetime.timedelta(days=3650)
-                }
+        messages = [row for row in reversed(results)]
+        self.render_history_messages(messages, older)
 
-            after_date = period_array[zoom_factor].strftime("%Y-%m-%d")
+    @allocate_autorelease_pool
+    @run_in_gui_thread
+    def render_history_messages(self, messages, older=False):
+        if len(messages) and messages[0].date is not None:
+            message = messages[0]
+            delta = datetime.date.today() - message.date
 
-            if zoom_factor == 1:
+            if delta.days <= 2:
+                self.chatViewController.scrolling_zoom_factor = 1
                 self.zoom_period_label = 'Displaying messages from last day'
-            elif zoom_factor == 2:
+            elif delta.days <= 7:
+                self.chatViewController.scrolling_zoom_factor = 2
                 self.zoom_period_label = 'Displaying messages from last week'
-            elif zoom_factor == 3:
+            elif delta.days <= 31:
+                self.chatViewController.scrolling_zoom_factor = 3
                 self.zoom_period_label = 'Displaying messages from last month'
-            elif zoom_factor == 4:
+            elif delta.days <= 90:
+                self.chatViewController.scrolling_zoom_factor = 4
                 self.zoom_period_label = 'Displaying messages from last three months'
-            elif zoom_factor == 5:
+            elif delta.days <= 180:
+                self.chatViewController.scrolling_zoom_factor = 5
                 self.zoom_period_label = 'Displaying messages from last six months'
-            elif zoom_factor == 6:
+            elif delta.days <= 365:
+                self.chatViewController.scrolling_zoom_factor = 6
                 self.zoom_period_label = 'Displaying messages from last year'
-            elif zoom_factor == 7:
+            else:
+                self.chatViewController.scrolling_zoom_factor = 7
                 self.zoom_period_label = 'Displaying all messages'
-                self.chatViewController.setHandleScrolling_(False)
-
-            results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), after_date=after_date, count=10000, search_text=self.chatViewController.search_text)
-        else:
-            results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), count=self.showHistoryEntries, search_text=self.chatViewController.search_text)
-
-        messages = [row for row in reversed(results)]
-        self.render_history_messages(messages)
 
-    @allocate_autorelease_pool
-    @run_in_gui_thread
-    def render_history_messages(self, messages):
-        if self.chatViewController.scrolling_zoom_factor:
-            if not self.message_count_from_history:
-                self.message_count_from_history = len(messages)
-                self.chatViewController.lastMessagesLabel.setStringValue_(self.zoom_period_label)
+        if len(messages) < self.showHistoryEntries:
+            # the last page of the history has been reached
+            self.chatViewController.setHandleScrolling_(False)
+            if not older and not len(messages):
+                self.chatViewController.lastMessagesLabel.setStringValue_('There are no previous messages')
             else:
-                if self.message_count_from_history == len(messages):
-                    self.chatViewController.setHandleScrolling_(False)
-                    self.chatViewController.lastMessagesLabel.setStringValue_('%s. There are no previous messages.' % self.zoom_period_label)
-                    self.chatViewController.setHandleScrolling_(False)
-                else:
-                    self.chatViewController.lastMessagesLabel.setStringValue_(self.zoom_period_label)
+                self.zoom_period_label = '%s. There are no previous messages.' % self.zoom_period_label
+                self.chatViewController.lastMessagesLabel.setStringValue_(self.zoom_period_label)
+        elif older:
+            self.chatViewController.lastMessagesLabel.setStringValue_(self.zoom_period_label)
         else:
-            self.message_count_from_history = len(messages)
-            if len(messages):
-                self.chatViewController.lastMessagesLabel.setStringValue_('Scroll up for going back in time')
-            else:
-                self.chatViewController.setHandleScrolling_(False)
-                self.chatViewController.lastMessagesLabel.setStringValue_('There are no previous messages')
-
-        if len(messages):
-            message = messages[0]
-            delta = datetime.date.today() - message.date
+            self.chatViewController.lastMessagesLabel.setStringValue_('Scroll up for going back in time')
 
-            if not self.chatViewController.scrolling_zoom_factor:
-                if delta.days <= 2:
-                    self.chatViewController.scrolling_zoom_factor = 1
-                elif delta.days <= 7:
-                    self.chatViewController.scrolling_zoom_factor = 2
-                elif delta.days <= 31:
-                    self.chatViewController.scrolling_zoom_factor = 3
-                elif delta.days <= 90:
-                    self.chatViewController.scrolling_zoom_factor = 4
-                elif delta.days <= 180:
-                    self.chatViewController.scrolling_zoom_factor = 5
-                elif delta.days <= 365:
-                    self.chatViewController.scrolling_zoom_factor = 6
-                elif delta.days <= 3650:
-                    self.chatViewController.scrolling_zoom_factor = 7
+        if older:
+            self.chatViewController.startRenderingOlderMessages()
 
         call_id = None
         seen_sms = {}
         last_media_type = 'sms'
         last_chat_timestamp = None
+        entries = []
         for message in messages:
             if message.status == 'failed':
                 continue
@@ -566,8 +543,7 @@ class SMSViewController(NSObject):
             if message.direction == 'outgoing':
                 icon = NSApp.delegate().contactsWindowController.iconPathForSelf()
             else:
-                sender_uri = sipuri_components_from_string(message.cpim_from)[0]
-                icon = NSApp.delegate().contactsWindowController.iconPathForURI(sender_uri)
+                icon = NSApp.delegate().contactsWindowController.iconPathForCPIMIdentity(message.cpim_from)
 
             timestamp=ISOTimestamp(message.cpim_timestamp)
             is_html = False if message.content_type == 'text' else True
@@ -578,13 +554,17 @@ class SMSViewController(NSObject):
             #if message.media_type == 'sms' and last_media_type == 'chat':
             #   self.chatViewController.showSystemMessage(message.sip_callid, 'Instant messages', timestamp, False)
 
-            self.chatViewController.showMessage(message.sip_callid, message.msgid, message.direction, message.cpim_from, icon, message.body, timestamp, recipient=message.cpim_to, state=message.status, is_html=is_html, history_entry=True, media_type='sms')
+            entries.append(self.chatViewController.messageEntry(message.sip_callid, message.msgid, message.direction, message.cpim_from, icon, message.body, timestamp, recipient=message.cpim_to, state=message.status, is_html=is_html, media_type='sms'))
 
             call_id = message.sip_callid
             last_media_type = 'chat' if message.media_type == 'chat' else 'sms'
             if message.media_type == 'chat':
                 last_chat_timestamp = timestamp
 
+        self.chatViewController.showMessages(entries)
+
+        if older:
+            self.chatViewController.finishRenderingOlderMessages()
         self.chatViewController.loadingProgressIndicator.stopAnimation_(None)
 
     def webviewFinishedLoading_(self, notification):
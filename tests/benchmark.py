@@ -0,0 +1,352 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Benchmarks of the code paths changed for speed, each one next to the approach it replaced where that still
+makes sense to run. Run all of them or only the named ones with
+
+    python tests/benchmark.py [name ...]
+
+Benchmarks of modules that need the application frameworks are skipped when those cannot be imported.
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+BENCHMARKS = []
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+class Skipped(Exception):
+    pass
+
+
+def best_time(func, repeat=3):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(name, text):
+    print '%-28s %s' % (name, text)
+
+
+@benchmark
+def file_write_buffer():
+    from FileWriteBuffer import FileWriteBuffer
+    # a 1 GB file received in the 64 KB chunks of the file transfer stream
+    chunk = hashlib.sha1().digest() * (64*1024 // 20) + 'x' * (64*1024 % 20)
+    count = 1024*1024*1024 // len(chunk)
+
+    def receive(write):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                hash = hashlib.sha1()
+                write(f, hash)
+        finally:
+            os.remove(path)
+
+    def write_chunks(f, hash):
+        for i in xrange(count):
+            f.write(chunk)
+            hash.update(chunk)
+
+    def write_buffered(f, hash):
+        write_buffer = FileWriteBuffer(f, hash)
+        for i in xrange(count):
+            write_buffer.write(chunk)
+        write_buffer.flush()
+
+    for name, write in (('chunk writes', write_chunks), ('FileWriteBuffer', write_buffered)):
+        elapsed = best_time(lambda: receive(write), repeat=1)
+        report('file_write_buffer', '%s: 1 GB in %.2fs, %d MB/s' % (name, elapsed, 1024 / elapsed))
+
+
+@benchmark
+def history_writes():
+    from HistoryBatches import CHAT_MESSAGES_INSERT_QUERY, CHAT_MESSAGES_UPDATE_QUERY, insert_chat_messages
+    from tests.test_history_batches import Database, message_row
+    # 20000 messages added one by one, 5000 of them already stored, in a database file like the history one
+    rows = [message_row(str(i % 15000), remote_uri=u'user%d@example.com' % (i % 50)) for i in xrange(20000)]
+
+    def write_rows(db):
+        # the former path, one commit per message
+        for row in rows:
+            db.connection.execute(CHAT_MESSAGES_INSERT_QUERY, row)
+            db.connection.execute(CHAT_MESSAGES_UPDATE_QUERY, (row[14], row[16], row[0], row[6], row[7], row[14], row[16]))
+            db.connection.commit()
+
+    def write_batch(db):
+        insert_chat_messages(db, rows)
+
+    for name, write in (('row commits', write_rows), ('insert_chat_messages', write_batch)):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        db = Database(path)
+        try:
+            start = time.time()
+            write(db)
+            elapsed = time.time() - start
+            count = db.query("SELECT count(*) FROM chat_messages")[0][0]
+        finally:
+            db.connection.close()
+            os.remove(path)
+        report('history_writes', '%s: %d messages (%d stored) in %.2fs, %d/s' % (name, len(rows), count, elapsed, len(rows) / elapsed))
+
+
+@benchmark
+def journal_encryption():
+    from M2Crypto.EVP import Cipher
+    from EncryptionWrappers import encryptor
+    # chat journal entries of a few hundred bytes encrypted one by one before being pushed
+    entry = 'x' * 400
+    count = 20000
+
+    def encrypt_uncached():
+        # the former cipher, deriving the key from the password for each entry
+        for i in xrange(count):
+            cipher = Cipher(alg='aes_128_cbc', key='password', iv='\0' * 16, op=1, key_as_bytes=1, d='sha1', salt='saltsalt', i=5)
+            cipher.update(entry) + cipher.final()
+
+    def encrypt_cached():
+        encrypt = encryptor('password')
+        for i in xrange(count):
+            encrypt(entry)
+
+    for name, encrypt in (('key per entry', encrypt_uncached), ('encryptor', encrypt_cached)):
+        elapsed = best_time(encrypt)
+        report('journal_encryption', '%s: %d entries in %.3fs, %d/s' % (name, count, elapsed, count / elapsed))
+
+
+@benchmark
+def addressbook_reload():
+    from AddressBookSnapshot import AddressBookSnapshot, normalize_address
+    # Blink starting with a synthetic System Address Book of 5000 persons, none modified since the last run. Reading
+    # the person properties from the address book is not included, as it needs the application frameworks
+    persons = [('record%d:ABPerson' % index, 400000000.0 + index, [(u'mobile', u'+31 (6) %08d' % index), (u'sip', u'user%d@example.com' % index)])
+               for index in xrange(5000)]
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'addressbook_snapshot.pickle')
+
+    def load_all():
+        # the former startup, every person is parsed and the thread yields 10ms every 10 persons
+        loaded = 0
+        for record, modification_time, addresses in persons:
+            if loaded % 10 == 0:
+                time.sleep(0.01)
+            loaded += 1
+            [(normalize_address(address), address_type) for address_type, address in addresses]
+
+    def load_snapshot():
+        snapshot = AddressBookSnapshot(path)
+        snapshot.load()
+        restored = [snapshot.get(record, modification_time) for record, modification_time, addresses in persons]
+        assert None not in restored
+
+    try:
+        snapshot = AddressBookSnapshot(path)
+        for record, modification_time, addresses in persons:
+            snapshot.update(record, modification_time, (record, None, [(normalize_address(address), address_type) for address_type, address in addresses]))
+        snapshot.save()
+        for name, load in (('all persons', load_all), ('snapshot', load_snapshot)):
+            elapsed = best_time(load, repeat=1)
+            report('addressbook_reload', '%s: %d persons in %.3fs' % (name, len(persons), elapsed))
+    finally:
+        shutil.rmtree(folder)
+
+
+@benchmark
+def uri_lookup():
+    from ContactListModel import BlinkGroup
+    from tests.test_contact_indexes import make_contact
+    # the contact lookups done for history rows and chat messages, in a group of 8000 contacts
+    group = BlinkGroup(u'All Contacts', None)
+    group.contacts = [make_contact(index) for index in xrange(8000)]
+    uris = []
+    for index in xrange(0, 8000, 80):
+        contact = group.contacts[index]
+        uris.extend([contact.uri, u'sip:' + contact.uri, u'0%s' % contact.username.lstrip(u'+')[-9:], u'nobody%d@nowhere.net' % index])
+
+    def scan(uri):
+        # the former lookup, matchesURI for every contact of the group
+        return next((contact for contact in group.contacts if contact.matchesURI(uri)), None)
+
+    def indexed(uri):
+        return next(group.contactsMatchingURI(uri), None)
+
+    results = []
+    for name, lookup in (('scan', scan), ('contactsMatchingURI', indexed)):
+        start = time.time()
+        results.append([lookup(uri) for uri in uris])
+        elapsed = time.time() - start
+        report('uri_lookup', '%s: %d lookups in %d contacts in %.3fs, %d/s' % (name, len(uris), len(group.contacts), elapsed, len(uris) / elapsed))
+    assert results[0] == results[1]
+
+
+@benchmark
+def smiley_replacement():
+    import random
+    from util import escape_html
+    from tests.test_smileys import load_manager, replace_loop
+    # a chat history of 10000 messages replayed with the default smiley theme
+    manager = load_manager()
+    rand = random.Random(1)
+    smileys = manager.smileys.keys()
+    words = ['hello', 'how', 'are', 'you', 'today', 'see', 'http://example.com/page', 'meeting', 'at', '10:30']
+    messages = [escape_html(' '.join(rand.choice(smileys) if rand.random() < 0.1 else rand.choice(words) for j in xrange(rand.randint(3, 30))))
+                for i in xrange(10000)]
+
+    results = []
+    for name, subst in (('replace loop', lambda text: replace_loop(manager, text)), ('subst_smileys_html', manager.subst_smileys_html)):
+        elapsed = best_time(lambda: results.append([subst(text) for text in messages]))
+        report('smiley_replacement', '%s: %d messages in %.3fs, %d/s' % (name, len(messages), elapsed, len(messages) / elapsed))
+    assert results[0] == results[-1]
+
+
+@benchmark
+def identity_parser():
+    import shlex
+    import util
+    from tests.test_util import IDENTITIES
+    # the From and CPIM identities parsed for each history row
+    identities = [identity for identity in IDENTITIES if identity] * 1000
+
+    def parse_uncached():
+        for identity in identities:
+            util._sipuri_components_cache.clear()
+            util.sipuri_components_from_string(identity)
+
+    def parse_cached():
+        for identity in identities:
+            util.sipuri_components_from_string(identity)
+
+    # the tokenizer, followed by the whole parse with and without the cache
+    for name, parse in (('shlex.split', lambda: map(shlex.split, identities)), ('_split_identity', lambda: map(util._split_identity, identities)),
+                        ('uncached components', parse_uncached), ('cached components', parse_cached)):
+        elapsed = best_time(parse)
+        report('identity_parser', '%s: %d calls in %.3fs, %.1f us/call' % (name, len(identities), elapsed, elapsed * 1e6 / len(identities)))
+
+
+@benchmark
+def trace_file():
+    from BlinkLogger import FileLogger, TraceFile
+    # 50000 SIP trace entries of about 1 KB, as logged during a screen sharing session, written by TraceFile without
+    # and with the rotation into compressed segments every trace_max_size bytes
+    packet = 'MESSAGE sip:alice@example.com SIP/2.0\r\n' + 'X-Header: %s\r\n' % ('x' * 60) * 14
+    count = 50000
+    folder = tempfile.mkdtemp()
+
+    def write_flushed(filename):
+        # the former writes, flushed for each entry
+        with open(filename, 'a') as f:
+            for index in xrange(count):
+                f.write('%s [blink %d]: RECEIVED: Packet %d\n%s\n--\n' % ('2011-05-01 10:00:00', 1000, index, packet))
+                f.flush()
+
+    def write_buffered(filename, max_size=FileLogger.trace_max_size):
+        trace = TraceFile(filename, FileLogger.trace_buffer_size, max_size, FileLogger.trace_backup_count)
+        try:
+            for index in xrange(count):
+                trace.write('%s [blink %d]: RECEIVED: Packet %d\n%s\n--\n' % ('2011-05-01 10:00:00', 1000, index, packet))
+        finally:
+            trace.close()
+
+    try:
+        for name, write in (('flush per entry', write_flushed), ('TraceFile', lambda filename: write_buffered(filename, max_size=0)), ('TraceFile rotated', write_buffered)):
+            filename = os.path.join(folder, name.replace(' ', '_') + '.txt')
+            elapsed = best_time(lambda: write(filename), repeat=1)
+            report('trace_file', '%s: %d traces in %.2fs, %d traces/s' % (name, count, elapsed, count / elapsed))
+    finally:
+        shutil.rmtree(folder)
+
+
+@benchmark
+def presence_matching():
+    from ContactListModel import BlinkGroup, BlinkPresenceContact, BlinkPresenceURIIndex
+    from tests.test_contact_indexes import make_presence_contact
+    # full state presence notifications of 1000 resources replayed for 2000 presence contacts in 4 groups
+    contacts = [make_presence_contact(index) for index in xrange(2000)]
+    groups = [BlinkGroup(u'Group %d' % index, None) for index in xrange(4)]
+    for index, group in enumerate(groups):
+        group.contacts = contacts[index::4]
+    resources = [contact.uris[0].uri for contact in contacts[::2]]
+
+    def scan(uri):
+        # the former match, getPresenceContactsMatchingURI walking every group for each resource
+        return set((blink_contact, group) for group in groups for blink_contact in group.contacts if isinstance(blink_contact, BlinkPresenceContact) and blink_contact.contact.presence.subscribe and blink_contact.matchesURI(uri, True))
+
+    index = BlinkPresenceURIIndex()
+    def indexed(uri):
+        index.refresh(groups)
+        return set(index.contacts_matching_uri(uri))
+
+    # the index is built during the first notification and reused by the next ones
+    results = []
+    for name, match, notifications in (('scan', scan, 1), ('BlinkPresenceURIIndex', indexed, 3)):
+        start = time.time()
+        for i in xrange(notifications):
+            matches = [match(uri) for uri in resources]
+        elapsed = (time.time() - start) / notifications
+        results.append(matches)
+        report('presence_matching', '%s: %d resources for %d contacts in %.3fs per notification' % (name, len(resources), len(contacts), elapsed))
+    assert results[0] == results[1]
+
+
+@benchmark
+def contact_search():
+    from ContactListModel import BlinkGroup
+    from tests.test_contact_indexes import make_contact
+    # searches typed one character at a time in a group of 10000 contacts
+    group = BlinkGroup(u'All Contacts', None)
+    group.contacts = [make_contact(index) for index in xrange(10000)]
+    keystrokes = [text[:length] for text in (u'alice12', u'Contact 99', u'+3120000', u'example.org') for length in xrange(1, len(text) + 1)]
+
+    def scan(text):
+        # the former search, every contact checked for each keystroke
+        return [contact for contact in group.contacts if text in contact or contact.matchesURI(text)]
+
+    def indexed(text):
+        return [contact for rank, contact in group.contactsMatchingText(text)]
+
+    results = []
+    for name, search in (('scan', scan), ('contactsMatchingText', indexed)):
+        latencies = []
+        matches = []
+        for text in keystrokes:
+            start = time.time()
+            matches.append(search(text))
+            latencies.append(time.time() - start)
+        results.append(matches)
+        # the first search also builds the index
+        first, latencies = latencies[0], latencies[1:]
+        report('contact_search', '%s: %d keystrokes in %d contacts, first %.1f ms, then %.1f ms average and %.1f ms worst' % (name, len(keystrokes), len(group.contacts), first * 1000, sum(latencies) * 1000 / len(latencies), max(latencies) * 1000))
+    assert results[0] == results[1]
+
+
+def main(names):
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+        try:
+            func()
+        except (ImportError, Skipped), e:
+            report(func.__name__, 'skipped: %s' % e)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
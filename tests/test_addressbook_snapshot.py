@@ -0,0 +1,88 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from AddressBookSnapshot import AddressBookSnapshot, normalize_address
+
+
+PERSON = (u'Alice Smith', u'Example Inc', [(u'+31201234567', u'mobile'), (u'alice@example.com', 'sip'), (u'http://example.com', 'url')])
+
+
+class NormalizeAddressTest(unittest.TestCase):
+
+    def test_numbers(self):
+        self.assertEqual(normalize_address(u'+31 (20) 123-4567'), u'+31201234567')
+        self.assertEqual(normalize_address(u'020 123 4567'), u'0201234567')
+        self.assertEqual(normalize_address(u'sip:*21#'), u'*21#')
+
+    def test_sip_addresses_and_urls(self):
+        self.assertEqual(normalize_address(u'alice@example.com'), u'alice@example.com')
+        self.assertEqual(normalize_address(u'http://example.com/alice'), u'http://example.com/alice')
+
+
+class AddressBookSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'addressbook_snapshot.pickle')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_saved_snapshot_is_loaded(self):
+        snapshot = AddressBookSnapshot(self.path)
+        snapshot.load()
+        self.assertTrue(snapshot.loaded)
+        self.assertEqual(snapshot.records, {})
+        snapshot.update('record1:ABPerson', 100.0, PERSON)
+        snapshot.update('record2:ABPerson', None, PERSON)
+        snapshot.save()
+        self.assertEqual(os.listdir(self.folder), ['addressbook_snapshot.pickle'])
+
+        snapshot = AddressBookSnapshot(self.path)
+        snapshot.load()
+        self.assertEqual(snapshot.get('record1:ABPerson', 100.0), PERSON)
+
+    def test_modified_persons_are_not_returned(self):
+        snapshot = AddressBookSnapshot(self.path)
+        snapshot.update('record1:ABPerson', 100.0, PERSON)
+        snapshot.update('record2:ABPerson', None, PERSON)
+        self.assertEqual(snapshot.get('record1:ABPerson', 101.0), None)
+        self.assertEqual(snapshot.get('record1:ABPerson', None), None)
+        # a person without modification time is always read again
+        self.assertEqual(snapshot.get('record2:ABPerson', None), None)
+        self.assertEqual(snapshot.get('record3:ABPerson', 100.0), None)
+
+    def test_remove(self):
+        snapshot = AddressBookSnapshot(self.path)
+        snapshot.update('record1:ABPerson', 100.0, PERSON)
+        snapshot.update('record2:ABPerson', 100.0, PERSON)
+        snapshot.remove(['record1:ABPerson', 'record3:ABPerson'])
+        self.assertEqual(sorted(snapshot.records), ['record2:ABPerson'])
+
+    def test_unreadable_snapshot(self):
+        for content in ('not a pickle', 'I1\n.'):
+            with open(self.path, 'wb') as f:
+                f.write(content)
+            snapshot = AddressBookSnapshot(self.path)
+            snapshot.load()
+            self.assertEqual(snapshot.records, {})
+            self.assertEqual(snapshot.get('record1:ABPerson', 100.0), None)
+
+    def test_failed_save_keeps_the_previous_snapshot(self):
+        snapshot = AddressBookSnapshot(self.path)
+        snapshot.update('record1:ABPerson', 100.0, PERSON)
+        snapshot.save()
+        snapshot.update('record2:ABPerson', 100.0, lambda: None)
+        snapshot.save()
+        snapshot = AddressBookSnapshot(self.path)
+        snapshot.load()
+        self.assertEqual(sorted(snapshot.records), ['record1:ABPerson'])
+
+
+if __name__ == '__main__':
+    unittest.main()
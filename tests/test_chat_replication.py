@@ -0,0 +1,358 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+try:
+    import HistoryManager
+    from HistoryManager import ChatHistoryReplicator, ChatReplicationJournal
+    from twisted.internet import defer
+    from twisted.python.failure import Failure
+except ImportError:
+    HistoryManager = None
+
+
+def run_now(reactor, pool, func, *args, **kw):
+    # stands in for the db thread pool
+    return defer.maybeDeferred(func, *args, **kw)
+
+
+def result_of(deferred):
+    results = []
+    deferred.addBoth(results.append)
+    result = results[0]
+    if isinstance(result, Failure):
+        result.raiseException()
+    return result
+
+
+ACCOUNT = u'alice@example.com'
+
+
+@unittest.skipIf(HistoryManager is None, 'HistoryManager needs the application frameworks')
+class ChatReplicationJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'history.sqlite')
+        self.saved = HistoryManager.deferToThreadPool, HistoryManager.block_on
+        HistoryManager.deferToThreadPool = run_now
+        HistoryManager.block_on = result_of
+
+    def tearDown(self):
+        HistoryManager.deferToThreadPool, HistoryManager.block_on = self.saved
+        shutil.rmtree(self.folder)
+
+    def open_journal(self):
+        journal = object.__new__(ChatReplicationJournal)
+        journal._initialize("sqlite://" + self.path)
+        return journal
+
+    def stored_entries(self):
+        # what another process finds on disk, regardless of any connection state kept by the journal
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute("SELECT account, action, entry_id, data FROM chat_replication_journal ORDER BY id").fetchall()
+        finally:
+            db.close()
+
+    def test_entries_survive_a_crash(self):
+        journal = self.open_journal()
+        self.assertTrue(result_of(journal.add_entries([(ACCOUNT, 'put', 'msg1', u'first'), (ACCOUNT, 'put', 'msg2', u'second')])))
+        result_of(journal.add_entries([(ACCOUNT, 'delete', 'journal1', '')]))
+        result_of(journal.remove_entries(ACCOUNT, 'put', ['msg1']))
+        # nothing else is saved before the application is killed
+        expected = [(ACCOUNT, 'put', 'msg2', u'second'), (ACCOUNT, 'delete', 'journal1', u'')]
+        self.assertEqual(self.stored_entries(), expected)
+        journal.db.close()
+
+        journal = self.open_journal()
+        self.assertEqual([tuple(entry) for entry in journal.get_entries()], expected)
+
+    def test_entries_are_replaced(self):
+        journal = self.open_journal()
+        result_of(journal.add_entries([(ACCOUNT, 'put', 'msg1', u'first'), (ACCOUNT, 'delete', 'msg1', '')]))
+        result_of(journal.add_entries([(ACCOUNT, 'put', 'msg1', u'edited')]))
+        result_of(journal.add_entries([(u'bob@example.com', 'put', 'msg1', u'other account')]))
+        self.assertEqual(sorted(self.stored_entries()), [(ACCOUNT, 'delete', 'msg1', u''), (ACCOUNT, 'put', 'msg1', u'edited'), (u'bob@example.com', 'put', 'msg1', u'other account')])
+        journal.db.close()
+
+    def test_utf8_data(self):
+        journal = self.open_journal()
+        result_of(journal.add_entries([('alice@example.com', 'put', 'msg1', u'caf\xe9'.encode('utf-8'))]))
+        self.assertEqual(self.stored_entries(), [(ACCOUNT, 'put', 'msg1', u'caf\xe9')])
+        journal.db.close()
+
+    def test_removing_unknown_entries(self):
+        journal = self.open_journal()
+        result_of(journal.add_entries([(ACCOUNT, 'put', 'msg1', u'first')]))
+        result_of(journal.remove_entries(ACCOUNT, 'put', ['msg2']))
+        result_of(journal.remove_entries(ACCOUNT, 'delete', ['msg1']))
+        self.assertEqual(self.stored_entries(), [(ACCOUNT, 'put', 'msg1', u'first')])
+        journal.db.close()
+
+
+class FakeAccountId(unicode):
+    @property
+    def domain(self):
+        return self.partition('@')[2]
+
+
+class FakeAccount(object):
+    def __init__(self, id):
+        self.id = FakeAccountId(id)
+
+
+class FakeAccountManager(object):
+    accounts = {}
+
+    def get_account(self, id):
+        return self.accounts[id]
+
+
+class FakeChatHistory(object):
+    journal_ids = {}
+
+    def update_from_journal_put_results(self, msgid, journal_id):
+        self.journal_ids[msgid] = journal_id
+
+
+class FakeReplicatedHistory(object):
+    # records what addLocalHistoryFromRemoteJournalEntries would store
+    def __init__(self):
+        self.results = []
+
+    def __call__(self, results, account, notify=False):
+        self.results.extend(results)
+
+
+class FakeJournal(object):
+    def __init__(self):
+        self.removed = []
+
+    def remove_entries(self, account, action, entry_ids):
+        self.removed.extend((account, action, entry_id) for entry_id in entry_ids)
+
+
+class StandInServer(object):
+    """Takes the place of the NSURLConnection requests made to the chat history server"""
+
+    def __init__(self, replicator):
+        self.replicator = replicator
+        self.requests = []
+
+    def start_connection(self, account, entries):
+        batch = {'postData': entries, 'responseData': '', 'authRequestCount': 0, 'connection': object(), 'url': 'https://example.com/settings'}
+        self.requests.append(batch)
+        return batch
+
+    def acknowledge(self, batch):
+        results = [{'id': msgid, 'journal_id': index} for index, msgid in enumerate(sorted(batch['postData']))]
+        self.respond(batch, HistoryManager.cjson.encode({'success': True, 'results': results}))
+
+    def respond(self, batch, body):
+        # the response arrives in two chunks
+        self.replicator.connection_didReceiveData_(batch['connection'], body[:10])
+        self.replicator.connection_didReceiveData_(batch['connection'], body[10:])
+        self.replicator.connectionDidFinishLoading_(batch['connection'])
+
+    def fail(self, batch):
+        self.replicator.connection_didFailWithError_(batch['connection'], 'connection refused')
+
+
+@unittest.skipIf(HistoryManager is None, 'HistoryManager needs the application frameworks')
+class ChatJournalPushTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = HistoryManager.AccountManager, HistoryManager.ChatHistory, HistoryManager.BlinkLogger
+        HistoryManager.AccountManager = FakeAccountManager
+        HistoryManager.ChatHistory = FakeChatHistory
+        HistoryManager.BlinkLogger = HistoryManager.Null
+        self.account = FakeAccount(ACCOUNT)
+        FakeAccountManager.accounts = {self.account.id: self.account}
+        FakeChatHistory.journal_ids = {}
+
+        replicator = object.__new__(ChatHistoryReplicator)
+        replicator.outgoing_entries = {}
+        replicator.for_delete_entries = {}
+        replicator.connections_for_outgoing_replication = {}
+        replicator.connections_for_incoming_replication = {}
+        replicator.connections_for_delete_replication = {}
+        replicator.disabled_accounts = set()
+        replicator.push_retry_time = {}
+        replicator.push_failures = {}
+        replicator.journal = FakeJournal()
+        self.server = StandInServer(replicator)
+        replicator.startConnectionForOutgoingReplication = self.server.start_connection
+        self.replicator = replicator
+
+    def tearDown(self):
+        HistoryManager.AccountManager, HistoryManager.ChatHistory, HistoryManager.BlinkLogger = self.saved
+
+    def queue(self, count, size=10, start=0):
+        entries = self.replicator.outgoing_entries.setdefault(self.account.id, {})
+        for index in xrange(start, start + count):
+            msgid = 'msg%04d' % index
+            entries[msgid] = {'id': msgid, 'data': 'x' * size}
+
+    def in_flight(self):
+        return self.replicator.connections_for_outgoing_replication.get(self.account.id, [])
+
+    def test_batches_are_bounded(self):
+        self.queue(250)
+        self.replicator.pushJournalEntries(self.account)
+        self.assertEqual(len(self.server.requests), ChatHistoryReplicator.push_window)
+        self.assertEqual([len(batch['postData']) for batch in self.server.requests], [ChatHistoryReplicator.push_batch_entries] * ChatHistoryReplicator.push_window)
+        first, second = self.server.requests
+        self.assertFalse(set(first['postData']) & set(second['postData']))
+        # the window is full, nothing else is sent
+        self.replicator.pushJournalEntries(self.account)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_batch_size(self):
+        size = ChatHistoryReplicator.push_batch_size // 3 + 1
+        self.queue(4, size=size)
+        self.queue(1, size=ChatHistoryReplicator.push_batch_size * 2, start=4)
+        self.replicator.pushJournalEntries(self.account)
+        for batch in self.server.requests:
+            sizes = [len(entry['data']) for entry in batch['postData'].itervalues()]
+            # an entry larger than the limit is still sent, on its own
+            self.assertTrue(sum(sizes) <= ChatHistoryReplicator.push_batch_size or len(sizes) == 1, sizes)
+
+    def test_acknowledged_entries_are_removed(self):
+        self.queue(150)
+        self.replicator.pushJournalEntries(self.account)
+        first = self.server.requests[0]
+        self.server.acknowledge(first)
+        pushed = set(first['postData'])
+        self.assertFalse(pushed & set(self.replicator.outgoing_entries[self.account.id]))
+        self.assertEqual(len(self.replicator.outgoing_entries[self.account.id]), 50)
+        self.assertEqual(sorted(self.replicator.journal.removed), sorted((self.account.id, 'put', msgid) for msgid in pushed))
+        self.assertEqual(set(FakeChatHistory.journal_ids), pushed)
+        self.assertFalse(first in self.in_flight())
+
+        # the remaining entries are all in flight and the window is not refilled with them again
+        self.assertEqual(len(self.server.requests), 2)
+        self.server.acknowledge(self.server.requests[1])
+        self.assertEqual(self.replicator.outgoing_entries[self.account.id], {})
+        self.assertEqual(self.in_flight(), [])
+
+    def test_entries_queued_during_a_push_are_kept(self):
+        self.queue(10)
+        self.replicator.pushJournalEntries(self.account)
+        self.queue(5, start=10)
+        self.server.acknowledge(self.server.requests[0])
+        # the entries queued meanwhile are pushed as soon as the previous batch is acknowledged
+        self.assertEqual(sorted(self.replicator.outgoing_entries[self.account.id]), ['msg%04d' % index for index in xrange(10, 15)])
+        self.assertEqual(sorted(self.server.requests[1]['postData']), ['msg%04d' % index for index in xrange(10, 15)])
+
+    def test_entries_queued_again_during_a_push_are_kept(self):
+        self.queue(10)
+        self.replicator.pushJournalEntries(self.account)
+        # a status change of msg0003 queues a new version while the old one is in flight
+        self.queue(1, size=20, start=3)
+        self.replicator.pushJournalEntries(self.account)
+        self.assertEqual(len(self.server.requests), 1)
+        self.server.acknowledge(self.server.requests[0])
+        self.assertEqual(sorted(self.replicator.outgoing_entries[self.account.id]), ['msg0003'])
+        self.assertFalse((self.account.id, 'put', 'msg0003') in self.replicator.journal.removed)
+        self.assertEqual(len(self.replicator.journal.removed), 9)
+        # the new version is pushed right away and removed once acknowledged
+        self.assertEqual(self.server.requests[1]['postData'].keys(), ['msg0003'])
+        self.assertEqual(self.server.requests[1]['postData']['msg0003']['data'], 'x' * 20)
+        self.server.acknowledge(self.server.requests[1])
+        self.assertEqual(self.replicator.outgoing_entries[self.account.id], {})
+        self.assertTrue((self.account.id, 'put', 'msg0003') in self.replicator.journal.removed)
+
+    def test_failed_push_backs_off(self):
+        self.queue(10)
+        delays = []
+        for attempt in xrange(8):
+            self.replicator.pushJournalEntries(self.account)
+            self.server.fail(self.server.requests[-1])
+            delays.append(self.replicator.push_retry_time[self.account.id] - HistoryManager.time.time())
+        self.assertEqual(len(self.replicator.outgoing_entries[self.account.id]), 10)
+        self.assertEqual(self.in_flight(), [])
+        self.assertEqual(self.replicator.journal.removed, [])
+        self.assertEqual(self.replicator.push_failures[self.account.id], 8)
+        self.assertEqual([int(round(delay)) for delay in delays], [80, 160, 320, 640, 1280, 2560, 3600, 3600])
+
+        # a successful push resets the backoff
+        self.replicator.pushJournalEntries(self.account)
+        self.server.acknowledge(self.server.requests[-1])
+        self.assertFalse(self.account.id in self.replicator.push_failures)
+        self.assertFalse(self.account.id in self.replicator.push_retry_time)
+
+    def test_unacknowledged_push_is_retried(self):
+        self.queue(10)
+        self.replicator.pushJournalEntries(self.account)
+        self.server.respond(self.server.requests[0], 'not a json document')
+        self.assertEqual(len(self.replicator.outgoing_entries[self.account.id]), 10)
+        self.assertEqual(self.replicator.push_failures[self.account.id], 1)
+
+        self.replicator.pushJournalEntries(self.account)
+        self.server.respond(self.server.requests[1], HistoryManager.cjson.encode({'success': False, 'error_message': 'Database error'}))
+        self.assertEqual(len(self.replicator.outgoing_entries[self.account.id]), 10)
+        self.assertEqual(self.replicator.push_failures[self.account.id], 2)
+        self.assertTrue(self.account.id in self.replicator.disabled_accounts)
+        self.assertEqual(self.replicator.journal.removed, [])
+
+
+@unittest.skipIf(HistoryManager is None, 'HistoryManager needs the application frameworks')
+class ChatJournalFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = HistoryManager.AccountManager, HistoryManager.BlinkLogger
+        HistoryManager.AccountManager = FakeAccountManager
+        HistoryManager.BlinkLogger = HistoryManager.Null
+        self.account = FakeAccount(ACCOUNT)
+        FakeAccountManager.accounts = {self.account.id: self.account}
+
+        replicator = object.__new__(ChatHistoryReplicator)
+        replicator.connections_for_outgoing_replication = {}
+        replicator.connections_for_incoming_replication = {}
+        replicator.connections_for_delete_replication = {}
+        replicator.replication_server_summary = {}
+        replicator.disabled_accounts = set()
+        replicator.sync_counter = {}
+        replicator.incoming_batch_entries = 10
+        replicator.addLocalHistoryFromRemoteJournalEntries = self.history = FakeReplicatedHistory()
+        replicator.disableReplication = lambda account, reason=None: replicator.disabled_accounts.add(account)
+        self.replicator = replicator
+
+    def tearDown(self):
+        HistoryManager.AccountManager, HistoryManager.BlinkLogger = self.saved
+
+    def fetch(self, response):
+        connection = object()
+        self.replicator.connections_for_incoming_replication[self.account.id] = {'parser': HistoryManager.JSONStreamDecoder(('summary', 'results')),
+                                                                                 'journal': HistoryManager.IncomingJournal(self.replicator.incoming_batch_entries),
+                                                                                 'notify': False,
+                                                                                 'authRequestCount': 0,
+                                                                                 'connection': connection,
+                                                                                 'url': 'https://example.com/settings'}
+        body = HistoryManager.cjson.encode(response)
+        for index in xrange(0, len(body), 100):
+            self.replicator.connection_didReceiveData_(connection, body[index:index+100])
+        self.replicator.connectionDidFinishLoading_(connection)
+
+    def test_results_are_applied(self):
+        results = [{'id': 'msg%04d' % index, 'data': 'x'} for index in xrange(25)]
+        self.fetch({'success': True, 'results': results})
+        self.assertEqual(self.history.results, results)
+        self.assertEqual(self.replicator.connections_for_incoming_replication, {})
+        self.assertFalse(self.account.id in self.replicator.disabled_accounts)
+
+    def test_failed_response_applies_nothing(self):
+        results = [{'id': 'msg%04d' % index, 'data': 'x'} for index in xrange(25)]
+        self.fetch({'results': results, 'success': False, 'error_message': 'Database error'})
+        self.assertEqual(self.history.results, [])
+        self.assertTrue(self.account.id in self.replicator.disabled_accounts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import datetime
+import json
+import unittest
+
+try:
+    import ChatViewController
+    from ChatViewController import ChatViewController as ChatViewControllerClass
+except ImportError:
+    ChatViewController = None
+
+
+class Value(object):
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+class FakeSmileyManager(object):
+    def subst_smileys_html(self, text):
+        return text
+
+
+class FakeOutputView(object):
+    def __init__(self):
+        self.scripts = []
+
+    def stringByEvaluatingJavaScriptFromString_(self, script):
+        self.scripts.append(script)
+
+
+class FakeDelegate(object):
+    def __init__(self):
+        self.new_messages = 0
+
+    def isOutputFrameVisible(self):
+        return True
+
+    def chatViewDidGetNewMessage_(self, controller):
+        self.new_messages += 1
+
+
+def decode_script(script):
+    # the scripts have the form renderMessages(<json list>)
+    assert script.startswith('renderMessages(') and script.endswith(')'), script
+    return json.loads(script[len('renderMessages('):-1])
+
+
+@unittest.skipIf(ChatViewController is None, 'ChatViewController needs the application frameworks')
+class ChatViewRenderingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_smiley_manager = ChatViewController.SmileyManager
+        ChatViewController.SmileyManager = FakeSmileyManager
+        self.output_view = FakeOutputView()
+        self.delegate = FakeDelegate()
+        self.controller = ChatViewControllerClass.alloc().init()
+        self.controller.outputView = self.output_view
+        self.controller.delegate = self.delegate
+        self.controller.setAccount_(Value(id='alice@example.com', display_name='Alice'))
+        self.controller.resetRenderedMessages()
+        self.controller.messageQueue = []
+        self.controller.finishedLoading = True
+        self.controller.expandSmileys = False
+
+    def tearDown(self):
+        ChatViewController.SmileyManager = self.saved_smiley_manager
+
+    def entries(self, count):
+        timestamp = datetime.datetime(2011, 5, 1, 10, 0)
+        entries = [self.controller.systemMessageEntry('call-id', u'Started', timestamp)]
+        for index in xrange(count):
+            direction = 'incoming' if index % 2 else 'outgoing'
+            entries.append(self.controller.messageEntry('call-id', 'msgid-%d' % index, direction, u'Bob', 'icon.png', u'Message-%d' % index, timestamp))
+        return entries
+
+    def test_history_is_rendered_with_one_call(self):
+        entries = self.entries(100)
+        self.assertEqual(self.output_view.scripts, [])
+        self.controller.showMessages(entries)
+        self.assertEqual(len(self.output_view.scripts), 1)
+        self.assertEqual(self.delegate.new_messages, 1)
+        messages = decode_script(self.output_view.scripts[0])
+        self.assertEqual(len(messages), 101)
+        self.assertEqual(messages[0][0], 'system')
+        self.assertEqual(messages[0][2], u'Started')
+        self.assertEqual([message[1] for message in messages[1:]], ['msgid-%d' % index for index in xrange(100)])
+        self.assertEqual(messages[1][:6], ['message', 'msgid-0', 'outgoing', u'Bob', 'icon.png', u'Message-0'])
+        self.assertEqual([message.msgid for message in self.controller.rendered_messages], [message[1] for message in messages])
+
+    def test_empty_history_is_not_rendered(self):
+        self.controller.showMessages([])
+        self.assertEqual(self.output_view.scripts, [])
+        self.assertEqual(self.delegate.new_messages, 0)
+
+    def test_history_is_queued_until_the_view_is_loaded(self):
+        self.controller.finishedLoading = False
+        self.controller.showMessages(self.entries(10))
+        self.controller.showSystemMessage('call-id', u'Connected', datetime.datetime(2011, 5, 1, 10, 0))
+        self.assertEqual(self.output_view.scripts, [])
+        self.assertEqual(len(self.controller.messageQueue), 2)
+        self.assertEqual([len(decode_script(script)) for script in self.controller.messageQueue], [11, 1])
+
+    def test_arguments_are_escaped(self):
+        # quotes, backslashes, line separators and characters outside the BMP must not break the script
+        text = u'It\'s "quoted" \\ \u2028 \U0001F600'
+        sender = u'Bob "The Builder" O\'Neil'
+        self.controller.showMessage('call-id', 'msgid', 'incoming', sender, 'icon.png', text, datetime.datetime(2011, 5, 1, 10, 0), is_html=True)
+        script = self.output_view.scripts[0]
+        # JavaScript does not accept the \U escapes of other encoders, so the script only holds \uXXXX escapes
+        self.assertTrue(isinstance(script, str))
+        self.assertFalse('\\U' in script)
+        self.assertTrue('\\u2028' in script)
+        self.assertTrue('\\ud83d\\ude00' in script)
+        message = decode_script(script)[0]
+        self.assertEqual(message[3], sender)
+        self.assertEqual(message[5], text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import random
+import unittest
+
+try:
+    from ContactListModel import BlinkContact, BlinkContactList, BlinkGroup, BlinkPresenceContact, BlinkPresenceURIIndex, split_uri
+except ImportError:
+    BlinkContact = None
+
+
+NAMES = [u'alice', u'bob', u'carol', u'dave', u'eve', u'mallory', u'trent', u'peggy']
+DOMAINS = [u'example.com', u'example.org', u'sip2sip.info']
+
+
+def make_contact(index):
+    if index % 5 == 0:
+        uri = u'+3120%07d@%s' % (index, DOMAINS[index % len(DOMAINS)])
+    else:
+        uri = u'%s%d@%s' % (NAMES[index % len(NAMES)], index // len(NAMES), DOMAINS[index % len(DOMAINS)])
+    return BlinkContact(uri, name=u'Contact %d' % index)
+
+
+class AddressbookURI(object):
+    def __init__(self, uri):
+        self.uri = uri
+        self.type = None
+
+
+class AddressbookPresence(object):
+    def __init__(self, subscribe):
+        self.subscribe = subscribe
+
+
+class AddressbookContact(object):
+    """The attributes of an address book contact read by the presence URI index"""
+    def __init__(self, name, uris, subscribe=True):
+        self.name = name
+        self.uris = [AddressbookURI(uri) for uri in uris]
+        self.presence = AddressbookPresence(subscribe)
+
+
+def make_presence_contact(index):
+    uris = [u'%s%d@%s' % (NAMES[index % len(NAMES)], index // len(NAMES), DOMAINS[index % len(DOMAINS)])]
+    if index % 3 == 0:
+        uris.append(u'sip:+3120%07d@%s' % (index, DOMAINS[0]))
+    # skip __init__, which subscribes to notifications and loads the avatar
+    blink_contact = BlinkPresenceContact.alloc().init()
+    blink_contact.contact = AddressbookContact(u'Contact %d' % index, uris, subscribe=index % 7 != 0)
+    blink_contact._set_username_and_domain()
+    return blink_contact
+
+
+@unittest.skipIf(BlinkContact is None, 'ContactListModel needs the application frameworks')
+class BlinkContactURIIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(5)
+        self.group = BlinkGroup(u'Test', None)
+        self.pool = [make_contact(index) for index in xrange(300)]
+
+    def lookups(self):
+        contact = self.random.choice(self.pool)
+        return [contact.uri, u'sip:' + contact.uri, contact.username, contact.username[:3], u'0%s' % contact.username.lstrip(u'+')[-9:], u'nobody@nowhere.net']
+
+    def assertMatchesScan(self):
+        for uri in self.lookups():
+            for exact_match in (False, True):
+                expected = [contact for contact in self.group.contacts if contact.matchesURI(uri, exact_match)]
+                self.assertEqual(list(self.group.contactsMatchingURI(uri, exact_match)), expected, uri)
+
+    def test_contacts_are_kept_in_a_change_counting_list(self):
+        self.group.contacts = [self.pool[0]]
+        self.assertTrue(isinstance(self.group.contacts, BlinkContactList))
+        changes = self.group.contacts.changes
+        self.group.contacts.append(self.pool[1])
+        self.group.contacts.extend(self.pool[2:4])
+        self.assertEqual(self.group.contacts.changes, changes)
+        self.group.contacts.remove(self.pool[1])
+        self.group.contacts.sort(key=lambda contact: contact.name)
+        self.group.contacts[0] = self.pool[5]
+        del self.group.contacts[0]
+        self.assertEqual(self.group.contacts.changes, changes + 4)
+
+    def test_appended_contacts_are_indexed(self):
+        for contact in self.pool:
+            self.group.contacts.append(contact)
+            if self.random.random() < 0.1:
+                self.assertMatchesScan()
+        self.assertMatchesScan()
+
+    def test_group_changes(self):
+        self.group.contacts = self.pool[:100]
+        self.assertMatchesScan()
+        for i in xrange(200):
+            action = self.random.choice(['append', 'remove', 'sort', 'insert', 'replace', 'assign'])
+            contacts = self.group.contacts
+            if action == 'append':
+                contacts.append(self.random.choice(self.pool))
+            elif action == 'remove' and contacts:
+                contacts.remove(self.random.choice(contacts))
+            elif action == 'sort':
+                contacts.sort(key=lambda contact: contact.uri)
+            elif action == 'insert':
+                contacts.insert(self.random.randint(0, len(contacts)), self.random.choice(self.pool))
+            elif action == 'replace' and contacts:
+                contacts[self.random.randrange(len(contacts))] = self.random.choice(self.pool)
+            elif action == 'assign':
+                self.group.contacts = self.random.sample(self.pool, 50)
+            self.assertMatchesScan()
+
+    def test_invalidate_after_uri_change(self):
+        self.group.contacts = self.pool[:10]
+        contact = self.group.contacts[3]
+        self.assertEqual(list(self.group.contactsMatchingURI(u'zoe@example.net', True)), [])
+        contact.uris[0].uri = u'zoe@example.net'
+        contact._set_username_and_domain()
+        self.group.uri_index.invalidate()
+        self.assertEqual(list(self.group.contactsMatchingURI(u'zoe@example.net', True)), [contact])
+
+
+@unittest.skipIf(BlinkContact is None, 'ContactListModel needs the application frameworks')
+class BlinkContactSearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(7)
+        self.group = BlinkGroup(u'Test', None)
+        self.pool = [make_contact(index) for index in xrange(300)]
+
+    def assertFindsAsScan(self, text):
+        # typing the text one character at a time, as the search box does
+        for length in xrange(1, len(text) + 1):
+            prefix = text[:length]
+            expected = [position for position, contact in enumerate(self.group.contacts) if prefix in contact]
+            self.assertEqual(self.group.search_index.contacts_containing(self.group.contacts, prefix), expected, prefix)
+
+    def test_contacts_containing(self):
+        self.group.contacts = self.pool
+        for text in (u'alice1', u'Contact 12', u'EXAMPLE.ORG', u'+3120', u'@sip2', u'zz'):
+            self.assertFindsAsScan(text)
+
+    def test_group_changes(self):
+        self.group.contacts = self.pool[:100]
+        for i in xrange(100):
+            action = self.random.choice(['append', 'remove', 'sort'])
+            if action == 'append':
+                self.group.contacts.append(self.random.choice(self.pool))
+            elif action == 'remove':
+                self.group.contacts.remove(self.random.choice(self.group.contacts))
+            else:
+                self.group.contacts.sort(key=lambda contact: contact.uri)
+            self.assertFindsAsScan(self.random.choice([u'bob', u'contact 2', u'example', u'eve1']))
+
+    def test_rank(self):
+        alice = BlinkContact(u'alice@example.com', name=u'Alice Smith')
+        malice = BlinkContact(u'malice@example.com', name=u'Malice')
+        smith = BlinkContact(u'js@example.com', name=u'John Smith')
+        self.group.contacts = [malice, smith, alice]
+        self.assertEqual(self.group.contactsMatchingText(u'alice@example.com'), [(2, malice), (0, alice)])
+        self.assertEqual(self.group.contactsMatchingText(u'smith'), [(1, smith), (1, alice)])
+        self.assertEqual(self.group.contactsMatchingText(u'lice'), [(2, malice), (2, alice)])
+
+
+@unittest.skipIf(BlinkContact is None, 'ContactListModel needs the application frameworks')
+class BlinkPresenceURIIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(11)
+        self.index = BlinkPresenceURIIndex()
+        self.pool = [make_presence_contact(index) for index in xrange(200)] + [make_contact(index) for index in xrange(20)]
+        self.groups = [BlinkGroup(u'Group %d' % index, None) for index in xrange(4)]
+        for group in self.groups:
+            group.contacts = self.random.sample(self.pool, 80)
+
+    def scan(self, uri):
+        key = split_uri(uri)
+        return set((blink_contact, group) for group in self.groups for blink_contact in group.contacts
+                   if isinstance(blink_contact, BlinkPresenceContact) and blink_contact.contact.presence.subscribe and
+                   ((blink_contact.username, blink_contact.domain) == key or any(split_uri(item.uri) == key for item in blink_contact.uris)))
+
+    def assertMatchesScan(self):
+        self.index.refresh(self.groups)
+        for blink_contact in self.random.sample(self.pool, 20):
+            for item in blink_contact.uris:
+                self.assertEqual(set(self.index.contacts_matching_uri(item.uri)), self.scan(item.uri), item.uri)
+        self.assertEqual(self.index.contacts_matching_uri(u'nobody@nowhere.net'), [])
+
+    def test_notify_replay(self):
+        # a burst of presence updates for every contact, with the groups changing in between
+        self.assertMatchesScan()
+        for i in xrange(100):
+            group = self.random.choice(self.groups)
+            action = self.random.choice(['none', 'append', 'remove', 'sort', 'assign'])
+            if action == 'append':
+                group.contacts.append(self.random.choice(self.pool))
+            elif action == 'remove' and group.contacts:
+                group.contacts.remove(self.random.choice(group.contacts))
+            elif action == 'sort':
+                group.contacts.sort(key=lambda contact: contact.uri)
+            elif action == 'assign':
+                group.contacts = self.random.sample(self.pool, 60)
+            self.assertMatchesScan()
+
+    def test_groups_change(self):
+        self.assertMatchesScan()
+        self.groups.pop()
+        self.assertMatchesScan()
+        self.groups.append(BlinkGroup(u'New', None))
+        self.groups[-1].contacts = self.pool[:10]
+        self.assertMatchesScan()
+
+    def test_invalidate_after_subscription_change(self):
+        self.assertMatchesScan()
+        blink_contact = next(contact for contact in self.groups[0].contacts if isinstance(contact, BlinkPresenceContact) and contact.contact.presence.subscribe)
+        blink_contact.contact.presence.subscribe = False
+        self.index.invalidate()
+        self.assertMatchesScan()
+        self.assertFalse(any(contact is blink_contact for contact, group in self.index.contacts_matching_uri(blink_contact.uri)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import unittest
+
+from collections import deque
+
+try:
+    from DebugWindow import DebugWindow
+    from AppKit import NSTextStorage
+except ImportError:
+    DebugWindow = None
+
+
+class FakeTableView(object):
+    def __init__(self):
+        self.reloads = 0
+        self.row_changes = 0
+
+    def reloadData(self):
+        self.reloads += 1
+
+    def noteNumberOfRowsChanged(self):
+        self.row_changes += 1
+
+    def scrollRowToVisible_(self, row):
+        pass
+
+
+class FakeTextView(object):
+    def __init__(self, text):
+        self.storage = NSTextStorage.alloc().initWithString_(text)
+
+    def textStorage(self):
+        return self.storage
+
+    def scrollRangeToVisible_(self, range):
+        pass
+
+
+class FakeTextField(object):
+    def __init__(self, value=u''):
+        self.value = value
+
+    def stringValue(self):
+        return self.value
+
+    def setStringValue_(self, value):
+        self.value = value
+
+
+def notification(name, size=10):
+    return (name, 'sender', 'attributes', '2012-01-01 10:00:00', name.lower(), size)
+
+
+@unittest.skipIf(DebugWindow is None, 'DebugWindow needs the application frameworks')
+class DebugWindowNotificationsTest(unittest.TestCase):
+
+    def setUp(self):
+        # the window is not loaded from its nib, only the notifications list is used
+        window = DebugWindow.alloc()
+        window.notifications_limit = 3
+        window.notifications_unfiltered = deque(maxlen=3)
+        window.notifications = window.notifications_unfiltered
+        window.notifications_filter = u''
+        window.notificationsBytes = 0
+        window.notificationsTextView = FakeTableView()
+        window.notificationsInfoLabel = FakeTextField()
+        window.filterNotificationsSearchBox = FakeTextField()
+        self.window = window
+
+    def test_limit(self):
+        for index in xrange(5):
+            self.window.addNotification(notification('Notification%d' % index, size=index + 1))
+        self.assertEqual([item[0] for item in self.window.notifications], ['Notification2', 'Notification3', 'Notification4'])
+        self.assertEqual(self.window.notificationsBytes, 3 + 4 + 5)
+        # once the list is full every row moves, so the table is reloaded
+        self.assertEqual(self.window.notificationsTextView.row_changes, 3)
+        self.assertEqual(self.window.notificationsTextView.reloads, 2)
+
+    def test_filter(self):
+        self.window.addNotification(notification('SIPSessionDidStart'))
+        self.window.addNotification(notification('BlinkFileTransferDidEnd'))
+        self.window.filterNotificationsSearchBox.setStringValue_(u' Session ')
+        self.window.renderNotifications()
+        self.assertEqual([item[0] for item in self.window.notifications], ['SIPSessionDidStart'])
+        self.assertEqual(self.window.notificationsInfoLabel.stringValue(), '1 notifications matched')
+
+        self.window.addNotification(notification('SIPSessionDidEnd'))
+        self.window.addNotification(notification('SIPAccountDidActivate'))
+        self.window.addNotification(notification('SIPSessionWillStart'))
+        self.window.addNotification(notification('SIPSessionGotProposal'))
+        self.assertEqual([item[0] for item in self.window.notifications], ['SIPSessionDidEnd', 'SIPSessionWillStart', 'SIPSessionGotProposal'])
+        self.assertEqual([item[0] for item in self.window.notifications_unfiltered], ['SIPAccountDidActivate', 'SIPSessionWillStart', 'SIPSessionGotProposal'])
+
+        self.window.filterNotificationsSearchBox.setStringValue_(u'')
+        self.window.renderNotifications()
+        self.assertTrue(self.window.notifications is self.window.notifications_unfiltered)
+
+
+@unittest.skipIf(DebugWindow is None, 'DebugWindow needs the application frameworks')
+class DebugWindowTextViewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.window = DebugWindow.alloc()
+        self.window.text_view_limit = 100
+
+    def test_trimmed_at_line_boundary(self):
+        text_view = FakeTextView(u''.join(u'line %04d\n' % index for index in xrange(15)))
+        self.window.scroll_to_end(text_view)
+        self.assertEqual(text_view.textStorage().string(), u''.join(u'line %04d\n' % index for index in xrange(8, 15)))
+
+    def test_short_text_is_kept(self):
+        text = u''.join(u'line %04d\n' % index for index in xrange(10))
+        text_view = FakeTextView(text)
+        self.window.scroll_to_end(text_view)
+        self.assertEqual(text_view.textStorage().string(), text)
+
+    def test_text_without_newlines(self):
+        text_view = FakeTextView(u'x' * 150)
+        self.window.scroll_to_end(text_view)
+        self.assertEqual(text_view.textStorage().length(), 75)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import binascii
+import cStringIO
+import unittest
+
+try:
+    import EncryptionWrappers
+    from EncryptionWrappers import encryptor, decryptor, encrypt_file, decrypt_file, derive_key, CHUNK_SIZE
+except ImportError:
+    EncryptionWrappers = None
+
+
+PASSWORD = 'secret password'
+PLAINTEXT = 'Blink chat history replication'
+
+# encrypted with Cipher(alg='aes_128_cbc', key=PASSWORD, iv='\0' * 16, op=1, key_as_bytes=1, d='sha1', salt='saltsalt', i=5),
+# the cipher used before the derived keys were cached
+CIPHERTEXT = binascii.unhexlify('c476a3ef54d8126e9ca3c7879848212a09cafc06a0287d3ee4eac837d860f04a')
+DERIVED_KEY = binascii.unhexlify('ee91a531dcbcf2019d7a77e33f96f71c')
+
+
+@unittest.skipIf(EncryptionWrappers is None, 'EncryptionWrappers needs M2Crypto')
+class EncryptionWrappersTest(unittest.TestCase):
+
+    def setUp(self):
+        EncryptionWrappers._derived_keys.clear()
+
+    def test_derived_key(self):
+        self.assertEqual(derive_key(PASSWORD), DERIVED_KEY)
+
+    def test_decrypts_existing_ciphertext(self):
+        self.assertEqual(decryptor(PASSWORD)(CIPHERTEXT), PLAINTEXT)
+        self.assertEqual(decryptor(PASSWORD)(binascii.b2a_base64(CIPHERTEXT), b64_decode=True), PLAINTEXT)
+
+    def test_ciphertext_is_unchanged(self):
+        self.assertEqual(encryptor(PASSWORD)(PLAINTEXT), CIPHERTEXT)
+        self.assertEqual(encryptor(PASSWORD)(PLAINTEXT, b64_encode=True), binascii.b2a_base64(CIPHERTEXT).strip())
+
+    def test_round_trip(self):
+        for data in ('', 'x', 'x' * 16, 'x' * 1000):
+            self.assertEqual(decryptor(PASSWORD)(encryptor(PASSWORD)(data)), data)
+            self.assertEqual(decryptor(PASSWORD)(encryptor(PASSWORD)(data, b64_encode=True), b64_decode=True), data)
+
+    def test_files_match_the_data_functions(self):
+        # several chunks and a partial one, so that cipher_filter has to carry the cipher state between reads
+        data = ''.join(chr(index % 251) for index in xrange(3 * CHUNK_SIZE + 17))
+        ciphertext = encryptor(PASSWORD)(data)
+        for chunk_size in (CHUNK_SIZE, 1000):
+            encrypted = cStringIO.StringIO()
+            encrypt_file(PASSWORD, cStringIO.StringIO(data), encrypted, chunk_size)
+            self.assertEqual(encrypted.getvalue(), ciphertext)
+            decrypted = cStringIO.StringIO()
+            decrypt_file(PASSWORD, cStringIO.StringIO(ciphertext), decrypted, chunk_size)
+            self.assertEqual(decrypted.getvalue(), data)
+
+    def test_cache_does_not_hold_passwords(self):
+        derive_key(PASSWORD)
+        self.assertEqual(len(EncryptionWrappers._derived_keys), 1)
+        self.assertFalse(PASSWORD in EncryptionWrappers._derived_keys)
+        self.assertEqual(EncryptionWrappers._derived_keys.values(), [DERIVED_KEY])
+
+    def test_cache_is_bounded(self):
+        passwords = ['password %d' % index for index in xrange(EncryptionWrappers.DERIVED_KEYS_CACHE_SIZE + 5)]
+        keys = [derive_key(password) for password in passwords]
+        self.assertEqual(len(EncryptionWrappers._derived_keys), EncryptionWrappers.DERIVED_KEYS_CACHE_SIZE)
+        self.assertEqual(len(set(keys)), len(keys))
+        # evicted keys are derived again with the same result
+        self.assertEqual(derive_key(passwords[0]), keys[0])
+        self.assertEqual(decryptor(PASSWORD)(CIPHERTEXT), PLAINTEXT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import hashlib
+import random
+import unittest
+
+from FileWriteBuffer import FileWriteBuffer, WRITE_ALIGNMENT, WRITE_BUFFER_SIZE
+
+
+class RecordingFile(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.data = ''
+        self.writes = []
+
+    def write(self, data):
+        if self.fail:
+            raise IOError(28, 'No space left on device')
+        self.writes.append(len(data))
+        self.data += str(data)
+
+
+def stream_data(size):
+    return ''.join(hashlib.sha1(str(index)).digest() for index in xrange(size // 20 + 1))[:size]
+
+
+class FileWriteBufferTest(unittest.TestCase):
+
+    def receive(self, write_buffer, data):
+        rand = random.Random(len(data))
+        received = 0
+        while received < len(data):
+            chunk = data[received:received + rand.randint(1000, 9000)]
+            received += len(chunk)
+            write_buffer.write(chunk)
+
+    def test_aligned_writes(self):
+        fd = RecordingFile()
+        write_buffer = FileWriteBuffer(fd, hashlib.sha1())
+        data = stream_data(3 * WRITE_BUFFER_SIZE + 12345)
+        self.receive(write_buffer, data)
+        self.assertEqual(len(fd.writes), 3)
+        position = 0
+        for size in fd.writes:
+            position += size
+            self.assertEqual(position % WRITE_ALIGNMENT, 0)
+            self.assertTrue(size >= WRITE_BUFFER_SIZE - WRITE_ALIGNMENT)
+        # the rest stays buffered until the stream ends
+        self.assertEqual(write_buffer.position, position)
+        self.assertEqual(write_buffer.buffered, len(data) - position)
+        write_buffer.flush()
+        self.assertEqual(write_buffer.chunks, [])
+        self.assertEqual(write_buffer.buffered, 0)
+        self.assertEqual(fd.data, data)
+        self.assertEqual(write_buffer.hash.hexdigest(), hashlib.sha1(data).hexdigest())
+
+    def test_unaligned_start(self):
+        # data appended to a file that does not end on a block boundary
+        fd = RecordingFile()
+        write_buffer = FileWriteBuffer(fd, hashlib.sha1(), position=1000)
+        data = stream_data(2 * WRITE_BUFFER_SIZE)
+        self.receive(write_buffer, data)
+        position = 1000
+        for size in fd.writes:
+            position += size
+            self.assertEqual(position % WRITE_ALIGNMENT, 0)
+        write_buffer.flush()
+        self.assertEqual(fd.data, data)
+        self.assertEqual(write_buffer.hash.hexdigest(), hashlib.sha1(data).hexdigest())
+
+    def test_small_buffer(self):
+        fd = RecordingFile()
+        write_buffer = FileWriteBuffer(fd, hashlib.sha1(), size=4096, alignment=1024)
+        write_buffer.write('x' * 1000)
+        # nothing fills a whole block yet
+        write_buffer.flush(aligned=True)
+        self.assertEqual(fd.writes, [])
+        self.assertEqual(write_buffer.buffered, 1000)
+        write_buffer.write('y' * 3500)
+        self.assertEqual(fd.writes, [4096])
+        self.assertEqual(write_buffer.buffered, 404)
+        write_buffer.flush()
+        self.assertEqual(fd.data, 'x' * 1000 + 'y' * 3500)
+        write_buffer.flush()
+        self.assertEqual(len(fd.writes), 2)
+
+    def test_write_error(self):
+        write_buffer = FileWriteBuffer(RecordingFile(fail=True), hashlib.sha1())
+        write_buffer.write('x' * 1000)
+        self.assertRaises(EnvironmentError, write_buffer.flush)
+        self.assertEqual(write_buffer.chunks, [])
+        self.assertEqual(write_buffer.buffered, 0)
+        self.assertEqual(write_buffer.position, 0)
+        self.assertEqual(write_buffer.hash.hexdigest(), hashlib.sha1().hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Tests of the batched history writes, on an in-memory sqlite database with the
+schema of tests.test_history_indexes, and of the batches of the chat journal
+pushed to the replication server.
+"""
+
+import sqlite3
+import unittest
+
+from datetime import datetime
+
+from HistoryBatches import insert_session_entries, insert_chat_messages, WriteBehindQueue, journal_batches, remove_acknowledged_entries, IncomingJournal
+from tests.test_history_indexes import SESSIONS_TABLE, CHAT_MESSAGES_TABLE, BASE_INDEXES
+
+
+class Database(object):
+    # the part of the SQLObject connection used by execute_batch
+
+    def __init__(self, path=':memory:'):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(SESSIONS_TABLE)
+        self.connection.execute(CHAT_MESSAGES_TABLE)
+        for query in BASE_INDEXES:
+            self.connection.execute(query)
+        self.connection.commit()
+        self.released = 0
+
+    def getConnection(self):
+        return self.connection
+
+    def releaseConnection(self, connection):
+        self.released += 1
+
+    def query(self, query):
+        return self.connection.execute(query).fetchall()
+
+
+def message_row(msgid, status='delivered', journal_id='', local_uri=u'bob@example.com', remote_uri=u'alice@example.com', body=u'hello'):
+    return (msgid, '', '2011-05-01 10:00:00', '2011-05-01', 'chat', 'outgoing', local_uri, remote_uri,
+            local_uri, remote_uri, '2011-05-01 10:00:00+00:00', body, 'text/plain', 0, status, 'uuid', journal_id, '')
+
+
+def session_row(session_id, status='completed'):
+    return (session_id, 'audio', 'outgoing', status, '', datetime(2011, 5, 1, 10, 0), datetime(2011, 5, 1, 10, 5), 300,
+            'callid', 'fromtag', 'totag', u'bob@example.com', u'alice@example.com', '', '', 0, '')
+
+
+class FIFOExecutor(object):
+    # runs the scheduled functions when asked to, in order, like the single db thread does
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, func):
+        self.calls.append(func)
+
+    def run(self):
+        while self.calls:
+            self.calls.pop(0)()
+
+
+class InsertChatMessagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+
+    def test_insert(self):
+        insert_chat_messages(self.db, [message_row('1'), message_row('2'), message_row('3', remote_uri=u'carol@example.com')])
+        self.assertEqual(self.db.query("select msgid, remote_uri, body from chat_messages order by msgid"),
+                         [(u'1', u'alice@example.com', u'hello'), (u'2', u'alice@example.com', u'hello'), (u'3', u'carol@example.com', u'hello')])
+        self.assertEqual(self.db.released, 1)
+
+    def test_duplicates_are_ignored(self):
+        insert_chat_messages(self.db, [message_row('1', body=u'first')])
+        insert_chat_messages(self.db, [message_row('1', body=u'second'), message_row('1', body=u'third')])
+        self.assertEqual(self.db.query("select msgid, body from chat_messages"), [(u'1', u'first')])
+
+    def test_duplicate_updates_status_and_journal_id(self):
+        insert_chat_messages(self.db, [message_row('1', status='sending'), message_row('2', status='delivered', journal_id='5')])
+        insert_chat_messages(self.db, [message_row('1', status='delivered', journal_id='7', body=u'changed'), message_row('2', status='delivered', journal_id='5')])
+        self.assertEqual(self.db.query("select msgid, status, journal_id, body from chat_messages order by msgid"),
+                         [(u'1', u'delivered', u'7', u'hello'), (u'2', u'delivered', u'5', u'hello')])
+
+    def test_update_is_limited_to_the_conversation(self):
+        insert_chat_messages(self.db, [message_row('1', status='sending'), message_row('1', status='sending', remote_uri=u'carol@example.com')])
+        insert_chat_messages(self.db, [message_row('1', status='failed', remote_uri=u'carol@example.com')])
+        self.assertEqual(self.db.query("select remote_uri, status from chat_messages order by remote_uri"),
+                         [(u'alice@example.com', u'sending'), (u'carol@example.com', u'failed')])
+
+    def test_error_rolls_back_the_batch(self):
+        # the row with a missing value fails after the first one was inserted
+        rows = [message_row('1'), message_row('2')[:-1]]
+        self.assertRaises(sqlite3.Error, insert_chat_messages, self.db, rows)
+        self.assertEqual(self.db.query("select count(*) from chat_messages"), [(0,)])
+        self.assertEqual(self.db.released, 1)
+        insert_chat_messages(self.db, [message_row('3')])
+        self.assertEqual(self.db.query("select msgid from chat_messages"), [(u'3',)])
+
+    def test_isolation_level_is_restored(self):
+        isolation_level = self.db.connection.isolation_level
+        insert_chat_messages(self.db, [message_row('1')])
+        self.assertEqual(self.db.connection.isolation_level, isolation_level)
+
+
+class InsertSessionEntriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+
+    def test_duplicates_are_ignored(self):
+        insert_session_entries(self.db, [session_row('a', status='completed'), session_row('b')])
+        insert_session_entries(self.db, [session_row('a', status='missed'), session_row('c')])
+        self.assertEqual(self.db.query("select session_id, status from sessions order by session_id"),
+                         [(u'a', u'completed'), (u'b', u'completed'), (u'c', u'completed')])
+
+
+class WriteBehindQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.executor = FIFOExecutor()
+        self.queue = WriteBehindQueue(self.batches.append, self.executor)
+
+    def test_burst_is_written_in_one_batch(self):
+        for i in range(5):
+            self.queue.put(i)
+        self.assertEqual(len(self.executor.calls), 1)
+        self.assertEqual(self.batches, [])
+        self.executor.run()
+        self.assertEqual(self.batches, [[0, 1, 2, 3, 4]])
+
+    def test_rows_added_after_a_flush_start_a_new_batch(self):
+        self.queue.put(1)
+        self.executor.run()
+        self.queue.put(2)
+        self.queue.put(3)
+        self.executor.run()
+        self.assertEqual(self.batches, [[1], [2, 3]])
+
+    def test_flush_runs_before_later_work(self):
+        # a query scheduled after add_message must see the message stored
+        seen = []
+        self.queue.put(1)
+        self.executor(lambda: seen.append(list(self.batches)))
+        self.queue.put(2)
+        self.executor.run()
+        self.assertEqual(seen, [[[1, 2]]])
+
+    def test_rows_added_while_writing(self):
+        def writer(rows):
+            self.batches.append(rows)
+            if rows == [1]:
+                self.queue.put(2)
+        self.queue.writer = writer
+        self.queue.put(1)
+        self.executor.run()
+        self.assertEqual(self.batches, [[1], [2]])
+
+    def test_batches_are_written_to_the_database_in_order(self):
+        db = Database()
+        queue = WriteBehindQueue(lambda rows: insert_chat_messages(db, rows), self.executor)
+        queue.put(message_row('1', status='sending'))
+        queue.put(message_row('1', status='delivered', journal_id='3'))
+        self.executor.run()
+        queue.put(message_row('1', status='displayed', journal_id='4'))
+        self.executor.run()
+        self.assertEqual(db.query("select msgid, status, journal_id from chat_messages"), [(u'1', u'displayed', u'4')])
+
+
+def journal_entries(count, size=10, start=0):
+    return dict(('msg%04d' % index, {'id': 'msg%04d' % index, 'data': 'x' * size}) for index in xrange(start, start + count))
+
+
+class JournalBatchesTest(unittest.TestCase):
+
+    def test_batches_are_bounded(self):
+        entries = journal_entries(250)
+        batches = journal_batches(entries, set(), 2, 100, 1024 * 1024)
+        self.assertEqual([len(batch) for batch in batches], [100, 100])
+        self.assertFalse(set(batches[0]) & set(batches[1]))
+        for batch in batches:
+            for msgid, entry in batch.iteritems():
+                self.assertTrue(entries[msgid] is entry)
+
+    def test_batch_size(self):
+        entries = journal_entries(4, size=101)
+        entries.update(journal_entries(1, size=1000, start=4))
+        batches = journal_batches(entries, set(), 10, 100, 300)
+        self.assertEqual(sum(len(batch) for batch in batches), 5)
+        for batch in batches:
+            sizes = [len(entry['data']) for entry in batch.itervalues()]
+            # an entry larger than the limit is still sent, on its own
+            self.assertTrue(sum(sizes) <= 300 or len(sizes) == 1, sizes)
+
+    def test_entries_in_flight_are_left_out(self):
+        entries = journal_entries(10)
+        batches = journal_batches(entries, set(['msg0000', 'msg0001']), 2, 100, 1024)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(sorted(batches[0]), ['msg%04d' % index for index in xrange(2, 10)])
+        self.assertEqual(journal_batches(entries, set(entries), 2, 100, 1024), [])
+        self.assertEqual(journal_batches(entries, set(), 0, 100, 1024), [])
+
+
+class RemoveAcknowledgedEntriesTest(unittest.TestCase):
+
+    def test_acknowledged_entries_are_removed(self):
+        entries = journal_entries(15)
+        batch = journal_batches(entries, set(), 1, 10, 1024)[0]
+        self.assertEqual(sorted(remove_acknowledged_entries(entries, batch)), sorted(batch))
+        self.assertFalse(set(batch) & set(entries))
+        self.assertEqual(len(entries), 5)
+
+    def test_entry_queued_again_is_kept(self):
+        entries = journal_entries(3)
+        batch = journal_batches(entries, set(), 1, 10, 1024)[0]
+        # the message changed while the batch was in flight, the same data queued again is a new entry too
+        entries['msg0001'] = {'id': 'msg0001', 'data': 'y' * 10}
+        entries['msg0002'] = dict(entries['msg0002'])
+        self.assertEqual(remove_acknowledged_entries(entries, batch), ['msg0000'])
+        self.assertEqual(sorted(entries), ['msg0001', 'msg0002'])
+        self.assertEqual(entries['msg0001']['data'], 'y' * 10)
+        # which is pushed with the next batch and removed when that one is acknowledged
+        batch = journal_batches(entries, set(), 1, 10, 1024)[0]
+        self.assertEqual(sorted(remove_acknowledged_entries(entries, batch)), ['msg0001', 'msg0002'])
+        self.assertEqual(entries, {})
+
+    def test_entries_removed_meanwhile(self):
+        entries = journal_entries(2)
+        batch = journal_batches(entries, set(), 1, 10, 1024)[0]
+        del entries['msg0000']
+        self.assertEqual(remove_acknowledged_entries(entries, batch), ['msg0001'])
+        self.assertEqual(entries, {})
+
+
+def journal_events(members=(), results=0, summary=0):
+    # the events JSONStreamDecoder returns for a part of the journal
+    events = [(name, value, False) for name, value in members]
+    events.extend(('summary', {'journal_id': index, 'timestamp': 1300000000 + index}, True) for index in xrange(summary))
+    events.extend(('results', {'id': 'msg%04d' % index}, True) for index in xrange(results))
+    return events
+
+
+class IncomingJournalTest(unittest.TestCase):
+
+    def test_results_are_applied_in_batches(self):
+        journal = IncomingJournal(10)
+        self.assertEqual(journal.add_events(journal_events([('success', True)], summary=3)), [])
+        self.assertEqual(len(journal.add_events(journal_events(results=6))), 0)
+        self.assertEqual(len(journal.add_events(journal_events(results=6))), 12)
+        self.assertEqual(len(journal.add_events(journal_events(results=4))), 0)
+        self.assertEqual(len(journal.finish()), 4)
+        self.assertEqual(journal.count, 16)
+        self.assertEqual(len(journal.summary), 3)
+        self.assertEqual(journal.finish(), [])
+
+    def test_results_wait_for_success(self):
+        # the server sends the success member after the results
+        journal = IncomingJournal(10)
+        self.assertEqual(journal.add_events(journal_events(results=25)), [])
+        self.assertEqual(len(journal.add_events(journal_events([('success', True)]))), 25)
+        self.assertEqual(journal.finish(), [])
+
+    def test_failed_response(self):
+        journal = IncomingJournal(10)
+        self.assertEqual(journal.add_events(journal_events([('success', False), ('error_message', 'Database error')], results=25)), [])
+        self.assertEqual(journal.finish(), [])
+        self.assertEqual(journal.members, {'success': False, 'error_message': 'Database error'})
+
+    def test_failure_after_the_results(self):
+        journal = IncomingJournal(10)
+        self.assertEqual(journal.add_events(journal_events(results=25)), [])
+        self.assertEqual(journal.add_events(journal_events([('success', False)])), [])
+        self.assertEqual(journal.finish(), [])
+
+    def test_response_without_success(self):
+        journal = IncomingJournal(10)
+        self.assertEqual(journal.add_events(journal_events(results=25)), [])
+        self.assertEqual(journal.finish(), [])
+        self.assertFalse(journal.success)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Checks with EXPLAIN QUERY PLAN that the history queries are answered by the
+indexes the schema migrations create. The index definitions are read from
+HistoryManager.py, the tables are created the way SQLObject creates them.
+"""
+
+import ast
+import os
+import re
+import sqlite3
+import unittest
+
+
+HISTORY_MANAGER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'HistoryManager.py')
+
+SESSIONS_TABLE = """
+CREATE TABLE sessions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT,
+    media_types TEXT,
+    direction TEXT,
+    status TEXT,
+    failure_reason TEXT,
+    start_time TIMESTAMP,
+    end_time TIMESTAMP,
+    duration INT,
+    sip_callid TEXT,
+    sip_fromtag TEXT,
+    sip_totag TEXT,
+    local_uri VARCHAR(128),
+    remote_uri VARCHAR(128),
+    remote_focus TEXT,
+    participants LONGTEXT,
+    hidden INT,
+    am_filename LONGTEXT
+)
+"""
+
+CHAT_MESSAGES_TABLE = """
+CREATE TABLE chat_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    msgid TEXT,
+    direction TEXT,
+    time TIMESTAMP,
+    date DATE,
+    sip_callid TEXT,
+    sip_fromtag TEXT,
+    sip_totag TEXT,
+    local_uri VARCHAR(128),
+    remote_uri VARCHAR(128),
+    cpim_from VARCHAR(128),
+    cpim_to VARCHAR(128),
+    cpim_timestamp TEXT,
+    body LONGTEXT,
+    content_type TEXT,
+    private TEXT,
+    status TEXT,
+    media_type TEXT,
+    uuid TEXT,
+    journal_id TEXT,
+    encryption TEXT
+)
+"""
+
+# indexes declared with DatabaseIndex and the ones added by the older schema versions
+BASE_INDEXES = [
+    "CREATE UNIQUE INDEX sessions_session_idx ON sessions (session_id, local_uri, remote_uri)",
+    "CREATE INDEX sessions_local_idx ON sessions (local_uri)",
+    "CREATE INDEX sessions_remote_idx ON sessions (remote_uri)",
+    "CREATE INDEX sip_fromtag_index ON sessions (sip_fromtag)",
+    "CREATE INDEX start_time_index ON sessions (start_time)",
+    "CREATE UNIQUE INDEX chat_messages_msg_idx ON chat_messages (msgid, local_uri, remote_uri)",
+    "CREATE INDEX chat_messages_id_idx ON chat_messages (msgid)",
+    "CREATE INDEX chat_messages_local_idx ON chat_messages (local_uri)",
+    "CREATE INDEX chat_messages_remote_idx ON chat_messages (remote_uri)",
+    "CREATE INDEX date_index ON chat_messages (date)",
+    "CREATE INDEX time_index ON chat_messages (time)"
+]
+
+
+def load_index_definitions():
+    # the module needs the application frameworks, so only read its index constants
+    with open(HISTORY_MANAGER) as f:
+        source = f.read()
+    definitions = {}
+    for name in ('SESSIONS_INDEXES', 'CHAT_MESSAGES_INDEXES'):
+        match = re.search(r'^%s = (\{.*?^\})' % name, source, re.M | re.S)
+        definitions[name] = ast.literal_eval(match.group(1))
+    return definitions
+
+
+class HistoryIndexesTest(unittest.TestCase):
+
+    def setUp(self):
+        definitions = load_index_definitions()
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute(SESSIONS_TABLE)
+        self.db.execute(CHAT_MESSAGES_TABLE)
+        for query in BASE_INDEXES:
+            self.db.execute(query)
+        for table, name in (('sessions', 'SESSIONS_INDEXES'), ('chat_messages', 'CHAT_MESSAGES_INDEXES')):
+            for index, columns in definitions[name].items():
+                self.db.execute("CREATE INDEX IF NOT EXISTS %s ON %s %s" % (index, table, columns))
+
+    def tearDown(self):
+        self.db.close()
+
+    def query_plan(self, query):
+        return ' '.join(row[-1] for row in self.db.execute("EXPLAIN QUERY PLAN " + query))
+
+    def assertUsesIndex(self, query, index):
+        plan = self.query_plan(query)
+        self.assertTrue(('USING INDEX %s' % index) in plan or ('USING COVERING INDEX %s' % index) in plan, plan)
+        self.assertFalse('USE TEMP B-TREE FOR ORDER BY' in plan, plan)
+
+    def test_messages_page(self):
+        # ChatHistory._get_messages_page for a conversation, first and next pages
+        query = "select id, time from chat_messages where 1=1 and remote_uri in ('alice@example.com') and media_type in ('chat')"
+        self.assertUsesIndex(query + " order by time desc, id desc limit 100", 'remote_uri_media_type_time_index')
+        query += " and (time < '2016-01-01 10:00:00' or (time = '2016-01-01 10:00:00' and id < 1000))"
+        self.assertUsesIndex(query + " order by time desc, id desc limit 100", 'remote_uri_media_type_time_index')
+
+    def test_daily_entries(self):
+        # ChatHistory._get_daily_entries for an account
+        query = "select date, local_uri, remote_uri, media_type from chat_messages where local_uri = 'bob@example.com' group by date, remote_uri, media_type, local_uri order by date DESC"
+        self.assertTrue('local_uri_date_index' in self.query_plan(query), self.query_plan(query))
+
+    def test_messages_of_session(self):
+        # ChatHistory._get_messages by call id
+        query = "select id from chat_messages where 1=1 and sip_callid='abc@host' order by time desc limit 100"
+        self.assertTrue('sip_callid_index' in self.query_plan(query), self.query_plan(query))
+
+    def test_session_entries(self):
+        # SessionHistory._get_entries for the missed calls history group
+        query = "select id from sessions where direction = 'incoming' and status = 'missed' and hidden = 0 order by start_time desc limit 12"
+        self.assertUsesIndex(query, 'direction_status_hidden_start_time_index')
+
+    def test_known_calls(self):
+        # SessionHistory._get_known_calls used by the server history sync
+        query = "select direction, sip_callid, sip_fromtag from sessions where sip_callid in ('a@host','b@host') and sip_fromtag in ('1','2')"
+        self.assertTrue('sip_callid_fromtag_index' in self.query_plan(query), self.query_plan(query))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import time
+import unittest
+
+try:
+    import ldap
+    from ldap.controls import SimplePagedResultsControl
+    import ContactWindowController
+    from ContactWindowController import LdapSearch
+except ImportError:
+    LdapSearch = None
+
+
+def entry(name, number, *names):
+    return 'cn=%s,dc=example,dc=com' % name, {'cn': [name] + list(names), 'telephoneNumber': [number]}
+
+
+class StubConnection(object):
+    """Serves the given pages to a paged search, the cookie of a page is the index of the next one"""
+
+    def __init__(self, pages, size_limit_exceeded=False, on_page=None):
+        self.pages = pages
+        self.size_limit_exceeded = size_limit_exceeded
+        self.on_page = on_page
+        self.requests = []
+
+    def search_ext(self, base, scope, filter, attributes, serverctrls):
+        control = serverctrls[0]
+        self.requests.append((filter, control.size, control.cookie))
+        return len(self.requests)
+
+    def result3(self, msgid):
+        filter, size, cookie = self.requests[msgid-1]
+        if size == 0:
+            return ldap.RES_SEARCH_RESULT, [], msgid, []
+        index = int(cookie or 0)
+        if self.on_page is not None:
+            self.on_page(index)
+        if self.size_limit_exceeded and index == len(self.pages) - 1:
+            raise ldap.SIZELIMIT_EXCEEDED({'desc': 'Size limit exceeded'})
+        next_cookie = str(index + 1) if index + 1 < len(self.pages) else ''
+        return ldap.RES_SEARCH_RESULT, self.pages[index], msgid, [SimplePagedResultsControl(True, size=size, cookie=next_cookie)]
+
+
+class StubDirectory(object):
+    dn = 'dc=example,dc=com'
+    server = 'ldap://ldap.example.com:389'
+    size_limit = 100
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.released = []
+        self.closed = []
+
+    def acquire(self):
+        return self.connection
+
+    def release(self, l):
+        self.released.append(l)
+
+    def _close_connection(self, l):
+        self.closed.append(l)
+
+
+@unittest.skipIf(LdapSearch is None, 'ContactWindowController needs the application frameworks and python-ldap')
+class LdapSearchTest(unittest.TestCase):
+
+    def run_search(self, keyword, connection):
+        directory = StubDirectory(connection)
+        search = LdapSearch(directory)
+        search.keyword = keyword
+        search._search(keyword)
+        return search, directory
+
+    def test_paged_search(self):
+        connection = StubConnection([[entry('Alice One', '1'), entry('Alice Two', '2')], [entry('Alice Three', '3')]])
+        search, directory = self.run_search(u'alice', connection)
+        self.assertEqual([cookie for filter, size, cookie in connection.requests], ['', '1'])
+        self.assertEqual(directory.released, [connection])
+        timestamp, contacts, complete = search.cache['alice']
+        self.assertEqual([name for (name, uris), names in contacts], ['Alice One', 'Alice Two', 'Alice Three'])
+        self.assertEqual(contacts[0], (('Alice One', [('telephone', '1')]), ['Alice One']))
+        self.assertTrue(complete)
+        self.assertEqual(search.ldap_query_id, None)
+
+    def test_filter_is_escaped(self):
+        connection = StubConnection([[]])
+        self.run_search(u'a*(b)', connection)
+        self.assertEqual(connection.requests[0][0], 'cn=*a\\2a\\28b\\29*')
+
+    def test_size_limit_exceeded(self):
+        connection = StubConnection([[entry('Alice One', '1')], [entry('Alice Two', '2')]], size_limit_exceeded=True)
+        search, directory = self.run_search(u'alice', connection)
+        timestamp, contacts, complete = search.cache['alice']
+        self.assertEqual([name for (name, uris), names in contacts], ['Alice One'])
+        self.assertFalse(complete)
+        # the same keyword is served from the cache, a longer one must query the server again
+        self.assertEqual(search._cached_results(u'alice'), [('Alice One', [('telephone', '1')])])
+        self.assertEqual(search._cached_results(u'alice one'), None)
+
+    def test_abandon_when_keyword_changes(self):
+        pages = [[entry('Alice One', '1')], [entry('Alice Two', '2')], [entry('Alice Three', '3')]]
+        search = []
+        def on_page(index):
+            if index == 0:
+                search[0].keyword = u'bob'
+        connection = StubConnection(pages, on_page=on_page)
+        directory = StubDirectory(connection)
+        search.append(LdapSearch(directory))
+        search[0].keyword = u'alice'
+        search[0]._search(u'alice')
+        self.assertEqual([(size, cookie) for filter, size, cookie in connection.requests], [(LdapSearch.page_size, ''), (0, '1')])
+        self.assertFalse('alice' in search[0].cache)
+        self.assertEqual(directory.released, [connection])
+
+    def test_search_error(self):
+        class FailingConnection(StubConnection):
+            def result3(self, msgid):
+                raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        connection = FailingConnection([])
+        search, directory = self.run_search(u'alice', connection)
+        self.assertEqual(directory.closed, [connection])
+        self.assertEqual(directory.released, [])
+        self.assertFalse('alice' in search.cache)
+
+    def test_cached_prefix_results(self):
+        search = LdapSearch(StubDirectory(None))
+        now = time.time()
+        contacts = [(('Alice One', [('telephone', '1')]), ['Alice One']), (('Alice Two', [('telephone', '2')]), ['Alice Two'])]
+        search.cache['alic'] = (now, contacts, True)
+        self.assertEqual(search._cached_results(u'Alice T'), [contacts[1][0]])
+        # prefixes of three characters or less are not used
+        search.cache.clear()
+        search.cache['ali'] = (now, contacts, True)
+        self.assertEqual(search._cached_results(u'alice'), None)
+        # expired and incomplete results of a prefix are not used
+        search.cache.clear()
+        search.cache['alic'] = (now - search.cache_ttl - 1, contacts, True)
+        self.assertEqual(search._cached_results(u'alice'), None)
+        search.cache['alic'] = (now, contacts, False)
+        self.assertEqual(search._cached_results(u'alice'), None)
+
+    def test_cached_results_match_every_cn(self):
+        connection = StubConnection([[entry('Bob Smith', '1', 'Robert Smith'), entry('Alice Smith', '2'), entry('Smith & Co', '3', 'Robbie')]])
+        search, directory = self.run_search(u'smit', connection)
+        # the server found the entries by any of their names, so must the narrowed results
+        self.assertEqual(search._cached_results(u'smith'), [('Bob Smith', [('telephone', '1')]), ('Alice Smith', [('telephone', '2')]), ('Smith & Co', [('telephone', '3')])])
+        self.assertEqual(search._cached_results(u'smith &'), [('Smith & Co', [('telephone', '3')])])
+        search.cache['robe'] = search.cache['smit']
+        self.assertEqual(search._cached_results(u'robert'), [('Bob Smith', [('telephone', '1')])])
+
+    def test_posted_contacts(self):
+        posted = []
+        class Center(object):
+            def post_notification(self, name, sender=None, data=None):
+                posted.append(data.contacts)
+        saved = ContactWindowController.NotificationCenter
+        ContactWindowController.NotificationCenter = Center
+        try:
+            self.run_search(u'bob', StubConnection([[entry('Bob Smith', '1', 'Robert Smith')], [entry('Bob Jones', '2')]]))
+        finally:
+            ContactWindowController.NotificationCenter = saved
+        self.assertEqual(posted, [[('Bob Smith', [('telephone', '1')])], [('Bob Jones', [('telephone', '2')])]])
+
+
+if __name__ == '__main__':
+    unittest.main()
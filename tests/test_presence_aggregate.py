@@ -0,0 +1,121 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import datetime
+import unittest
+
+import PresenceAggregate as presence_aggregate
+from PresenceAggregate import PresenceAggregate
+
+
+class Value(object):
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+class TimeOffset(int):
+    description = None
+
+
+def service(id, basic='open', extended='available', timestamp=None, notes=(), idle=False, time_offset=None, homepage=None, icon=None):
+    device_info = Value(description='Laptop %s' % id, user_agent='Blink', time_offset=TimeOffset(time_offset) if time_offset is not None else None)
+    return Value(id=id,
+                 timestamp=Value(value=timestamp) if timestamp is not None else None,
+                 user_input=Value(value='idle' if idle else 'active'),
+                 status=Value(basic=basic, extended=extended),
+                 notes=list(notes),
+                 homepage=Value(value=homepage) if homepage else None,
+                 capabilities=Value(audio=True, message=True, file_transfer=False, screen_sharing_server=False, screen_sharing_client=True),
+                 contact=Value(value='alice@example.com;gr=%s' % id),
+                 icon=icon,
+                 device_info=device_info,
+                 map=None)
+
+
+def pidf(entity, *services):
+    return Value(entity=entity, services=list(services))
+
+
+class FrozenDateTime(datetime.datetime):
+    now = datetime.datetime(2011, 5, 1, 10, 0)
+
+    @classmethod
+    def utcnow(cls):
+        return cls.now
+
+
+class PresenceAggregateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_datetime = presence_aggregate.datetime
+        presence_aggregate.datetime = Value(datetime=FrozenDateTime, timedelta=datetime.timedelta)
+        FrozenDateTime.now = datetime.datetime(2011, 5, 1, 10, 0)
+
+    def tearDown(self):
+        presence_aggregate.datetime = self.saved_datetime
+
+    def pidfs(self):
+        return [pidf('alice@example.com',
+                     service('laptop', extended='busy', timestamp=datetime.datetime(2011, 5, 1, 9, 0), notes=[u'In a meeting'], time_offset=120, homepage='http://example.com', icon=u'http://example.com/icon.png'),
+                     service('old', extended='away', timestamp=datetime.datetime(2011, 5, 1, 8, 0))),
+                pidf('sip:alice@example.org', service('phone', basic='closed', extended='offline', notes=[u'Gone']))]
+
+    def test_status(self):
+        aggregate = PresenceAggregate(self.pidfs())
+        self.assertEqual(aggregate.status, {'available': False, 'away': False, 'busy': True, 'offline': True})
+        self.assertEqual(aggregate.urls, ['http://example.com'])
+        self.assertEqual(aggregate.has_notes, 2)
+
+    def test_most_recent_services(self):
+        aggregate = PresenceAggregate(self.pidfs())
+        self.assertEqual([(service_id, uri, status, notes) for service_id, device_text, uri, status, notes in aggregate.transitions],
+                         [('laptop', 'alice@example.com', 'busy', [u'In a meeting']), ('phone', 'alice@example.org', 'offline', [u'Gone'])])
+        devices = aggregate.copy_devices()
+        self.assertEqual(sorted(devices), ['laptop', 'old', 'phone'])
+        self.assertEqual(devices['laptop']['icon'], u'http://example.com/icon.png')
+        self.assertEqual(devices['old']['icon'], None)
+        self.assertEqual(devices['laptop']['caps'], set(['audio', 'chat', 'screen-sharing-client']))
+        self.assertEqual(devices['laptop']['aor'], ['sip:alice@example.com'])
+        self.assertEqual(devices['laptop']['contact'], 'sip:alice@example.com;gr=laptop')
+
+    def test_shared_aggregate_matches_a_new_one(self):
+        # the copies of a contact in several groups share one aggregate instead of each walking the pidfs
+        pidfs = self.pidfs()
+        shared = PresenceAggregate(pidfs)
+        first, second = shared.copy_devices(), shared.copy_devices()
+        fresh = PresenceAggregate(pidfs)
+        self.assertEqual(first, fresh.copy_devices())
+        self.assertEqual(second, fresh.copy_devices())
+        self.assertEqual(shared.status, fresh.status)
+        self.assertEqual(shared.transitions, fresh.transitions)
+
+    def test_copies_are_independent(self):
+        aggregate = PresenceAggregate(self.pidfs())
+        devices = aggregate.copy_devices()
+        devices['laptop']['aor'].append('sip:alice@example.net')
+        devices['laptop']['caps'].add('file-transfer')
+        devices['laptop']['notes'].append(u'Changed')
+        devices['laptop']['status'] = 'available'
+        devices = aggregate.copy_devices()
+        self.assertEqual(devices['laptop']['aor'], ['sip:alice@example.com'])
+        self.assertEqual(devices['laptop']['caps'], set(['audio', 'chat', 'screen-sharing-client']))
+        self.assertEqual(devices['laptop']['notes'], [u'In a meeting'])
+        self.assertEqual(devices['laptop']['status'], 'busy')
+
+    def test_local_time_is_computed_when_read(self):
+        aggregate = PresenceAggregate(self.pidfs())
+        devices = aggregate.copy_devices()
+        self.assertEqual(devices['laptop']['local_time'], '12:00 (UTC+2)')
+        self.assertEqual(devices['laptop']['time_offset'], '(UTC+2)')
+        self.assertEqual(devices['phone']['local_time'], None)
+        # the cached aggregate is read again later
+        FrozenDateTime.now = datetime.datetime(2011, 5, 1, 13, 30)
+        self.assertEqual(aggregate.copy_devices()['laptop']['local_time'], '15:30 (UTC+2)')
+
+    def test_fractional_time_offset(self):
+        aggregate = PresenceAggregate([pidf('bob@example.com', service('laptop', time_offset=330))])
+        self.assertEqual(aggregate.copy_devices()['laptop']['local_time'], '15:30 (UTC+5.5)')
+
+
+if __name__ == '__main__':
+    unittest.main()
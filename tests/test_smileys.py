@@ -0,0 +1,75 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import os
+import random
+import unittest
+
+try:
+    from SmileyManager import SmileyManager
+    from util import escape_html
+except ImportError:
+    SmileyManager = None
+
+
+SMILEYS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'smileys')
+
+
+def load_manager():
+    # the instance made by the singleton loads the theme from the application bundle
+    manager = object.__new__(SmileyManager)
+    manager.smileys = {}
+    manager.smileys_html = {}
+    manager.smileys_pattern = None
+    manager.smiley_keys = []
+    manager.load_theme(SMILEYS_DIRECTORY, 'default')
+    return manager
+
+
+def replace_loop(manager, text):
+    # substitution as done before the smileys were compiled into a single pattern
+    items = sorted(manager.smileys_html.items(), reverse=True)
+    for k, v in items:
+        text = text.replace(k, v)
+    return text
+
+
+@unittest.skipIf(SmileyManager is None, 'SmileyManager needs the application frameworks')
+class SmileyManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = load_manager()
+
+    def img(self, name):
+        return "<img src='file:%s' class='smiley' />" % os.path.join(SMILEYS_DIRECTORY, 'default', name)
+
+    def test_golden_output(self):
+        subst = self.manager.subst_smileys_html
+        self.assertEqual(subst('hello'), 'hello')
+        self.assertEqual(subst(':)'), self.img('smile.png'))
+        self.assertEqual(subst(':-)&nbsp;there'), self.img('smile.png') + '&nbsp;there')
+        self.assertEqual(subst('a:Db'), 'a%sb' % self.img('smile-big.png'))
+        self.assertEqual(subst(escape_html("<:o) and :'(")), '%s&nbsp;and&nbsp;%s' % (self.img('party.png'), self.img('crying.png')))
+        self.assertEqual(subst('(pl)(P)'), self.img('plate.png') + self.img('camera.png'))
+
+    def test_longer_smileys_win(self):
+        # (pl) and :-) start with other smileys
+        self.assertEqual(self.manager.subst_smileys_html('(pl)'), self.img('plate.png'))
+        self.assertEqual(self.manager.subst_smileys_html(':-)'), self.img('smile.png'))
+
+    def test_same_output_as_replace_loop(self):
+        rand = random.Random(3)
+        smileys = self.manager.smileys.keys()
+        words = ['hello', 'how', 'are', 'you', 'today', 'see', 'http://example.com/a(b)', '100%', '"quoted"']
+        for i in xrange(2000):
+            parts = [rand.choice(smileys) if rand.random() < 0.3 else rand.choice(words) for j in xrange(rand.randint(1, 12))]
+            text = escape_html(' '.join(parts))
+            self.assertEqual(self.manager.subst_smileys_html(text), replace_loop(self.manager, text), text)
+
+    def test_empty_theme(self):
+        self.manager.smileys_pattern = None
+        self.assertEqual(self.manager.subst_smileys_html(':)'), ':)')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from BlinkLogger import TraceFile
+except ImportError:
+    TraceFile = None
+
+
+@unittest.skipIf(TraceFile is None, 'BlinkLogger needs the application frameworks')
+class TraceFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'sip_trace.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def read(self, filename=None):
+        with open(filename or self.filename, 'rb') as f:
+            return f.read()
+
+    def read_segment(self, index):
+        f = gzip.open('%s.%d.gz' % (self.filename, index), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_buffering(self):
+        trace_file = TraceFile(self.filename, buffer_size=100, max_size=0, backup_count=5)
+        trace_file.write('a' * 60)
+        self.assertEqual(self.read(), '')
+        trace_file.write(u'caf\xe9 ' * 8)
+        self.assertEqual(self.read(), 'a' * 60 + 'caf\xc3\xa9 ' * 8)
+        trace_file.write('b' * 10)
+        trace_file.flush()
+        self.assertEqual(len(self.read()), 60 + 48 + 10)
+        trace_file.write('c')
+        trace_file.close()
+        self.assertTrue(self.read().endswith('bc'))
+
+    def test_existing_file_is_appended(self):
+        with open(self.filename, 'wb') as f:
+            f.write('x' * 50)
+        trace_file = TraceFile(self.filename, buffer_size=10, max_size=100, backup_count=5)
+        self.assertEqual(trace_file.size, 50)
+        trace_file.write('y' * 40)
+        trace_file.close()
+        self.assertEqual(self.read(), 'x' * 50 + 'y' * 40)
+        self.assertFalse(os.path.exists(self.filename + '.1.gz'))
+
+    def test_rotation(self):
+        trace_file = TraceFile(self.filename, buffer_size=1, max_size=100, backup_count=3)
+        chunks = [chr(ord('a') + index) * 100 for index in xrange(5)]
+        for chunk in chunks:
+            trace_file.write(chunk)
+        trace_file.write('tail')
+        trace_file.close()
+        self.assertEqual(self.read(), 'tail')
+        # the newest segment comes first and only backup_count segments are kept
+        self.assertEqual([self.read_segment(index) for index in (1, 2, 3)], chunks[:-4:-1])
+        self.assertFalse(os.path.exists(self.filename + '.4.gz'))
+        self.assertEqual(sorted(os.listdir(self.folder)), ['sip_trace.txt', 'sip_trace.txt.1.gz', 'sip_trace.txt.2.gz', 'sip_trace.txt.3.gz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
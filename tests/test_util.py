@@ -0,0 +1,166 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+import random
+import shlex
+import unittest
+
+try:
+    import util
+except ImportError:
+    util = None
+
+
+IDENTITIES = [
+    'sip:alice@example.com',
+    '<sip:alice@example.com>',
+    '"Alice" <sip:alice@example.com>',
+    '"Alice Smith" <sip:alice@example.com;transport=tls>',
+    'Alice Smith <sip:alice@example.com>',
+    "'Alice' <sip:alice@example.com>",
+    '"Bob \'The Builder\'" <sips:bob@example.org:5061>',
+    'Bob"by" <sip:bob@example.org>',
+    '"" <sip:anonymous@anonymous.invalid>',
+    'sip:+31208005100@example.com',
+    '"+31 20 800 5100" <sip:0031208005100@sip2sip.info>',
+    'sip:+31208005100@10.0.0.1',
+    '<sip:123456@192.168.1.20>',
+    'tel:+31208005100',
+    '   spaced   <sip:spaced@example.com>   ',
+    'tab\tseparated <sip:tab@example.com>',
+    'alice@example.com',
+    '',
+]
+
+
+def random_identity(rand):
+    alphabet = ['a', 'b', 'Z', '0', '9', '+', '@', '.', ':', ';', '=', '<', '>', ' ', '\t', '"', "'", '-', '_', '\xc3\xa9']
+    return ''.join(rand.choice(alphabet) for i in xrange(rand.randint(0, 30)))
+
+
+@unittest.skipIf(util is None, 'util needs the application frameworks')
+class SplitIdentityTest(unittest.TestCase):
+
+    def assertSameAsShlex(self, text):
+        try:
+            expected = shlex.split(text)
+        except ValueError:
+            self.assertRaises(ValueError, util._split_identity, text)
+        else:
+            self.assertEqual(util._split_identity(text), expected, repr(text))
+
+    def test_identities(self):
+        for text in IDENTITIES:
+            self.assertSameAsShlex(text)
+
+    def test_random_identities(self):
+        rand = random.Random(1)
+        for i in xrange(20000):
+            self.assertSameAsShlex(random_identity(rand))
+
+    def test_backslashes(self):
+        self.assertSameAsShlex('"Alice \\"A\\"" <sip:alice@example.com>')
+        self.assertSameAsShlex('back\\ slash <sip:b@example.com>')
+
+    def test_components(self):
+        self.assertEqual(util.sipuri_components_from_string('"Alice Smith" <sip:alice@example.com>'), ('sip:alice@example.com', 'Alice Smith', 'Alice Smith <sip:alice@example.com>', 'Alice Smith <sip:alice@example.com>'))
+        self.assertEqual(util.sipuri_components_from_string('Bob <+31208005100@10.0.0.1>'), ('+31208005100', 'Bob', 'Bob <+31208005100@10.0.0.1>', 'Bob <+31208005100>'))
+        components = util.sipuri_components_from_string(u'"Ren\xe9" <sip:rene@example.com>')
+        self.assertEqual(components[1], u'Ren\xe9')
+        self.assertTrue(all(isinstance(item, unicode) for item in components))
+        self.assertTrue(all(isinstance(item, str) for item in util.sipuri_components_from_string('sip:alice@example.com')))
+
+    def test_components_are_cached_per_type(self):
+        first = util.sipuri_components_from_string(u'sip:carol@example.com')
+        self.assertTrue(util.sipuri_components_from_string(u'sip:carol@example.com') is first)
+        self.assertTrue(isinstance(util.sipuri_components_from_string('sip:carol@example.com')[0], str))
+
+
+@unittest.skipIf(util is None, 'util needs the application frameworks')
+class LRUCacheTest(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = util.LRUCache(3)
+        for key in 'abcd':
+            cache[key] = key.upper()
+        self.assertEqual(len(cache), 3)
+        self.assertFalse('a' in cache)
+        self.assertRaises(KeyError, cache.__getitem__, 'a')
+        self.assertEqual(cache['b'], 'B')
+
+    def test_recently_used_entries_are_kept(self):
+        cache = util.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a']
+        cache['c'] = 3
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        # replacing a value refreshes the entry too
+        cache['a'] = 4
+        cache['d'] = 5
+        self.assertEqual(cache['a'], 4)
+        self.assertFalse('c' in cache)
+
+    def test_clear(self):
+        cache = util.LRUCache(2)
+        cache['a'] = 1
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertFalse('a' in cache)
+
+
+@unittest.skipIf(util is None, 'util needs the application frameworks')
+class JSONStreamDecoderTest(unittest.TestCase):
+    document = '{"success": true, "summary": [{"id": 1, "text": "a, [b] {c}"}, {"id": 2, "text": "quote \\" and \\\\"}], "error_message": "", "results": [], "placed": [[1, 2], {"x": "]"}]}'
+
+    def decode(self, chunks, streamed_members=('summary', 'results', 'placed')):
+        decoder = util.JSONStreamDecoder(streamed_members)
+        events = []
+        for chunk in chunks:
+            events.extend(decoder.feed(chunk))
+        decoder.close()
+        return events
+
+    def reassemble(self, events):
+        result = {}
+        for name, value, is_item in events:
+            if is_item:
+                result.setdefault(name, []).append(value)
+            else:
+                self.assertFalse(name in result)
+                result[name] = value
+        return result
+
+    def test_streamed_members_are_returned_as_items(self):
+        events = self.decode([self.document])
+        expected = util.cjson.decode(self.document)
+        self.assertEqual([value for name, value, is_item in events if name == 'summary'], expected['summary'])
+        self.assertTrue(all(is_item for name, value, is_item in events if name in ('summary', 'placed')))
+        self.assertTrue(all(not is_item for name, value, is_item in events if name in ('success', 'error_message')))
+        self.assertFalse([event for event in events if event[0] == 'results'])
+
+    def test_every_split_point(self):
+        expected = util.cjson.decode(self.document)
+        expected.pop('results')
+        for index in xrange(len(self.document) + 1):
+            events = self.decode([self.document[:index], self.document[index:]])
+            self.assertEqual(self.reassemble(events), expected, index)
+
+    def test_byte_by_byte(self):
+        events = self.decode(list(self.document))
+        self.assertEqual(events, self.decode([self.document]))
+
+    def test_not_streamed(self):
+        events = self.decode([self.document], streamed_members=())
+        self.assertEqual(dict((name, value) for name, value, is_item in events), util.cjson.decode(self.document))
+        self.assertFalse(any(is_item for name, value, is_item in events))
+
+    def test_incomplete_document(self):
+        decoder = util.JSONStreamDecoder(('summary',))
+        decoder.feed(self.document[:-1])
+        self.assertRaises(ValueError, decoder.close)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,17 +5,20 @@ __all__ = ['audio_codecs', 'allocate_autorelease_pool', 'beautify_audio_codec',
            'compare_identity_addresses', 'escape_html', 'external_url_pattern', 'format_uri_type', 'format_identity_to_string', 'format_date', 'format_size', 'format_size_rounded', 'is_sip_aor_format', 'is_anonymous', 'image_file_extension_pattern', 'html2txt', 'normalize_sip_uri_for_outgoing_session', 'osx_version',
            'sipuri_components_from_string', 'strip_addressbook_special_characters', 'sip_prefix_pattern', 'video_file_extension_pattern',  'translate_alpha2digit', 'checkValidPhoneNumber',
            'BLINK_URL_TOKEN',
-           'AccountInfo', 'DictDiffer']
+           'AccountInfo', 'DictDiffer', 'JSONStreamDecoder', 'LRUCache']
 
 from AppKit import NSApp, NSRunAlertPanel
 from Foundation import NSAutoreleasePool, NSBundle, NSThread, NSLocalizedString
 
+import cjson
 import platform
 import re
 import shlex
 import unicodedata
 
+from collections import OrderedDict
 from datetime import datetime
+from threading import Lock
 
 from application.python.decorator import decorator, preserve_signature
 
@@ -167,19 +170,57 @@ def format_identity_to_string(identity, check_contact=False, format='AOR'):
         return address
 
 
+_identity_token_pattern = re.compile(r"""[ \t\r\n]+|[^ \t\r\n"'\\]+|"[^"\\]*"|'[^']*'""")
+_identity_number_ip_pattern = re.compile(r'^(?P<number>\+?[0-9]\d{5,15})@(\d{1,3}\.){3}\d{1,3}$')
+_identity_number_pattern = re.compile(r'^(?P<number>(00|\+)[1-9]\d{4,14})@')
+
+
+def _split_identity(uri):
+    # same result as shlex.split for identities without backslashes, anything fancier is left to shlex
+    if '\\' in uri:
+        return shlex.split(uri)
+    toks = []
+    tok = None
+    pos = 0
+    while pos < len(uri):
+        match = _identity_token_pattern.match(uri, pos)
+        if match is None:
+            # unbalanced quotes
+            return shlex.split(uri)
+        part = match.group()
+        pos = match.end()
+        if part[0] in ' \t\r\n':
+            if tok is not None:
+                toks.append(tok)
+                tok = None
+            continue
+        if part[0] in '"\'':
+            part = part[1:-1]
+        tok = part if tok is None else tok + part
+    if tok is not None:
+        toks.append(tok)
+    return toks
+
+
 def sipuri_components_from_string(text):
     """
     Takes a SIP URI in text format and returns formatted strings with various sub-parts
     """
+    key = (text.__class__, text)
+    try:
+        return _sipuri_components_cache[key]
+    except KeyError:
+        pass
+
     display_name = ""
     address = ""
     full_uri = ""
     fancy_uri = ""
 
-    # the shlex module doesn't support unicode
+    # work on utf8 encoded strings like the shlex module, which doesn't support unicode
     uri = text.encode('utf8') if isinstance(text, unicode) else text
 
-    toks = shlex.split(uri)
+    toks = _split_identity(uri)
 
     if len(toks) == 2:
         display_name = toks[0]
@@ -187,11 +228,7 @@ def sipuri_components_from_string(text):
     elif len(toks) == 1:
         address = toks[0]
     elif len(toks) > 2:
-        j = 0
-        while (j < len(toks) -1):
-            display_name = '%s %s' % (display_name, toks[j])
-            j = j + 1
-        display_name = display_name.strip()
+        display_name = ' '.join(toks[:-1]).strip()
         address = toks[-1]
     else:
         address = uri
@@ -203,8 +240,8 @@ def sipuri_components_from_string(text):
     else:
         full_uri = address
 
-    match_number_ip = re.match(r'^(?P<number>\+?[0-9]\d{5,15})@(\d{1,3}\.){3}\d{1,3}$', address)
-    match_number = re.match(r'^(?P<number>(00|\+)[1-9]\d{4,14})@', address)
+    match_number_ip = _identity_number_ip_pattern.match(address)
+    match_number = _identity_number_pattern.match(address)
     match = match_number_ip or match_number
 
     if match is not None:
@@ -219,9 +256,11 @@ def sipuri_components_from_string(text):
         fancy_uri = address
 
     if isinstance(text, unicode):
-        return address.decode('utf8'), display_name.decode('utf8'), full_uri.decode('utf8'), fancy_uri.decode('utf8')
+        components = address.decode('utf8'), display_name.decode('utf8'), full_uri.decode('utf8'), fancy_uri.decode('utf8')
     else:
-        return address, display_name, full_uri, fancy_uri
+        components = address, display_name, full_uri, fancy_uri
+    _sipuri_components_cache[key] = components
+    return components
 
 
 def is_sip_aor_format(uri):
@@ -310,7 +349,6 @@ def escape_html(text):
     text = text.replace('"', '&quot;')
     text = text.replace("'", '&apos;')
     text = text.replace(' ', '&nbsp;')
-    text = text.replace('\\', '\\\\')
     text = text.replace('\r\n', '<br/>')
     text = text.replace('\n', '<br/>')
     text = text.replace('\r', '<br/>')
@@ -461,6 +499,140 @@ class DictDiffer(object):
     def unchanged(self):
         return set(o for o in self.intersect if self.past_dict[o] == self.current_dict[o])
 
+class LRUCache(object):
+    """
+        Dictionary like cache holding at most size entries, the least recently used ones are discarded first
+        """
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = Lock()
+    def __getitem__(self, key):
+        with self.lock:
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.size:
+                self.data.popitem(last=False)
+    def __contains__(self, key):
+        return key in self.data
+    def __len__(self):
+        return len(self.data)
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+class JSONStreamDecoder(object):
+    """
+        Incremental decoder for a JSON object received in chunks. The elements of the arrays held
+        by the members named in streamed_members are returned one by one as soon as they are complete,
+        so only the element being received is kept in memory. Other members are returned whole.
+        feed() returns a list of (name, value, is_item) tuples.
+        """
+    _token_pattern = re.compile(r'["{}\[\],:]')
+    _string_pattern = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+
+    def __init__(self, streamed_members=()):
+        self.streamed_members = frozenset(streamed_members)
+        self.buffer = ''
+        self.position = 0
+        self.depth = 0
+        self.mark = None
+        self.name = None
+        self.expect_name = False
+        self.streaming = False
+        self.streamed = False
+        self.finished = False
+
+    def feed(self, data):
+        start = self.mark if self.mark is not None else self.position
+        self.buffer = self.buffer[start:] + data
+        self.position -= start
+        if self.mark is not None:
+            self.mark -= start
+
+        events = []
+        buffer = self.buffer
+        position = self.position
+        while not self.finished:
+            match = self._token_pattern.search(buffer, position)
+            if match is None:
+                position = len(buffer)
+                break
+            token = match.group()
+            index = match.start()
+            position = index + 1
+            if token == '"':
+                string = self._string_pattern.match(buffer, index)
+                if string is None:
+                    position = index
+                    break
+                position = string.end()
+                if self.depth == 1 and self.expect_name:
+                    self.name = cjson.decode(string.group())
+                    self.expect_name = False
+            elif token == ':':
+                if self.depth == 1:
+                    self.mark = position
+            elif token == ',':
+                if self.depth == 1:
+                    self._end_member(buffer, index, events)
+                    self.expect_name = True
+                elif self.depth == 2 and self.streaming:
+                    self._end_item(buffer, index, events)
+                    self.mark = position
+            elif token == '[':
+                if self.depth == 1 and self.mark is not None and self.name in self.streamed_members and not buffer[self.mark:index].strip():
+                    self.streaming = True
+                    self.mark = position
+                self.depth += 1
+            elif token == ']':
+                if self.depth == 2 and self.streaming:
+                    self._end_item(buffer, index, events)
+                    self.streaming = False
+                    self.streamed = True
+                    self.mark = None
+                self.depth -= 1
+            elif token == '{':
+                self.depth += 1
+                if self.depth == 1:
+                    self.expect_name = True
+            elif token == '}':
+                if self.depth == 1:
+                    self._end_member(buffer, index, events)
+                    self.finished = True
+                self.depth -= 1
+            if self.depth < 0:
+                raise ValueError('Unbalanced JSON document')
+
+        self.position = position
+        return events
+
+    def close(self):
+        if not self.finished:
+            raise ValueError('Incomplete JSON document')
+
+    def _end_member(self, buffer, index, events):
+        if self.mark is not None:
+            value = buffer[self.mark:index].strip()
+            if not self.streamed and value:
+                events.append((self.name, cjson.decode(value), False))
+        self.mark = None
+        self.name = None
+        self.streamed = False
+
+    def _end_item(self, buffer, index, events):
+        value = buffer[self.mark:index].strip()
+        if value:
+            events.append((self.name, cjson.decode(value), True))
+
+
+_sipuri_components_cache = LRUCache(4096)
+
 def memory_stick_mode():
     return unicodedata.normalize('NFC', NSBundle.mainBundle().bundlePath()).lower().startswith('/volumes/blink stick')
 